@@ -16,13 +16,83 @@ GROQ_MODEL = os.getenv("GROQ_MODEL", "meta-llama/llama-4-scout-17b-16e-instruct"
 GOOGLE_MODEL = os.getenv("GOOGLE_MODEL", "gemini-2.5-flash")
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini-2024-07-18")
 
+# Conversation memory cache
+MEMORY_CACHE_MAX_ENTRIES = int(os.getenv("MEMORY_CACHE_MAX_ENTRIES", "5000"))
+MEMORY_CACHE_MAX_BYTES = int(os.getenv("MEMORY_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+MEMORY_CACHE_TTL_MINUTES = float(os.getenv("MEMORY_CACHE_TTL_MINUTES", "30"))
+MEMORY_BACKEND = os.getenv("MEMORY_BACKEND", "supabase")  # "supabase", "sqlite" or "memory"
+MEMORY_SQLITE_PATH = os.getenv("MEMORY_SQLITE_PATH", "conversation_memory.db")
+MEMORY_STORAGE_MODE = os.getenv("MEMORY_STORAGE_MODE", "snapshot")  # "snapshot" or "append_log"
+MEMORY_CODEC = os.getenv("MEMORY_CODEC", "orjson")  # "json", "orjson" or "msgpack-zstd" (see core/codecs.py)
+
+# Conversation window: sized by a token budget, with a hard message cap
+MEMORY_TOKEN_BUDGET = int(os.getenv("MEMORY_TOKEN_BUDGET", "0"))  # 0 = per-model default (see core/tokens.py)
+MEMORY_MAX_MESSAGES = int(os.getenv("MEMORY_MAX_MESSAGES", "40"))
+MEMORY_MAX_MESSAGE_TOKENS = int(os.getenv("MEMORY_MAX_MESSAGE_TOKENS", "400"))
+MEMORY_SUMMARIZER = os.getenv("MEMORY_SUMMARIZER", "extractive")  # "extractive", "llm" or "off"
+
+# Cache coherence across uvicorn workers ("none" for a single worker, "udp" for several on one host)
+MEMORY_INVALIDATION_CHANNEL = os.getenv("MEMORY_INVALIDATION_CHANNEL", "none")
+MEMORY_INVALIDATION_PORTS = os.getenv("MEMORY_INVALIDATION_PORTS", "47100-47115")
+MEMORY_REVALIDATE_SECONDS = float(os.getenv("MEMORY_REVALIDATE_SECONDS", "5"))
+
+# Warm start: hot conversations are written here on shutdown and lazily restored on startup ("" = disabled)
+MEMORY_SNAPSHOT_PATH = os.getenv("MEMORY_SNAPSHOT_PATH", "")
+MEMORY_SNAPSHOT_MAX_AGE_MINUTES = float(os.getenv("MEMORY_SNAPSHOT_MAX_AGE_MINUTES", "60"))
+
+# Cap on ChatState.messages: the history window plus headroom for tool calls within a turn
+CHAT_STATE_MAX_MESSAGES = int(os.getenv("CHAT_STATE_MAX_MESSAGES", str(MEMORY_MAX_MESSAGES + 20)))
+
+# LangGraph checkpoints: latest one per thread, bounded and idle-expired ("" path = memory only)
+CHECKPOINT_MAX_THREADS = int(os.getenv("CHECKPOINT_MAX_THREADS", "2000"))
+CHECKPOINT_MAX_BYTES = int(os.getenv("CHECKPOINT_MAX_BYTES", str(32 * 1024 * 1024)))
+CHECKPOINT_TTL_MINUTES = float(os.getenv("CHECKPOINT_TTL_MINUTES", "30"))
+CHECKPOINT_SQLITE_PATH = os.getenv("CHECKPOINT_SQLITE_PATH", "")
+
+# State hydration: conversation, customer and active order load concurrently, each within its own deadline (0 = no limit)
+STATE_LOAD_CONVERSATION_TIMEOUT = float(os.getenv("STATE_LOAD_CONVERSATION_TIMEOUT", "3"))
+STATE_LOAD_CUSTOMER_TIMEOUT = float(os.getenv("STATE_LOAD_CUSTOMER_TIMEOUT", "2"))
+STATE_LOAD_ORDER_TIMEOUT = float(os.getenv("STATE_LOAD_ORDER_TIMEOUT", "2"))
+
+# Menu fast path: price/ingredient questions about one item are answered from the cached menu, without the LLM
+MENU_FAST_PATH_ENABLED = os.getenv("MENU_FAST_PATH_ENABLED", "true").lower() in ("1", "true", "yes")
+MENU_FAST_PATH_MAX_CHARS = int(os.getenv("MENU_FAST_PATH_MAX_CHARS", "120"))  # Longer messages always go to the LLM
+MENU_CATALOG_TTL_SECONDS = float(os.getenv("MENU_CATALOG_TTL_SECONDS", "300"))
+
+# Generated replies reused for identical non-personal turns (greetings, menu questions); dropped when the menu changes
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+RESPONSE_CACHE_TTL_SECONDS = float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "600"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "2000"))
+RESPONSE_CACHE_MAX_CHARS = int(os.getenv("RESPONSE_CACHE_MAX_CHARS", "160"))  # Longer messages are never cached
+
+# Tool calls of one model message: read-only ones run concurrently on this many threads, writes one at a time
+TOOL_EXECUTOR_MAX_WORKERS = int(os.getenv("TOOL_EXECUTOR_MAX_WORKERS", "8"))
+
+# Turns of one conversation run one at a time; max seconds a turn waits for the previous one (0 = no limit)
+MEMORY_TURN_LOCK_TIMEOUT = float(os.getenv("MEMORY_TURN_LOCK_TIMEOUT", "120"))
+
+# Retention: expired conversations are deleted in small, spaced batches
+MEMORY_RETENTION_DAYS = float(os.getenv("MEMORY_RETENTION_DAYS", "7"))
+MEMORY_RETENTION_BATCH_SIZE = int(os.getenv("MEMORY_RETENTION_BATCH_SIZE", "500"))
+MEMORY_RETENTION_PAUSE_SECONDS = float(os.getenv("MEMORY_RETENTION_PAUSE_SECONDS", "0.5"))
+MEMORY_RETENTION_MAX_BATCHES = int(os.getenv("MEMORY_RETENTION_MAX_BATCHES", "0"))  # Per run; 0 = no cap
+MEMORY_RETENTION_INTERVAL_MINUTES = float(os.getenv("MEMORY_RETENTION_INTERVAL_MINUTES", "60"))  # 0 = disabled
+
 logging.info(f"GOOGLE_API_KEY loaded: {bool(GOOGLE_API_KEY)}")
 logging.info(f"Using LLM_MODEL: {GOOGLE_MODEL}")
 
-supabase: Client = create_client(
-    supabase_url=SUPABASE_URL,
-    supabase_key=SUPABASE_KEY
-)
+# Database access
+SUPABASE_BACKEND = os.getenv("SUPABASE_BACKEND", "supabase")  # "fake" runs against local in-memory tables
+SUPABASE_MAX_CONCURRENCY = int(os.getenv("SUPABASE_MAX_CONCURRENCY", "16"))
+
+if SUPABASE_BACKEND == "fake":
+    from .core.fake_db import FakeSupabaseClient
+    supabase = FakeSupabaseClient()
+else:
+    supabase: Client = create_client(
+        supabase_url=SUPABASE_URL,
+        supabase_key=SUPABASE_KEY
+    )
 
 
 # =============================================================================
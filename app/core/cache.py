@@ -0,0 +1,191 @@
+"""
+Bounded in-process caches for the pizzeria chatbot.
+LRU eviction with entry/byte caps, TTL expiry and hit/miss counters.
+"""
+
+import logging
+import time
+import weakref
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Generic, Hashable, Iterator, List, Optional, Tuple, TypeVar
+
+logger = logging.getLogger(__name__)
+
+V = TypeVar("V")
+
+# Every named cache registers here so a single call can report on all of them
+_registry: "weakref.WeakValueDictionary[str, LRUCache]" = weakref.WeakValueDictionary()
+
+
+class LRUCache(Generic[V]):
+    """
+    Least-recently-used cache bounded by entry count and approximate bytes.
+
+    Entries also expire after `ttl_seconds` without being touched. Because the
+    underlying OrderedDict is kept in access order, expired entries always sit
+    at the front, so expiry is swept proactively on every operation in O(expired).
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_entries: int = 10_000,
+        max_bytes: int = 64 * 1024 * 1024,
+        ttl_seconds: float = 30 * 60,
+        sizeof: Optional[Callable[[V], int]] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._sizeof = sizeof or (lambda value: 0)
+        self._clock = clock
+
+        # key -> (value, size, touched_at)
+        self._data: "OrderedDict[Hashable, Tuple[V, int, float]]" = OrderedDict()
+        self._bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        _registry[name] = self
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        """Membership check that neither counts as a hit nor refreshes recency."""
+        entry = self._data.get(key)
+        return entry is not None and not self._is_expired(entry[2], self._clock())
+
+    def __iter__(self) -> Iterator[Hashable]:
+        return iter(list(self._data.keys()))
+
+    def items(self) -> List[Tuple[Hashable, V]]:
+        """Live (key, value) pairs, least recently used first. Does not touch recency."""
+        now = self._clock()
+        return [(key, value) for key, (value, _, touched_at) in list(self._data.items())
+                if not self._is_expired(touched_at, now)]
+
+    def get(self, key: Hashable, default: Optional[V] = None) -> Optional[V]:
+        """Return the cached value and mark it as most recently used."""
+        now = self._clock()
+        self._expire(now)
+
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        value, size, _ = entry
+        self._data[key] = (value, size, now)
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def peek(self, key: Hashable, default: Optional[V] = None) -> Optional[V]:
+        """Return the cached value without touching recency or counters."""
+        entry = self._data.get(key)
+        if entry is None or self._is_expired(entry[2], self._clock()):
+            return default
+        return entry[0]
+
+    def put(self, key: Hashable, value: V):
+        """Insert or replace an entry, evicting least-recently-used ones if over budget."""
+        now = self._clock()
+        self._expire(now)
+
+        size = self._safe_sizeof(value)
+        if key in self._data:
+            self._bytes -= self._data.pop(key)[1]
+
+        self._data[key] = (value, size, now)
+        self._bytes += size
+        self._evict_over_budget(keep=key)
+
+    def pop(self, key: Hashable, default: Optional[V] = None) -> Optional[V]:
+        """Remove an entry and return its value."""
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return default
+        self._bytes -= entry[1]
+        return entry[0]
+
+    def resize(self, key: Hashable):
+        """Recompute the byte size of an entry after it was mutated in place."""
+        entry = self._data.get(key)
+        if entry is None:
+            return
+        value, old_size, touched_at = entry
+        new_size = self._safe_sizeof(value)
+        self._data[key] = (value, new_size, touched_at)
+        self._bytes += new_size - old_size
+        self._evict_over_budget(keep=key)
+
+    def clear(self):
+        """Drop every entry. Counters are kept so stats stay cumulative."""
+        self._data.clear()
+        self._bytes = 0
+
+    def purge_expired(self) -> int:
+        """Drop every expired entry now and return how many were removed."""
+        before = self.expirations
+        self._expire(self._clock())
+        return self.expirations - before
+
+    def stats(self) -> Dict[str, Any]:
+        """Counters and sizes for monitoring endpoints."""
+        lookups = self.hits + self.misses
+        return {
+            "name": self.name,
+            "entries": len(self._data),
+            "bytes": self._bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+    def _is_expired(self, touched_at: float, now: float) -> bool:
+        return self.ttl_seconds is not None and now - touched_at >= self.ttl_seconds
+
+    def _expire(self, now: float):
+        while self._data:
+            key, (_, size, touched_at) = next(iter(self._data.items()))
+            if not self._is_expired(touched_at, now):
+                break
+            self._data.popitem(last=False)
+            self._bytes -= size
+            self.expirations += 1
+
+    def _evict_over_budget(self, keep: Hashable):
+        # A single oversized entry is still kept; the caller is about to use it
+        while len(self._data) > 1 and (len(self._data) > self.max_entries or self._bytes > self.max_bytes):
+            key = next(iter(self._data))
+            if key == keep:
+                self._data.move_to_end(key)
+                continue
+            _, size, _ = self._data.pop(key)
+            self._bytes -= size
+            self.evictions += 1
+
+    def _safe_sizeof(self, value: V) -> int:
+        try:
+            return int(self._sizeof(value))
+        except Exception as e:
+            logger.warning(f"Could not size entry for cache {self.name}: {e}")
+            return 0
+
+
+def get_cache_stats() -> Dict[str, Dict[str, Any]]:
+    """
+    Process-wide stats for every live named cache.
+    """
+    return {name: cache.stats() for name, cache in list(_registry.items())}
@@ -0,0 +1,311 @@
+"""
+Cached menu catalog and the LLM-free fast path for simple menu questions.
+
+"Cuánto cuesta la hawaiana" used to cost two model round trips (the model calls
+search_menu, then final_response phrases the result) for a fact the product
+tables already hold. The graph's router asks `menu_fast_path.answer()` first:
+when the message is plainly a price or ingredients question about exactly one
+menu item, the reply is filled from a template in Juan's voice. Anything else
+(orders, several items, follow-ups without an item name, long messages) returns
+None and takes the LLM path as before.
+
+The catalog is built from the active rows of the product tables described in
+DATABASE_SCHEMA.md (pizzas_armadas, combos, bebidas, adiciones, bordes) and
+reloaded at most every MENU_CATALOG_TTL_SECONDS. Those tables hold one row per
+size, so rows sharing a name become one item with a price per size. `version`
+changes whenever a reload finds different items, so anything derived from menu
+data can tell when it went stale.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import re
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from .db import db
+from .intents import match_groups, normalize
+from ..config import MENU_CATALOG_TTL_SECONDS, MENU_FAST_PATH_ENABLED, MENU_FAST_PATH_MAX_CHARS
+
+logger = logging.getLogger(__name__)
+
+# Generic words an item name may start with; "Pizza Hawaiana" is also "hawaiana"
+_NAME_PREFIXES = ("pizza ", "pizzas ")
+
+# (table, kind, name column, price column, ingredients column, size column)
+_SOURCES = (
+    ("pizzas_armadas", "pizza", "nombre", "precio", "texto_ingredientes", "tamano"),
+    ("combos", "combo", "nombre", "precio", "incluye", None),
+    ("bebidas", "bebida", "nombre_producto", "precio", None, "tamano"),
+    ("adiciones", "adicion", "nombre", "precio_adicional", None, "tamano_pizza"),
+    ("bordes", "borde", "nombre", "precio_adicional", None, None),
+)
+
+
+# =============================================================================
+# MENU CATALOG
+# =============================================================================
+
+def build_items(tables: Dict[str, List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """
+    Product rows by table name -> catalog items:
+    {"kind", "name", "prices": [{"size", "price"}, ...], "ingredients"}.
+    Rows of one table with the same name (one per size) are merged into one item.
+    """
+    items: Dict[Tuple[str, str], Dict[str, Any]] = {}
+    for table, kind, name_column, price_column, ingredients_column, size_column in _SOURCES:
+        for row in tables.get(table, []):
+            name = str(row.get(name_column) or "").strip()
+            if not name:
+                continue
+            item = items.setdefault((kind, normalize(name)), {
+                "kind": kind, "name": name, "prices": [], "ingredients": None,
+            })
+            price = {"size": str(row.get(size_column) or "").strip() if size_column else "",
+                     "price": row.get(price_column)}
+            if price not in item["prices"]:
+                item["prices"].append(price)
+            if item["ingredients"] is None and ingredients_column:
+                item["ingredients"] = row.get(ingredients_column) or None
+    for item in items.values():
+        # Cheapest size first, unparseable prices last
+        item["prices"].sort(key=lambda entry: _amount(entry["price"]))
+    return list(items.values())
+
+
+class MenuCatalog:
+    """Active menu items, indexed by accent-folded name and refreshed after a TTL."""
+
+    def __init__(self, ttl_seconds: float = 300, clock: Callable[[], float] = time.monotonic):
+        self.ttl_seconds = ttl_seconds
+        self._clock = clock
+        self._items: List[Dict[str, Any]] = []
+        self._aliases: Dict[str, List[int]] = {}  # Normalized name -> indexes into _items
+        self._pattern: Optional[re.Pattern] = None
+        self._digest: Optional[str] = None
+        self._loaded_at: Optional[float] = None
+        self._lock = asyncio.Lock()
+
+        self.version = 0  # Bumped whenever the menu items change
+        self.loads = 0
+        self.load_errors = 0
+
+    def is_fresh(self) -> bool:
+        return self._loaded_at is not None and self._clock() - self._loaded_at < self.ttl_seconds
+
+    async def ensure_loaded(self) -> bool:
+        """Reload the menu when the TTL ran out. False when no menu was ever loaded."""
+        if not self.is_fresh():
+            async with self._lock:
+                if not self.is_fresh():  # Concurrent turns share one reload
+                    await self.refresh()
+        return self._loaded_at is not None
+
+    async def refresh(self):
+        try:
+            results = await asyncio.gather(*(
+                db.execute(db.table(table).select("*").eq("activo", True)) for table, *_ in _SOURCES
+            ))
+        except Exception as e:
+            self.load_errors += 1
+            logger.warning(f"Could not load the menu catalog: {e}")
+            if self._loaded_at is not None:
+                self._loaded_at = self._clock()  # Keep serving the last menu, retry after another TTL
+            return
+        self.install(build_items({table: result.data or [] for (table, *_), result in zip(_SOURCES, results)}))
+
+    def install(self, items: List[Dict[str, Any]]):
+        """Replace the catalog with `items` (see build_items), bumping `version` if they differ."""
+        digest = hashlib.sha1(json.dumps(items, sort_keys=True, default=str).encode()).hexdigest()
+        if digest != self._digest:
+            self._digest = digest
+            self.version += 1
+            self._index(items)
+            logger.info(f"Menu catalog v{self.version}: {len(items)} items")
+        self._loaded_at = self._clock()
+        self.loads += 1
+
+    def invalidate(self):
+        """Reload on next use (e.g. after editing the menu)."""
+        if self._loaded_at is not None:
+            self._loaded_at = float("-inf")
+
+    def _index(self, items: List[Dict[str, Any]]):
+        aliases: Dict[str, List[int]] = {}
+        for position, item in enumerate(items):
+            name = normalize(item["name"]).strip()
+            names = {name}
+            for prefix in _NAME_PREFIXES:
+                if name.startswith(prefix) and len(name) > len(prefix):
+                    names.add(name[len(prefix):])
+            for alias in names:
+                aliases.setdefault(alias, []).append(position)
+        self._items = items
+        self._aliases = aliases
+        # Longest names first, so "hawaiana especial" wins over "hawaiana"
+        ordered = sorted(aliases, key=len, reverse=True)
+        self._pattern = re.compile(r"\b(?:" + "|".join(map(re.escape, ordered)) + r")\b") if ordered else None
+
+    def find(self, text: str) -> List[Dict[str, Any]]:
+        """Distinct menu items named in `text` (already normalized)."""
+        if self._pattern is None:
+            return []
+        found: Dict[int, None] = {}
+        for match in self._pattern.finditer(text):
+            for position in self._aliases[match.group()]:
+                found[position] = None
+        return [self._items[position] for position in found]
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "items": len(self._items),
+            "version": self.version,
+            "loads": self.loads,
+            "load_errors": self.load_errors,
+            "fresh": self.is_fresh(),
+        }
+
+
+# =============================================================================
+# FAST PATH
+# =============================================================================
+
+def _amount(value: Any) -> float:
+    if isinstance(value, bool):
+        return float("inf")
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float("inf")
+
+
+def format_price(value: Any) -> Optional[str]:
+    """25000 -> "$25.000" (Colombian pesos). None when the value is not a number."""
+    amount = _amount(value)
+    if amount == float("inf"):
+        return None
+    return f"${amount:,.0f}".replace(",", ".")
+
+
+def _prices(item: Dict[str, Any]) -> Optional[str]:
+    """"$42.000", or "$38.000 (Mediana) y $52.000 (Grande)" for an item sold in several sizes."""
+    entries = item["prices"]
+    amounts = [format_price(entry["price"]) for entry in entries]
+    if not amounts or None in amounts:
+        return None
+    if len(entries) == 1:
+        return amounts[0]
+    sizes = [entry["size"] for entry in entries]
+    if "" in sizes or len(set(sizes)) < len(sizes):
+        return None  # Several prices that the rows do not tell apart
+    parts = [f"{amount} ({size})" for amount, size in zip(amounts, sizes)]
+    return f"{', '.join(parts[:-1])} y {parts[-1]}"
+
+
+def _ingredients(item: Dict[str, Any]) -> Optional[str]:
+    # Only a real ingredients column; a marketing description reads wrong after "lleva"
+    value = item["ingredients"]
+    if isinstance(value, (list, tuple)):
+        parts = [str(part).strip() for part in value if str(part).strip()]
+        if not parts:
+            return None
+        return parts[0] if len(parts) == 1 else f"{', '.join(parts[:-1])} y {parts[-1]}"
+    if isinstance(value, str) and value.strip():
+        value = value.strip().rstrip(".")
+        return value[0].lower() + value[1:]  # texto_ingredientes starts a sentence; here it follows "lleva"
+    return None
+
+
+class MenuFastPath:
+    """
+    Deterministic answers for "price of X" / "what does X have". Every message it
+    is asked about counts as a hit or as a miss with the reason it fell back.
+    """
+
+    def __init__(self, catalog: MenuCatalog, enabled: bool = True, max_chars: int = 120):
+        self.catalog = catalog
+        self.enabled = enabled
+        self.max_chars = max_chars
+        self.hits = 0
+        self.misses = 0
+        self.fallbacks: Dict[str, int] = {}
+
+    async def answer(self, text: str, customer: Optional[Dict[str, Any]] = None, greet: bool = False) -> Optional[str]:
+        """Templated reply for `text`, or None when the LLM should handle it."""
+        if not self.enabled:
+            return None
+        reason, reply = await self._answer(text, customer or {}, greet)
+        if reply is None:
+            self.misses += 1
+            self.fallbacks[reason] = self.fallbacks.get(reason, 0) + 1
+            logger.debug(f"Menu fast path fell back ({reason})")
+        else:
+            self.hits += 1
+        return reply
+
+    async def _answer(self, text: str, customer: Dict[str, Any], greet: bool) -> Tuple[str, Optional[str]]:
+        # Cheap checks first: most messages never need the catalog
+        if len(text) > self.max_chars:
+            return "too_long", None
+        groups = match_groups(text)
+        wants_price = "ask_price" in groups
+        wants_ingredients = "ask_ingredients" in groups
+        if not (wants_price or wants_ingredients):
+            return "not_a_lookup", None
+        if "order" in groups:
+            return "order", None
+
+        if not await self.catalog.ensure_loaded():
+            return "catalog_unavailable", None
+        items = self.catalog.find(normalize(text))
+        if not items:
+            return "no_item", None
+        if len(items) > 1:
+            return "several_items", None
+
+        item = items[0]
+        price = _prices(item) if wants_price else None
+        ingredients = _ingredients(item) if wants_ingredients else None
+        if (wants_price and price is None) or (wants_ingredients and ingredients is None):
+            return "missing_data", None
+        return "hit", self._compose(item, price, ingredients, customer, greet)
+
+    @staticmethod
+    def _compose(item: Dict[str, Any], price: Optional[str], ingredients: Optional[str],
+                 customer: Dict[str, Any], greet: bool) -> str:
+        # Juan's voice: no opening ¿¡, "Claro que sí" / "Con mucho gusto"
+        name = item["name"]
+        name = f"la {name}" if item["kind"] == "pizza" else name  # "la Hawaiana", but "Limonada"
+        if price and ingredients:
+            reply = f"Claro que sí, {name} lleva {ingredients} y está en {price}."
+        elif price:
+            reply = f"Claro que sí, {name} está en {price}."
+        else:
+            reply = f"Con mucho gusto, {name} lleva {ingredients}."
+        reply += " Si quieres hacer el pedido, me dices."
+        if greet:
+            first_name = (customer.get("first_name") or "").strip()
+            hello = f"Hola {first_name}" if first_name else "Hola, bienvenido a One Pizzeria"
+            reply = f"{hello}. {reply}"
+        return reply
+
+    def stats(self) -> Dict[str, Any]:
+        asked = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / asked, 4) if asked else 0.0,
+            "fallbacks": dict(self.fallbacks),
+            "catalog": self.catalog.stats(),
+        }
+
+
+# Global instances
+menu_catalog = MenuCatalog(ttl_seconds=MENU_CATALOG_TTL_SECONDS)
+menu_fast_path = MenuFastPath(menu_catalog, enabled=MENU_FAST_PATH_ENABLED, max_chars=MENU_FAST_PATH_MAX_CHARS)
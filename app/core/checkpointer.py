@@ -1,117 +1,373 @@
 """
  Checkpointer for LangGraph using the hybrid memory approach.
-Much more efficient than the original checkpointer.
+Keeps only what the graph needs for the turn in progress; conversation history
+lives in MemoryManager.
 """
 
+import asyncio
 import logging
-from typing import Any, Optional, Sequence, Dict, Iterator, Tuple
+import sqlite3
+import threading
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional, Sequence, Dict, Iterator, Tuple
 from langchain_core.runnables import RunnableConfig
-from langgraph.checkpoint.base import BaseCheckpointSaver, Checkpoint, CheckpointMetadata
+from langgraph.checkpoint.base import (
+    WRITES_IDX_MAP,
+    BaseCheckpointSaver,
+    ChannelVersions,
+    Checkpoint,
+    CheckpointMetadata,
+    CheckpointTuple,
+    get_checkpoint_id,
+    get_checkpoint_metadata,
+)
 
+from ..config import (
+    CHECKPOINT_MAX_THREADS, CHECKPOINT_MAX_BYTES, CHECKPOINT_TTL_MINUTES, CHECKPOINT_SQLITE_PATH,
+    STATE_LOAD_CONVERSATION_TIMEOUT, STATE_LOAD_CUSTOMER_TIMEOUT, STATE_LOAD_ORDER_TIMEOUT,
+)
+from .cache import LRUCache
+from .intents import determine_step
 from .memory import memory, ConversationContext
 from .state import ChatState
 
 logger = logging.getLogger(__name__)
 
 
+class _ThreadCheckpoint:
+    """The latest checkpoint of one (thread, namespace): serialized pieces only."""
+    
+    __slots__ = ("checkpoint_id", "checkpoint", "metadata", "parent_id", "blobs", "writes")
+    
+    def __init__(self, checkpoint_id: str, checkpoint: Tuple[str, bytes], metadata: Tuple[str, bytes],
+                 parent_id: Optional[str], blobs: Dict[str, Tuple[Any, Tuple[str, bytes]]],
+                 writes: Dict[Tuple[str, int], Tuple[str, str, Tuple[str, bytes], str]]):
+        self.checkpoint_id = checkpoint_id
+        self.checkpoint = checkpoint  # Typed blob of the checkpoint without channel_values
+        self.metadata = metadata
+        self.parent_id = parent_id
+        self.blobs = blobs  # channel -> (version, typed blob) for the current version only
+        self.writes = writes  # (task_id, idx) -> (task_id, channel, typed blob, task_path)
+    
+    def size(self) -> int:
+        size = 200 + len(self.checkpoint[1]) + len(self.metadata[1])
+        size += sum(len(blob[1]) for _, blob in self.blobs.values())
+        size += sum(len(write[2][1]) for write in self.writes.values())
+        return size
+    
+    def to_row(self) -> Dict[str, Any]:
+        return {
+            "checkpoint_id": self.checkpoint_id,
+            "checkpoint": list(self.checkpoint),
+            "metadata": list(self.metadata),
+            "parent_id": self.parent_id,
+            "blobs": {channel: [version, list(blob)] for channel, (version, blob) in self.blobs.items()},
+            "writes": [[task_id, idx, channel, list(blob), task_path]
+                       for (task_id, idx), (_, channel, blob, task_path) in self.writes.items()],
+        }
+    
+    @classmethod
+    def from_row(cls, row: Dict[str, Any]) -> "_ThreadCheckpoint":
+        return cls(
+            row["checkpoint_id"],
+            tuple(row["checkpoint"]),
+            tuple(row["metadata"]),
+            row["parent_id"],
+            {channel: (version, tuple(blob)) for channel, (version, blob) in row["blobs"].items()},
+            {(task_id, idx): (task_id, channel, tuple(blob), task_path)
+             for task_id, idx, channel, blob, task_path in row["writes"]},
+        )
+
+
 class Checkpointer(BaseCheckpointSaver):
     """
-    Optimized checkpointer using MemoryManager.
+    Bounded LangGraph checkpointer.
+    
+    Conversation history lives in MemoryManager, so the graph only needs its
+    checkpoint for the turn in progress. Unlike MemorySaver, which keeps every
+    checkpoint of every thread forever, this saver:
+    1. Keeps only the latest checkpoint per thread (and its pending writes)
+    2. Stores only the current version of each channel
+    3. Holds threads in an LRU cache bounded by count and bytes, with idle expiry
+    4. Optionally writes through to a local SQLite file so a restart can resume
     
-    This checkpointer is much more efficient than the original because:
-    1. Only stores essential conversation data
-    2. Uses intelligent sliding window for messages
-    3. Has built-in caching for active conversations
-    4. Auto-cleanup of old conversations
+    Time travel to older checkpoints is therefore not supported.
     """
     
-    def __init__(self):
+    def __init__(self, name: str = "checkpoints", max_threads: int = CHECKPOINT_MAX_THREADS,
+                 max_bytes: int = CHECKPOINT_MAX_BYTES, ttl_seconds: float = CHECKPOINT_TTL_MINUTES * 60,
+                 sqlite_path: str = CHECKPOINT_SQLITE_PATH):
         super().__init__()
-        self.memory_manager = memory
-        logger.info("Checkpointer initialized")
+        self.name = name
+        self.ttl_seconds = ttl_seconds
+        # thread_id -> {checkpoint_ns: _ThreadCheckpoint}
+        self._threads: LRUCache[Dict[str, _ThreadCheckpoint]] = LRUCache(
+            name,
+            max_entries=max_threads,
+            max_bytes=max_bytes,
+            ttl_seconds=ttl_seconds,
+            sizeof=lambda namespaces: sum(record.size() for record in namespaces.values()),
+        )
+        self._lock = threading.RLock()  # LangGraph may call the sync API from worker threads
+        self.puts = 0
+        self.writes_saved = 0
+        
+        self._conn: Optional[sqlite3.Connection] = None
+        if sqlite_path:
+            self._conn = sqlite3.connect(sqlite_path, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS {name} (
+                    thread_id TEXT NOT NULL,
+                    checkpoint_ns TEXT NOT NULL,
+                    type TEXT NOT NULL,
+                    data BLOB NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (thread_id, checkpoint_ns)
+                )
+            """)
+            self._conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{name}_updated_at ON {name}(updated_at)")
+        logger.info(f"Checkpointer '{name}' initialized (max {max_threads} threads, "
+                    f"persistent: {bool(sqlite_path)})")
     
-    def get(self, config: RunnableConfig) -> Optional[Checkpoint]:
-        """
-        Load checkpoint from  memory.
-        """
-        try:
-            thread_id = config.get("configurable", {}).get("thread_id")
-            if not thread_id:
-                logger.warning("No thread_id provided in config")
-                return None
-            
-            # Note: We can't use async here due to LangGraph interface
-            # In practice, we'll handle this in the graph nodes directly
-            logger.info(f"Checkpoint requested for thread_id: {thread_id}")
-            return None  # We'll handle state loading in graph nodes
-            
-        except Exception as e:
-            logger.error(f"Error getting checkpoint: {e}")
+    # ---- storage ---------------------------------------------------------
+    
+    def _record(self, thread_id: str, checkpoint_ns: str) -> Optional[_ThreadCheckpoint]:
+        with self._lock:
+            namespaces = self._threads.get(thread_id)
+            if namespaces is not None and checkpoint_ns in namespaces:
+                return namespaces[checkpoint_ns]
+        record = self._load_persisted(thread_id, checkpoint_ns)
+        if record is not None:
+            self._store(thread_id, checkpoint_ns, record, persist=False)
+        return record
+    
+    def _store(self, thread_id: str, checkpoint_ns: str, record: _ThreadCheckpoint, persist: bool = True):
+        with self._lock:
+            namespaces = self._threads.peek(thread_id)
+            if namespaces is None:
+                namespaces = {}
+            namespaces[checkpoint_ns] = record
+            self._threads.put(thread_id, namespaces)
+        if persist:
+            self._persist(thread_id, checkpoint_ns, record)
+    
+    def _load_persisted(self, thread_id: str, checkpoint_ns: str) -> Optional[_ThreadCheckpoint]:
+        if self._conn is None:
+            return None
+        with self._lock:
+            found = self._conn.execute(
+                f"SELECT type, data, updated_at FROM {self.name} WHERE thread_id = ? AND checkpoint_ns = ?",
+                (thread_id, checkpoint_ns)
+            ).fetchone()
+        if found is None:
+            return None
+        type_, data, updated_at = found
+        if self.ttl_seconds and time.time() - updated_at > self.ttl_seconds:
+            self._delete_persisted(thread_id)
             return None
+        return _ThreadCheckpoint.from_row(self.serde.loads_typed((type_, data)))
     
-    async def aget(self, config: RunnableConfig) -> Optional[Checkpoint]:
-        """
-        Async version of get checkpoint.
-        """
-        return self.get(config)
+    def _persist(self, thread_id: str, checkpoint_ns: str, record: _ThreadCheckpoint):
+        if self._conn is None:
+            return
+        type_, data = self.serde.dumps_typed(record.to_row())
+        with self._lock:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO {self.name} (thread_id, checkpoint_ns, type, data, updated_at) "
+                f"VALUES (?, ?, ?, ?, ?)",
+                (thread_id, checkpoint_ns, type_, data, time.time())
+            )
     
-    def get_tuple(self, config: RunnableConfig) -> Optional[Tuple[Checkpoint, CheckpointMetadata]]:
-        """
-        Get checkpoint with metadata.
-        """
-        checkpoint = self.get(config)
-        if checkpoint:
-            thread_id = config.get("configurable", {}).get("thread_id", "unknown")
-            metadata = self._create_metadata(thread_id)
-            return (checkpoint, metadata)
-        return None
-    
-    async def aget_tuple(self, config: RunnableConfig) -> Optional[Tuple[Checkpoint, CheckpointMetadata]]:
-        """
-        Async version of get_tuple.
-        """
-        return self.get_tuple(config)
+    def _delete_persisted(self, thread_id: str):
+        if self._conn is None:
+            return
+        with self._lock:
+            self._conn.execute(f"DELETE FROM {self.name} WHERE thread_id = ?", (thread_id,))
     
-    def put(self, config: RunnableConfig, checkpoint: Checkpoint) -> CheckpointMetadata:
-        """
-        Save checkpoint to  memory.
-        """
-        try:
-            thread_id = config.get("configurable", {}).get("thread_id")
-            if not thread_id:
-                logger.warning("No thread_id provided in config")
-                return self._create_metadata(thread_id or "unknown")
-            
-            logger.info(f"Checkpoint saved for thread_id: {thread_id}")
-            
-            # We'll handle the actual saving in the graph nodes
-            # This is just for LangGraph compliance
-            return self._create_metadata(thread_id)
-            
-        except Exception as e:
-            logger.error(f"Error saving checkpoint: {e}")
-            return self._create_metadata(thread_id or "unknown")
+    def prune(self, limit: int = 1000) -> int:
+        """Delete up to `limit` persisted threads idle for longer than the TTL."""
+        if self._conn is None or not self.ttl_seconds:
+            return 0
+        cutoff = time.time() - self.ttl_seconds
+        with self._lock:
+            return self._conn.execute(
+                f"DELETE FROM {self.name} WHERE rowid IN "
+                f"(SELECT rowid FROM {self.name} WHERE updated_at < ? ORDER BY updated_at LIMIT ?)",
+                (cutoff, limit)
+            ).rowcount
     
-    async def aput(self, config: RunnableConfig, checkpoint: Checkpoint) -> CheckpointMetadata:
-        """
-        Async version of put checkpoint.
-        """
-        return self.put(config, checkpoint)
+    # ---- BaseCheckpointSaver ---------------------------------------------
     
-    def list(self, config: RunnableConfig, **kwargs) -> Iterator[CheckpointMetadata]:
-        """
-        List checkpoints (for LangGraph compatibility).
-        """
-        thread_id = config.get("configurable", {}).get("thread_id")
-        if thread_id:
-            yield self._create_metadata(thread_id)
-    
-    def _create_metadata(self, thread_id: str) -> CheckpointMetadata:
-        """Create checkpoint metadata."""
-        return CheckpointMetadata(
-            source_id=thread_id,
-            source_type="user"
+    def get_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        """Latest checkpoint of the thread, or the one requested if it is still the latest."""
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        record = self._record(thread_id, checkpoint_ns)
+        if record is None:
+            return None
+        checkpoint_id = get_checkpoint_id(config)
+        if checkpoint_id and checkpoint_id != record.checkpoint_id:
+            return None  # Older checkpoints are not kept
+        return self._to_tuple(thread_id, checkpoint_ns, record)
+    
+    def _to_tuple(self, thread_id: str, checkpoint_ns: str, record: _ThreadCheckpoint) -> CheckpointTuple:
+        checkpoint = self.serde.loads_typed(record.checkpoint)
+        checkpoint["channel_values"] = {
+            channel: self.serde.loads_typed(blob)
+            for channel, (_, blob) in record.blobs.items() if blob[0] != "empty"
+        }
+        return CheckpointTuple(
+            config={"configurable": {
+                "thread_id": thread_id,
+                "checkpoint_ns": checkpoint_ns,
+                "checkpoint_id": record.checkpoint_id,
+            }},
+            checkpoint=checkpoint,
+            metadata=self.serde.loads_typed(record.metadata),
+            parent_config=(
+                {"configurable": {
+                    "thread_id": thread_id,
+                    "checkpoint_ns": checkpoint_ns,
+                    "checkpoint_id": record.parent_id,
+                }}
+                if record.parent_id else None
+            ),
+            pending_writes=[
+                (task_id, channel, self.serde.loads_typed(blob))
+                for task_id, channel, blob, _ in record.writes.values()
+            ],
         )
+    
+    def list(self, config: Optional[RunnableConfig], *, filter: Optional[Dict[str, Any]] = None,
+             before: Optional[RunnableConfig] = None, limit: Optional[int] = None) -> Iterator[CheckpointTuple]:
+        """List the latest checkpoint of the matching (cached) threads."""
+        if config:
+            thread_ids = [config["configurable"]["thread_id"]]
+            wanted_ns = config["configurable"].get("checkpoint_ns")
+            wanted_id = get_checkpoint_id(config)
+        else:
+            thread_ids = list(self._threads)
+            wanted_ns = wanted_id = None
+        before_id = get_checkpoint_id(before) if before else None
+        
+        for thread_id in thread_ids:
+            if wanted_ns is not None:
+                record = self._record(thread_id, wanted_ns)
+                records = {wanted_ns: record} if record is not None else {}
+            else:
+                with self._lock:
+                    records = dict(self._threads.peek(thread_id) or {})
+            for checkpoint_ns, record in records.items():
+                if wanted_id and record.checkpoint_id != wanted_id:
+                    continue
+                if before_id and record.checkpoint_id >= before_id:
+                    continue
+                if filter:
+                    metadata = self.serde.loads_typed(record.metadata)
+                    if not all(metadata.get(key) == value for key, value in filter.items()):
+                        continue
+                if limit is not None:
+                    if limit <= 0:
+                        return
+                    limit -= 1
+                yield self._to_tuple(thread_id, checkpoint_ns, record)
+    
+    def put(self, config: RunnableConfig, checkpoint: Checkpoint, metadata: CheckpointMetadata,
+            new_versions: ChannelVersions) -> RunnableConfig:
+        """Replace the thread's checkpoint; only channels with a new version are serialized."""
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        previous = self._record(thread_id, checkpoint_ns)
+        
+        stored = checkpoint.copy()
+        values = stored.pop("channel_values")
+        blobs = dict(previous.blobs) if previous is not None else {}
+        for channel, version in new_versions.items():
+            blobs[channel] = (version, self.serde.dumps_typed(values[channel]) if channel in values else ("empty", b""))
+        # Drop channels the new checkpoint no longer tracks
+        current = checkpoint["channel_versions"]
+        blobs = {channel: entry for channel, entry in blobs.items() if channel in current}
+        
+        record = _ThreadCheckpoint(
+            checkpoint["id"],
+            self.serde.dumps_typed(stored),
+            self.serde.dumps_typed(get_checkpoint_metadata(config, metadata)),
+            config["configurable"].get("checkpoint_id"),
+            blobs,
+            {},  # Writes of the previous checkpoint are already applied
+        )
+        self._store(thread_id, checkpoint_ns, record)
+        self.puts += 1
+        if self._conn is not None and self.puts % 1000 == 0:
+            self.prune()
+        return {"configurable": {
+            "thread_id": thread_id,
+            "checkpoint_ns": checkpoint_ns,
+            "checkpoint_id": checkpoint["id"],
+        }}
+    
+    def put_writes(self, config: RunnableConfig, writes: Sequence[Tuple[str, Any]], task_id: str,
+                   task_path: str = "") -> None:
+        """Attach pending writes to the thread's current checkpoint."""
+        thread_id = config["configurable"]["thread_id"]
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        record = self._record(thread_id, checkpoint_ns)
+        if record is None or record.checkpoint_id != config["configurable"]["checkpoint_id"]:
+            logger.debug(f"Dropping writes for superseded checkpoint of {thread_id}")
+            return
+        
+        for idx, (channel, value) in enumerate(writes):
+            key = (task_id, WRITES_IDX_MAP.get(channel, idx))
+            if key[1] >= 0 and key in record.writes:
+                continue
+            record.writes[key] = (task_id, channel, self.serde.dumps_typed(value), task_path)
+        with self._lock:
+            self._threads.resize(thread_id)
+        self._persist(thread_id, checkpoint_ns, record)
+    
+    def delete_thread(self, thread_id: str) -> None:
+        with self._lock:
+            self._threads.pop(thread_id)
+        self._delete_persisted(thread_id)
+    
+    # ---- async API -------------------------------------------------------
+    # Memory hits are served inline; only SQLite I/O moves to a worker thread.
+    
+    async def aget_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        if self._conn is None:
+            return self.get_tuple(config)
+        return await asyncio.to_thread(self.get_tuple, config)
+    
+    async def alist(self, config: Optional[RunnableConfig], *, filter: Optional[Dict[str, Any]] = None,
+                    before: Optional[RunnableConfig] = None,
+                    limit: Optional[int] = None) -> AsyncIterator[CheckpointTuple]:
+        for item in self.list(config, filter=filter, before=before, limit=limit):
+            yield item
+    
+    async def aput(self, config: RunnableConfig, checkpoint: Checkpoint, metadata: CheckpointMetadata,
+                   new_versions: ChannelVersions) -> RunnableConfig:
+        if self._conn is None:
+            return self.put(config, checkpoint, metadata, new_versions)
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+    
+    async def aput_writes(self, config: RunnableConfig, writes: Sequence[Tuple[str, Any]], task_id: str,
+                          task_path: str = "") -> None:
+        if self._conn is None:
+            return self.put_writes(config, writes, task_id, task_path)
+        return await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+    
+    async def adelete_thread(self, thread_id: str) -> None:
+        if self._conn is None:
+            return self.delete_thread(thread_id)
+        return await asyncio.to_thread(self.delete_thread, thread_id)
+    
+    def stats(self) -> Dict[str, Any]:
+        stats = self._threads.stats()
+        stats["puts"] = self.puts
+        stats["persistent"] = self._conn is not None
+        return stats
 
 
 class ChatStateManager:
@@ -122,22 +378,63 @@ class ChatStateManager:
     
     def __init__(self):
         self.memory_manager = memory
+        # Per-source deadlines for hydration; a source that misses it gets its fallback
+        self.load_timeouts = {
+            "conversation": STATE_LOAD_CONVERSATION_TIMEOUT,
+            "customer": STATE_LOAD_CUSTOMER_TIMEOUT,
+            "active_order": STATE_LOAD_ORDER_TIMEOUT,
+        }
+        self.loads = 0
+        self.load_seconds = 0.0
+        self.source_seconds = {name: 0.0 for name in self.load_timeouts}
+        self.fallbacks = {name: 0 for name in self.load_timeouts}
+        # Last customer row each user's lookup returned, for turns whose lookup misses its deadline
+        self.known_customers: LRUCache[Dict[str, Any]] = LRUCache(
+            "known_customers", max_entries=CHECKPOINT_MAX_THREADS, ttl_seconds=CHECKPOINT_TTL_MINUTES * 60,
+        )
+        self.customers_reused = 0
+    
+    async def _load_source(self, name: str, source: Awaitable, fallback: Callable[[], Any]) -> Any:
+        """
+        Await one hydration source within its deadline.
+        On timeout or error the turn goes on with `fallback()` instead of failing.
+        """
+        timeout = self.load_timeouts.get(name) or None
+        started = time.perf_counter()
+        try:
+            return await asyncio.wait_for(source, timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Loading {name} timed out after {timeout}s, using fallback")
+        except Exception as e:
+            logger.warning(f"Loading {name} failed, using fallback: {e}")
+        finally:
+            self.source_seconds[name] += time.perf_counter() - started
+        self.fallbacks[name] += 1
+        return fallback()
     
     async def load_state_for_user(self, user_id: str, new_message: str) -> ChatState:
         """
         Load complete chat state for a user including memory.
+        `customer` is None when the lookup failed and this worker has no earlier
+        row for the user: unknown, which is not the same as unregistered.
         """
         try:
-            # Get conversation context from  memory
-            context = await self.memory_manager.get_conversation(user_id)
-            
-            # Get customer data from database
-            from .tools import get_customer
-            customer = get_customer.invoke({"user_id": user_id})
-            
-            # Get active order if exists
-            from .tools import get_active_order
-            active_order = get_active_order.invoke({"user_id": user_id})
+            # Conversation, customer and active order are independent round trips:
+            # load them together, so hydration costs the slowest one, not the sum
+            from .tools import get_active_order, get_customer
+            started = time.perf_counter()
+            context, customer, active_order = await asyncio.gather(
+                self._load_source(
+                    "conversation",
+                    self.memory_manager.get_conversation(user_id),
+                    # Possibly stale, but better than answering without any history
+                    lambda: self.memory_manager.peek_conversation(user_id) or ConversationContext(user_id)
+                ),
+                self._load_source("customer", get_customer.ainvoke({"user_id": user_id}), lambda: None),
+                self._load_source("active_order", get_active_order.ainvoke({"user_id": user_id}), dict),
+            )
+            self.loads += 1
+            self.load_seconds += time.perf_counter() - started
             
             # Build the ChatState
             from langchain_core.messages import HumanMessage
@@ -150,8 +447,10 @@ class ChatStateManager:
             new_human_message = HumanMessage(content=new_message)
             all_messages = historical_messages + [new_human_message]
             
-            # Determine current step and flags
-            needs_customer_info = not customer or not customer.get("last_name")
+            customer = self._known_customer(user_id, customer)
+            
+            # Determine current step and flags; an unknown customer is not sent to registration
+            needs_customer_info = customer is not None and not customer.get("last_name")
             ready_to_order = bool(customer and customer.get("last_name"))
             
             # Determine current step based on context
@@ -160,6 +459,7 @@ class ChatStateManager:
             state = ChatState(
                 user_id=user_id,
                 messages=all_messages,
+                conversation_summary=context.summary,
                 customer=customer,
                 current_step=current_step,
                 active_order=active_order,
@@ -186,72 +486,91 @@ class ChatStateManager:
                 ready_to_order=False
             )
     
-    async def save_state_for_user(self, state: ChatState, ai_response):
+    def _known_customer(self, user_id: str, customer: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """Remember a looked-up customer; after a failed lookup (None) fall back to the last one seen."""
+        if customer is None:
+            known = self.known_customers.get(user_id)
+            if known is not None:
+                self.customers_reused += 1
+            return known
+        if customer:
+            self.known_customers.put(user_id, customer)
+        else:
+            self.known_customers.pop(user_id)
+        return customer
+    
+    async def save_state_for_user(self, state: ChatState, ai_response) -> Optional[list]:
         """
         Save chat state to  memory.
+        Returns the stored message window afterwards (None if saving failed).
         """
         try:
             user_id = state["user_id"]
             
             # Save the AI response to conversation memory
-            from langchain_core.messages import AIMessage
+            from langchain_core.messages import AIMessage, HumanMessage
             ai_message = AIMessage(content=ai_response)
             
-            # Add both human message and AI response
-            if state["messages"]:
-                # Add the human message (last one in state)
-                human_message = state["messages"][-1]
-                await self.memory_manager.add_message(user_id, human_message)
-            
-            # Add the AI response
-            await self.memory_manager.add_message(user_id, ai_message)
-            
-            # Update customer context if we have relevant info
-            if state.get("customer") and state["customer"].get("first_name"):
-                await self.memory_manager.update_customer_context(
-                    user_id, 
-                    "customer_name", 
-                    f"{state['customer'].get('first_name', '')} {state['customer'].get('last_name', '')}"
-                )
-            
-            # Update order context if we have an active order
-            if state.get("active_order") and state["active_order"]:
-                await self.memory_manager.update_customer_context(
-                    user_id,
-                    "current_order",
-                    state["active_order"]
+            # Collect the whole turn and write it once
+            async with self.memory_manager.turn(user_id) as turn:
+                # Add the latest human message (the last state message is the AI reply)
+                human_message = next(
+                    (msg for msg in reversed(state["messages"]) if isinstance(msg, HumanMessage)),
+                    None
                 )
+                if human_message is not None:
+                    turn.add_message(human_message)
+                
+                # Add the AI response
+                turn.add_message(ai_message)
+                
+                # Update customer context if we have relevant info
+                if state.get("customer") and state["customer"].get("first_name"):
+                    turn.update_customer_context(
+                        "customer_name",
+                        f"{state['customer'].get('first_name', '')} {state['customer'].get('last_name', '')}"
+                    )
+                
+                # Update order context if we have an active order
+                if state.get("active_order") and state["active_order"]:
+                    turn.update_customer_context("current_order", state["active_order"])
             
             logger.info(f"Saved state for {user_id}")
+            context = await self.memory_manager.get_conversation(user_id)
+            history = context.get_messages_for_llm()
+            # The stored copy may be truncated; the graph keeps the full reply it returns
+            if history and isinstance(history[-1], AIMessage) and history[-1].content != ai_response:
+                history[-1] = AIMessage(content=ai_response, id=history[-1].id)
+            return history
             
         except Exception as e:
             logger.error(f"Error saving state for {user_id}: {e}")
+            return None
+    
+    def stats(self) -> Dict[str, Any]:
+        """Hydration latency (total and per source) and fallback counts."""
+        def avg_ms(seconds: float) -> float:
+            return round(seconds / self.loads * 1000, 2) if self.loads else 0.0
+        return {
+            "loads": self.loads,
+            "avg_ms": avg_ms(self.load_seconds),
+            "source_avg_ms": {name: avg_ms(seconds) for name, seconds in self.source_seconds.items()},
+            "fallbacks": dict(self.fallbacks),
+            "customers_reused": self.customers_reused,
+            "timeouts_seconds": dict(self.load_timeouts),
+        }
     
     def _determine_current_step(self, context: ConversationContext, new_message: str, needs_customer_info: bool) -> str:
         """
         Determine the current step in the conversation.
         """
-        message_lower = new_message.lower()
-        
         # Check customer context for clues
         if needs_customer_info:
             return "greeting"
         
-        # Check recent conversation for context
-        recent_messages = context.recent_messages[-3:] if context.recent_messages else []
-        recent_content = " ".join([msg.get("content", "") for msg in recent_messages]).lower()
-        
-        # Determine step based on message content and recent context
-        if any(word in message_lower for word in ["menú", "menu", "pizzas", "precios", "qué tienen"]):
-            return "menu"
-        elif any(word in message_lower for word in ["ordenar", "pedido", "quiero", "pizza"]):
-            return "order"
-        elif any(word in recent_content for word in ["pedido", "orden", "pizza"]):
-            return "order"
-        elif any(word in recent_content for word in ["menú", "menu", "precios"]):
-            return "menu"
-        else:
-            return "general"
+        # Message first, then the recent conversation (each text is scanned once, see intents.py)
+        recent_messages = list(context.messages)[-3:]
+        return determine_step(new_message, (msg.content for msg in recent_messages))
 
 
 # Global instances
@@ -0,0 +1,135 @@
+"""
+Binary codecs for stored conversation state.
+
+Every encoded blob starts with a 4-byte header: b"CX", the codec id and the
+schema version of the payload. Decoding reads the header, so blobs written with
+one codec stay readable after MEMORY_CODEC changes, and a payload layout change
+can be detected instead of silently misread.
+
+Available codecs:
+- "json":         stdlib json, always available
+- "orjson":       orjson (a regular dependency), same JSON payload, much faster
+- "msgpack-zstd": msgpack + zstandard (the "compact" extra: poetry install -E compact), smallest
+"""
+
+import json
+import logging
+from typing import Any, Dict, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:  # Optional: falls back to stdlib json
+    orjson = None
+
+try:
+    import msgpack
+    import zstandard
+except ImportError:  # Optional ("compact" extra): binary format unavailable
+    msgpack = None
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"CX"
+HEADER_SIZE = 4
+
+
+class CodecError(ValueError):
+    """Blob that no available codec can decode."""
+
+
+class Codec:
+    """Turns plain Python data (dicts, lists, str, numbers) into bytes and back."""
+
+    name = "base"
+    codec_id = 0
+
+    def dumps(self, obj: Any) -> bytes:
+        raise NotImplementedError
+
+    def loads(self, payload: bytes) -> Any:
+        raise NotImplementedError
+
+    def encode(self, obj: Any, schema_version: int = 1) -> bytes:
+        """Serialize `obj` behind a header carrying this codec and the schema version."""
+        return MAGIC + bytes((self.codec_id, schema_version)) + self.dumps(obj)
+
+
+class JSONCodec(Codec):
+
+    name = "json"
+    codec_id = 1
+
+    def dumps(self, obj: Any) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    def loads(self, payload: bytes) -> Any:
+        return json.loads(payload)
+
+
+class OrjsonCodec(Codec):
+
+    name = "orjson"
+    codec_id = 2
+
+    def dumps(self, obj: Any) -> bytes:
+        return orjson.dumps(obj)
+
+    def loads(self, payload: bytes) -> Any:
+        return orjson.loads(payload)
+
+
+class MsgpackZstdCodec(Codec):
+    """msgpack payload compressed with zstd. Contexts are small, so a low level is enough."""
+
+    name = "msgpack-zstd"
+    codec_id = 3
+
+    def __init__(self, level: int = 3):
+        self._compressor = zstandard.ZstdCompressor(level=level)
+        self._decompressor = zstandard.ZstdDecompressor()
+
+    def dumps(self, obj: Any) -> bytes:
+        return self._compressor.compress(msgpack.packb(obj, use_bin_type=True))
+
+    def loads(self, payload: bytes) -> Any:
+        return msgpack.unpackb(self._decompressor.decompress(payload), raw=False, strict_map_key=False)
+
+
+def available_codecs() -> Dict[str, Codec]:
+    """Codecs whose dependencies are installed, by name."""
+    codecs: Dict[str, Codec] = {"json": JSONCodec()}
+    if orjson is not None:
+        codecs["orjson"] = OrjsonCodec()
+    if msgpack is not None and zstandard is not None:
+        codecs["msgpack-zstd"] = MsgpackZstdCodec()
+    return codecs
+
+
+_CODECS = available_codecs()
+_BY_ID = {codec.codec_id: codec for codec in _CODECS.values()}
+# orjson writes plain JSON, so stdlib json can read its blobs when orjson is missing
+_BY_ID.setdefault(OrjsonCodec.codec_id, _CODECS["json"])
+
+
+_warned: set = set()
+
+
+def get_codec(name: Optional[str] = None) -> Codec:
+    """Codec by name; the fastest installed one when name is empty or unavailable."""
+    if name and name in _CODECS:
+        return _CODECS[name]
+    if name and name not in _warned:
+        _warned.add(name)
+        logger.warning(f"Codec '{name}' unavailable, using {'orjson' if orjson else 'json'}")
+    return _CODECS.get("orjson") or _CODECS["json"]
+
+
+def decode(blob: bytes) -> Tuple[int, Any]:
+    """Decode any blob written by encode(). Returns (schema_version, obj)."""
+    if len(blob) < HEADER_SIZE or blob[:2] != MAGIC:
+        raise CodecError("Missing codec header")
+    codec = _BY_ID.get(blob[2])
+    if codec is None:
+        raise CodecError(f"Codec id {blob[2]} is not installed")
+    return blob[3], codec.loads(blob[HEADER_SIZE:])
@@ -0,0 +1,145 @@
+"""
+Cache coherence between uvicorn workers.
+
+Every saved conversation row carries a version stamp. After a save, the worker
+publishes (thread_id, version) on an invalidation channel; other workers mark
+their cached copy stale and reload it on next use instead of serving old history.
+Workers also revalidate cached entries cheaply (a version-only query) when they
+have not heard about a thread for a while, which covers lost notifications.
+Saves are a compare-and-set on the same stamp (MemoryManager.save_conversation),
+so two workers that race on one thread never overwrite each other's messages.
+"""
+
+import asyncio
+import json
+import logging
+import uuid
+from typing import Awaitable, Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+InvalidationHandler = Callable[[str, int], Awaitable[None]]
+
+
+class InvalidationChannel:
+    """Broadcasts conversation version bumps to the other workers."""
+
+    def __init__(self):
+        self.origin = uuid.uuid4().hex  # Lets a worker ignore its own notifications
+        self.published = 0
+        self.received = 0
+
+    async def start(self, handler: InvalidationHandler):
+        raise NotImplementedError
+
+    async def publish(self, thread_id: str, version: int):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class LocalInvalidationChannel(InvalidationChannel):
+    """
+    In-process stand-in: every instance sharing a hub sees the others' notifications.
+    Useful to simulate several workers (several MemoryManagers) in one test process.
+    """
+
+    _default_hub: List["LocalInvalidationChannel"] = []
+
+    def __init__(self, hub: Optional[List["LocalInvalidationChannel"]] = None):
+        super().__init__()
+        self.hub = hub if hub is not None else self._default_hub
+        self._handler: Optional[InvalidationHandler] = None
+
+    async def start(self, handler: InvalidationHandler):
+        self._handler = handler
+        if self not in self.hub:
+            self.hub.append(self)
+
+    async def publish(self, thread_id: str, version: int):
+        self.published += 1
+        for peer in list(self.hub):
+            if peer is not self and peer._handler is not None:
+                peer.received += 1
+                await peer._handler(thread_id, version)
+
+    async def close(self):
+        if self in self.hub:
+            self.hub.remove(self)
+
+
+class _DatagramProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, channel: "UDPInvalidationChannel"):
+        self.channel = channel
+
+    def datagram_received(self, data: bytes, addr):
+        try:
+            payload = json.loads(data)
+        except ValueError:
+            return
+        if payload.get("o") == self.channel.origin:
+            return
+        self.channel.received += 1
+        asyncio.ensure_future(self.channel._handler(payload["t"], int(payload["v"])))
+
+
+class UDPInvalidationChannel(InvalidationChannel):
+    """
+    Local-socket channel for several workers on one host.
+    Each worker binds the first free port in `ports` and sends every
+    notification to all ports in the range. Delivery is best effort; periodic
+    revalidation covers anything lost.
+    """
+
+    def __init__(self, ports: range, host: str = "127.0.0.1"):
+        super().__init__()
+        self.ports = ports
+        self.host = host
+        self.port: Optional[int] = None
+        self._transport: Optional[asyncio.DatagramTransport] = None
+        self._handler: Optional[InvalidationHandler] = None
+
+    async def start(self, handler: InvalidationHandler):
+        self._handler = handler
+        loop = asyncio.get_running_loop()
+        for port in self.ports:
+            try:
+                self._transport, _ = await loop.create_datagram_endpoint(
+                    lambda: _DatagramProtocol(self), local_addr=(self.host, port)
+                )
+                self.port = port
+                logger.info(f"Invalidation channel listening on {self.host}:{port}")
+                return
+            except OSError:
+                continue
+        logger.warning(f"No free invalidation port in {self.ports.start}-{self.ports.stop - 1}; "
+                       f"relying on revalidation only")
+
+    async def publish(self, thread_id: str, version: int):
+        if self._transport is None:
+            return
+        self.published += 1
+        data = json.dumps({"t": thread_id, "v": version, "o": self.origin}).encode()
+        for port in self.ports:
+            if port != self.port:
+                self._transport.sendto(data, (self.host, port))
+
+    async def close(self):
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+
+
+def build_channel(name: Optional[str], ports: str = "") -> Optional[InvalidationChannel]:
+    """Create the channel selected by config ("none", "local" or "udp")."""
+    if not name or name == "none":
+        return None
+    if name == "local":
+        return LocalInvalidationChannel()
+    if name == "udp":
+        first, _, last = ports.partition("-")
+        return UDPInvalidationChannel(range(int(first), int(last or first) + 1))
+    logger.warning(f"Unknown invalidation channel '{name}', cache coherence disabled")
+    return None
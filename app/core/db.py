@@ -0,0 +1,92 @@
+"""
+Non-blocking data access layer over the Supabase client.
+
+supabase-py's `.execute()` is a blocking HTTP round trip. Calling it directly
+from an `async def` node or FastAPI handler stalls the event loop for every
+user, so all database I/O goes through `db`:
+
+    result = await db.execute(db.table("clientes").select("*").eq("user_id", user_id))
+
+Building the query is cheap and stays on the caller's thread; only `.execute()`
+is moved to a bounded worker pool. Sync code (LangChain tools) uses
+`db.execute_sync(...)`. Both paths take a slot from one shared limiter, so at
+most SUPABASE_MAX_CONCURRENCY round trips are in flight in total.
+"""
+
+import asyncio
+import contextvars
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict
+
+from ..config import supabase, SUPABASE_MAX_CONCURRENCY
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncSupabase:
+    """
+    Async facade over a sync Supabase (or fake) client with a concurrency cap.
+    """
+
+    def __init__(self, client: Any, max_concurrency: int = 16):
+        self.client = client
+        self.max_concurrency = max_concurrency
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="supabase-io")
+        # One budget for both paths: pool workers and sync callers take a slot per round trip
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+
+        self.queries = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.total_seconds = 0.0
+        self._stats_lock = threading.Lock()
+
+    def table(self, name: str) -> Any:
+        """Start a query builder for a table. No I/O happens until execute."""
+        return self.client.table(name)
+
+    async def execute(self, query: Any) -> Any:
+        """Run `query.execute()` on the I/O pool without blocking the event loop."""
+        loop = asyncio.get_running_loop()
+        # Keep contextvars (request-scoped state) visible inside the worker thread
+        ctx = contextvars.copy_context()
+        return await loop.run_in_executor(self._executor, ctx.run, self._timed_execute, query)
+
+    def execute_sync(self, query: Any) -> Any:
+        """Run `query.execute()` on the calling thread, bounded by the same limit."""
+        return self._timed_execute(query)
+
+    def _timed_execute(self, query: Any) -> Any:
+        with self._slots:
+            return self._run(query)
+
+    def _run(self, query: Any) -> Any:
+        with self._stats_lock:
+            self.queries += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        started = time.perf_counter()
+        try:
+            return query.execute()
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._stats_lock:
+                self.in_flight -= 1
+                self.total_seconds += elapsed
+
+    def stats(self) -> Dict[str, Any]:
+        """Query counters for monitoring endpoints."""
+        return {
+            "queries": self.queries,
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "max_concurrency": self.max_concurrency,
+            "avg_ms": round(1000 * self.total_seconds / self.queries, 2) if self.queries else 0.0,
+        }
+
+
+# Global instance
+db = AsyncSupabase(supabase, max_concurrency=SUPABASE_MAX_CONCURRENCY)
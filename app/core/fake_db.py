@@ -0,0 +1,211 @@
+"""
+Local in-memory stand-in for the Supabase client.
+Implements the subset of the PostgREST query builder this app uses, so the bot
+can run and be load tested offline (SUPABASE_BACKEND=fake).
+"""
+
+import copy
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Set
+
+
+class FakeAPIError(Exception):
+    """Raised where PostgREST answers with an error (e.g. a table that does not exist)."""
+
+
+class FakeResult:
+    """Mimics the `APIResponse` returned by `.execute()`."""
+
+    def __init__(self, data: List[Dict[str, Any]], count: Optional[int] = None):
+        self.data = data
+        self.count = count
+
+
+class FakeQuery:
+    """Chainable query builder over one in-memory table."""
+
+    def __init__(self, client: "FakeSupabaseClient", table_name: str):
+        self._client = client
+        self._table_name = table_name
+        self._action = "select"
+        self._payload: Any = None
+        self._on_conflict: Optional[str] = None
+        self._ignore_duplicates = False
+        self._columns: Optional[List[str]] = None
+        self._filters: List[Callable[[Dict[str, Any]], bool]] = []
+        self._order: List[tuple] = []
+        self._limit: Optional[int] = None
+
+    # ---- actions ---------------------------------------------------------
+
+    def select(self, columns: str = "*", **kwargs) -> "FakeQuery":
+        self._action = "select"
+        if columns and columns.strip() != "*":
+            self._columns = [column.strip() for column in columns.split(",")]
+        return self
+
+    def insert(self, data: Any, **kwargs) -> "FakeQuery":
+        self._action = "insert"
+        self._payload = data
+        return self
+
+    def upsert(self, data: Any, on_conflict: str = "id", ignore_duplicates: bool = False, **kwargs) -> "FakeQuery":
+        self._action = "upsert"
+        self._payload = data
+        self._on_conflict = on_conflict
+        self._ignore_duplicates = ignore_duplicates
+        return self
+
+    def update(self, data: Dict[str, Any], **kwargs) -> "FakeQuery":
+        self._action = "update"
+        self._payload = data
+        return self
+
+    def delete(self, **kwargs) -> "FakeQuery":
+        self._action = "delete"
+        return self
+
+    # ---- filters ---------------------------------------------------------
+
+    def eq(self, column: str, value: Any) -> "FakeQuery":
+        self._filters.append(lambda row: row.get(column) == value)
+        return self
+
+    def neq(self, column: str, value: Any) -> "FakeQuery":
+        self._filters.append(lambda row: row.get(column) != value)
+        return self
+
+    def lt(self, column: str, value: Any) -> "FakeQuery":
+        self._filters.append(lambda row: row.get(column) is not None and row.get(column) < value)
+        return self
+
+    def lte(self, column: str, value: Any) -> "FakeQuery":
+        self._filters.append(lambda row: row.get(column) is not None and row.get(column) <= value)
+        return self
+
+    def gt(self, column: str, value: Any) -> "FakeQuery":
+        self._filters.append(lambda row: row.get(column) is not None and row.get(column) > value)
+        return self
+
+    def gte(self, column: str, value: Any) -> "FakeQuery":
+        self._filters.append(lambda row: row.get(column) is not None and row.get(column) >= value)
+        return self
+
+    def in_(self, column: str, values: List[Any]) -> "FakeQuery":
+        allowed = list(values)
+        self._filters.append(lambda row: row.get(column) in allowed)
+        return self
+
+    def ilike(self, column: str, pattern: str) -> "FakeQuery":
+        needle = pattern.strip("%").lower()
+        self._filters.append(lambda row: needle in str(row.get(column) or "").lower())
+        return self
+
+    def order(self, column: str, desc: bool = False, **kwargs) -> "FakeQuery":
+        self._order.append((column, desc))
+        return self
+
+    def limit(self, size: int, **kwargs) -> "FakeQuery":
+        self._limit = size
+        return self
+
+    # ---- execution -------------------------------------------------------
+
+    def execute(self) -> FakeResult:
+        return self._client._execute(self)
+
+    def _matches(self, row: Dict[str, Any]) -> bool:
+        return all(check(row) for check in self._filters)
+
+    def _project(self, row: Dict[str, Any]) -> Dict[str, Any]:
+        if self._columns is None:
+            return copy.deepcopy(row)
+        return {column: copy.deepcopy(row.get(column)) for column in self._columns}
+
+
+class FakeSupabaseClient:
+    """
+    Thread-safe in-memory tables with PostgREST-like semantics.
+    `latency` (seconds) is slept on every execute to simulate a network round trip.
+    Tables are created on first use, except those listed in `missing_tables`,
+    which fail like a relation that was never created.
+    """
+
+    def __init__(self, tables: Optional[Dict[str, List[Dict[str, Any]]]] = None, latency: float = 0.0):
+        self.tables: Dict[str, List[Dict[str, Any]]] = {
+            name: [dict(row) for row in rows] for name, rows in (tables or {}).items()
+        }
+        self.latency = latency
+        self.missing_tables: Set[str] = set()
+        self.executed = 0
+        self._lock = threading.Lock()
+        self._next_id = 1
+
+    def table(self, name: str) -> FakeQuery:
+        return FakeQuery(self, name)
+
+    def _execute(self, query: FakeQuery) -> FakeResult:
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self._lock:
+            self.executed += 1
+            if query._table_name in self.missing_tables:
+                raise FakeAPIError(f'relation "public.{query._table_name}" does not exist')
+            rows = self.tables.setdefault(query._table_name, [])
+
+            if query._action == "select":
+                selected = [row for row in rows if query._matches(row)]
+                for column, desc in reversed(query._order):
+                    selected.sort(key=lambda row: (row.get(column) is None, row.get(column)), reverse=desc)
+                if query._limit is not None:
+                    selected = selected[:query._limit]
+                return FakeResult([query._project(row) for row in selected])
+
+            if query._action == "insert":
+                payload = query._payload if isinstance(query._payload, list) else [query._payload]
+                inserted = []
+                for item in payload:
+                    row = copy.deepcopy(item)
+                    if "id" not in row:
+                        row["id"] = self._next_id
+                        self._next_id += 1
+                    rows.append(row)
+                    inserted.append(copy.deepcopy(row))
+                return FakeResult(inserted)
+
+            if query._action == "upsert":
+                payload = query._payload if isinstance(query._payload, list) else [query._payload]
+                keys = [key.strip() for key in (query._on_conflict or "id").split(",")]
+                upserted = []
+                for item in payload:
+                    existing = next(
+                        (row for row in rows if all(row.get(key) == item.get(key) for key in keys)),
+                        None
+                    )
+                    if existing is not None and query._ignore_duplicates:
+                        continue  # Like ON CONFLICT DO NOTHING: not returned
+                    if existing is not None:
+                        existing.update(copy.deepcopy(item))
+                        upserted.append(copy.deepcopy(existing))
+                    else:
+                        row = copy.deepcopy(item)
+                        rows.append(row)
+                        upserted.append(copy.deepcopy(row))
+                return FakeResult(upserted)
+
+            if query._action == "update":
+                updated = []
+                for row in rows:
+                    if query._matches(row):
+                        row.update(copy.deepcopy(query._payload))
+                        updated.append(copy.deepcopy(row))
+                return FakeResult(updated)
+
+            if query._action == "delete":
+                deleted = [row for row in rows if query._matches(row)]
+                self.tables[query._table_name] = [row for row in rows if not query._matches(row)]
+                return FakeResult(deleted)
+
+            raise ValueError(f"Unsupported fake query action: {query._action}")
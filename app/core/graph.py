@@ -8,17 +8,20 @@ from typing import Dict, Any
 from langchain_core.messages import AIMessage, HumanMessage
 from langchain_openai import ChatOpenAI
 from langgraph.graph import StateGraph, END
-from langgraph.prebuilt import ToolNode
 from langchain_core.runnables import RunnableConfig
 
-from .state import ChatState
-from .tools import ALL_TOOLS, get_menu
-from .prompts import (
-    SYSTEM_PROMPT, CONTEXT_NEW_CUSTOMER, CONTEXT_RETURNING_CUSTOMER,
-    CONTEXT_MENU_INQUIRY, CONTEXT_ORDER_START, ERROR_GENERAL, CONTEXT_CONFUSION, TOOLS_EXECUTION_PROMPT
-)
-from .checkpointer import state_manager
-from langgraph.checkpoint.memory import MemorySaver
+from .state import ChatState, sync_messages
+from .tools import ALL_TOOLS
+from .tool_executor import tool_executor
+from .prompts import ERROR_GENERAL, CONTEXT_CONFUSION, TOOLS_EXECUTION_PROMPT
+from .prompt_layout import FINAL_RESPONSE_RULES, build_context, prefix_tokens
+from .checkpointer import checkpointer, state_manager
+from .catalog import menu_fast_path
+from .intents import detect_intent
+from .loader import request_scope
+from .memory import memory
+from .response_cache import response_cache
+from .tokens import prompt_tokens
 from ..config import OPENAI_MODEL
 from langchain_openai import ChatOpenAI
 
@@ -61,26 +64,31 @@ async def load_state_node(state: ChatState) -> Dict[str, Any]:
     print(f"Loading  state for user: {user_id}")
     
     try:
-        # CRITICAL: Always check if customer is registered first
-        from .tools import get_customer
-        customer = get_customer.invoke(user_id)
-        
-        # Load complete state using our  state manager
+        # Load complete state using our  state manager. It ALWAYS includes the
+        # customer lookup, run concurrently with the memory and order loads
         complete_state = await state_manager.load_state_for_user(user_id, new_message)
+        customer = complete_state.get("customer")  # None when the lookup failed: unknown, not new
         
-        # Determine if this is a new conversation (no previous messages in memory)
-        is_new_conversation = len(complete_state.get("messages", [])) == 0
+        # Determine if this is a new conversation (no previous messages in memory;
+        # the loaded messages always end with the new one)
+        is_new_conversation = len(complete_state.get("messages", [])) <= 1
     
-        needs_customer_info = not customer or not customer.get("last_name")
+        needs_customer_info = customer is not None and not customer.get("last_name")
+        
+        # Only the difference between the checkpoint and the stored window: usually
+        # nothing, a full rebuild only after a restart or when memory changed elsewhere
+        history = complete_state.get("messages", [])[:-1]  # Last one is the new message again
+        message_updates = sync_messages(state["messages"][:-1], history, rebuild_tail=state["messages"][-1:])
         
         # Return the loaded state data
         return {
-            "customer": customer,  # Always include customer data (empty dict if not found)
+            "customer": customer,  # Empty dict if not registered, None if the lookup failed
             "current_step": "",
             "active_order": complete_state.get("active_order", {}),
             "needs_customer_info": needs_customer_info,
             "ready_to_order": bool(customer and customer.get("last_name")),
-            "messages": complete_state.get("messages", [])  # This includes conversation history
+            "conversation_summary": complete_state.get("conversation_summary", ""),
+            "messages": message_updates
         }
         
     except Exception as e:
@@ -136,7 +144,27 @@ async def agent_with_tools_cycle(state: ChatState) -> ChatState:
         state.messages.append(error_msg)
         return state
 
-def conversation_node(state: ChatState) -> Dict[str, Any]:
+async def route_node(state: ChatState) -> Dict[str, Any]:
+    """
+    Deterministic router after load_state: simple price and ingredient questions
+    about one menu item are answered from the cached catalog (see core/catalog.py),
+    everything else goes on to the LLM unchanged.
+    """
+    message = state["messages"][-1] if state["messages"] else None
+    if not isinstance(message, HumanMessage) or not isinstance(message.content, str):
+        return {}
+    
+    # First contact: the template greets, like the LLM would
+    greet = not any(isinstance(msg, AIMessage) for msg in state["messages"])
+    reply = await menu_fast_path.answer(message.content, customer=state.get("customer"), greet=greet)
+    if reply is None:
+        return {}
+    
+    logger.info(f"Answered {state['user_id']} from the menu catalog, no LLM call")
+    return {"messages": [AIMessage(content=reply)], "current_step": "menu"}
+
+
+async def conversation_node(state: ChatState) -> Dict[str, Any]:
     """
     Enhanced conversation node that uses conversation memory.
     Juan handles different types of interactions naturally.
@@ -160,15 +188,24 @@ def conversation_node(state: ChatState) -> Dict[str, Any]:
             logger.info(f"Juan is sending full menu image to customer. Response: {menu_response}")
         else:
             logger.info(f"USING NORMAL LLM FLOW for step: {current_step}")
-            # Build context for the AI using conversation history
-            context = _build_conversation_context(state)
-            
-            # Generate response using LLM with tools
-            response = llm_with_tools.invoke(context)
-            
-            # Log tool calls for debugging
-            if hasattr(response, 'tool_calls') and response.tool_calls:
-                logger.info(f"Generated {len(response.tool_calls)} tool calls: {[tc.get('name', 'unknown') for tc in response.tool_calls]}")
+            # Same message, step and registration as an earlier non-personal turn:
+            # reuse its reply (see core/response_cache.py)
+            cached_reply = await response_cache.lookup(state)
+            if cached_reply is not None:
+                response = AIMessage(content=cached_reply)
+            else:
+                # Build context for the AI using conversation history
+                context = _build_conversation_context(state)
+                
+                # Generate response using LLM with tools; awaited, so the event loop
+                # keeps serving other users while the model answers
+                response = await llm_with_tools.ainvoke(context)
+                
+                # Log tool calls for debugging
+                if hasattr(response, 'tool_calls') and response.tool_calls:
+                    logger.info(f"Generated {len(response.tool_calls)} tool calls: {[tc.get('name', 'unknown') for tc in response.tool_calls]}")
+                else:
+                    await response_cache.store(state, response)
         
         # Update state based on response
         new_state = _update_state_from_response(state, response)
@@ -191,10 +228,12 @@ async def save_state_node(state: ChatState) -> Dict[str, Any]:
         ai_response = state["messages"][-1].content if state["messages"] else ""
         
         # Save state using our  state manager
-        await state_manager.save_state_for_user(state, ai_response)
+        history = await state_manager.save_state_for_user(state, ai_response)
         
         logger.info(f" state saved for user: {state['user_id']}")
-        return {}
+        # Swap this turn's messages (and tool traffic) for their stored versions so the
+        # next turn's load finds the checkpoint already in sync
+        return {"messages": sync_messages(state["messages"], history)} if history is not None else {}
         
     except Exception as e:
         logger.error(f"Error saving  state: {e}")
@@ -204,64 +243,16 @@ async def save_state_node(state: ChatState) -> Dict[str, Any]:
 def _build_conversation_context(state: ChatState) -> list:
     """
     Build conversation context using memory and current state.
-    Juan always checks customer status and responds accordingly.
+    Static instructions come first, as one precomputed block per step, so the
+    provider can reuse the prompt prefix across turns and customers; customer
+    data and history follow (see core/prompt_layout.py).
     """
-    messages = []
-    
-    # Always start with Juan's system prompt
-    messages.append(("system", SYSTEM_PROMPT))
-    
-    # CRITICAL: Add user_id to context so Juan knows which user_id to use for tools
-    user_id = state["user_id"]
-    messages.append(("system", f"IMPORTANTE: El user_id de este cliente es '{user_id}'. Usa SIEMPRE este user_id exacto cuando uses herramientas como get_customer, create_customer, etc. NO uses el nombre del cliente como user_id."))
+    messages = build_context(state)
     
-    # Add situational context based on current step and customer info
-    if state["current_step"] == "greeting":
-        if state.get("customer") and state["customer"].get("first_name"):
-            # Returning customer - greet by name
-            customer_name = f"{state['customer'].get('first_name', '')} {state['customer'].get('last_name', '')}"
-            context = CONTEXT_RETURNING_CUSTOMER.format(customer_name=customer_name.strip())
-            messages.append(("system", context))
-            messages.append(("system", f"IMPORTANTE: Este cliente se llama {customer_name.strip()}. Salúdalo por su nombre real."))
-        else:
-            # New customer - be cordial but don't ask for info unless ordering
-            messages.append(("system", CONTEXT_NEW_CUSTOMER))
-            messages.append(("system", "IMPORTANTE: Este cliente NO está registrado. NO inventes nombres. Salúdalo cordialmente sin usar nombres inventados."))
-    
-    elif state["current_step"] == "menu":
-        messages.append(("system", CONTEXT_MENU_INQUIRY))
-    
-    elif state["current_step"] == "full_menu":
-        messages.append(("system", CONTEXT_MENU_INQUIRY))
-        messages.append(("system", "IMPORTANTE: El cliente pidió el MENÚ COMPLETO. Debes usar la herramienta send_full_menu para enviar la imagen del menú."))
-    
-    elif state["current_step"] == "order":
-        messages.append(("system", CONTEXT_ORDER_START))
-    
-    elif state["current_step"] == "confirmation":
-        messages.append(("system", CONTEXT_ORDER_CONFIRMATION))
-    
-    # Add customer context if available
-    if state.get("customer") and state["customer"]:
-        customer_info = f"Datos del cliente en la base de datos: {state['customer']}"
-        messages.append(("system", customer_info))
-    else:
-        messages.append(("system", "IMPORTANTE: Este cliente NO está en la base de datos. NO inventes información sobre él."))
-    
-    # Add current order context if available
-    if state.get("active_order") and state["active_order"]:
-        order_info = f"Pedido activo actual: {state['active_order']}"
-        messages.append(("system", order_info))
-    
-    # Add conversation history from  memory
-    conversation_messages = []
-    for msg in state.get("messages", []):
-        if isinstance(msg, HumanMessage):
-            conversation_messages.append(("human", msg.content))
-        elif isinstance(msg, AIMessage):
-            conversation_messages.append(("assistant", msg.content))
-    
-    messages.extend(conversation_messages)
+    # Track what the prompt actually costs, and how much of it is the shared prefix
+    prompt_token_count = prompt_tokens.record(messages, static_tokens=prefix_tokens(messages[0][1]))
+    history_count = sum(1 for role, _ in messages if role != "system")
+    logger.info(f"Prompt for {state['user_id']}: ~{prompt_token_count} tokens, {history_count} history messages")
     
     return messages
 
@@ -269,7 +260,8 @@ def _build_conversation_context(state: ChatState) -> list:
 def _detect_user_intent(state: ChatState) -> str:
     """
     Detect user intent based on their last message.
-    Juan needs to distinguish between full menu requests vs specific queries.
+    Juan needs to distinguish between full menu requests vs specific queries
+    (keyword lists and priority live in intents.py).
     """
     if not state["messages"]:
         return "greeting"
@@ -278,60 +270,16 @@ def _detect_user_intent(state: ChatState) -> str:
     last_human_message = None
     for msg in reversed(state["messages"]):
         if isinstance(msg, HumanMessage):
-            last_human_message = msg.content.lower()
+            last_human_message = msg.content
             break
     
     if not last_human_message:
         return "greeting"
     
-    # Full menu request keywords (should send image)
-    full_menu_keywords = [
-        "menú completo", "menu completo", "el menú", "el menu", "ver el menú", "ver el menu",
-        "muéstrame el menú", "muestrame el menu", "envíame el menú", "enviame el menu",
-        "quiero ver el menú", "quiero ver el menu", "menú", "menu", "carta", "la carta",
-        "qué tienen", "que tienen", "qué hay", "que hay", "qué venden", "que venden",
-        "opciones", "productos", "comida", "pizzas tienen", "pizzas hay"
-    ]
-    
-    # Specific menu queries (should use database)
-    specific_menu_keywords = [
-        "precio de", "precios de", "cuesta la", "cuánto cuesta", "cuanto cuesta", 
-        "ingredientes de", "lleva la", "pizza de", "tamaño de", "tamaños de"
-    ]
-    
-    # Order-related keywords
-    order_keywords = [
-        "pedido", "orden", "comprar", "quiero una", "me gustaría una", "voy a pedir",
-        "hacer pedido", "ordenar", "pedir una"
-    ]
-    
-    # Confirmation keywords
-    confirmation_keywords = [
-        "confirmar", "listo", "perfecto", "sí", "si", "ok", "está bien", "esta bien"
-    ]
-    
-    # Check for specific menu queries first (more specific)
-    if any(keyword in last_human_message for keyword in specific_menu_keywords):
-        print(f"Detected menu")
-        return "menu"
-    
-    # Check for full menu request
-    if any(keyword in last_human_message for keyword in full_menu_keywords):
-        print(f"Detected full menu")
-        return "full_menu"
-    
-    # Check for order intent
-    if any(keyword in last_human_message for keyword in order_keywords):
-        print(f"Detected order")
-        return "order"
-    
-    # Check for confirmation
-    if any(keyword in last_human_message for keyword in confirmation_keywords):
-        print(f"Detected confirmation")
-        return "confirmation"
-    
-    print(f"Detected general")
-    return "general"
+    # One cached scan, shared with the state manager's step detection
+    intent = detect_intent(last_human_message)
+    logger.debug(f"Detected {intent}")
+    return intent
 
 
 def _update_state_from_response(state: ChatState, response: AIMessage) -> Dict[str, Any]:
@@ -348,6 +296,15 @@ def _update_state_from_response(state: ChatState, response: AIMessage) -> Dict[s
 # ROUTING LOGIC
 # =============================================================================
 
+def route_after_fast_path(state: ChatState) -> str:
+    """
+    Skip the LLM when route_node already answered.
+    """
+    if state["messages"] and isinstance(state["messages"][-1], AIMessage):
+        return "answered"
+    return "use_llm"
+
+
 def should_use_tools(state: ChatState) -> str:
     """
     Determine if we should use tools or end the conversation.
@@ -364,7 +321,7 @@ def should_use_tools(state: ChatState) -> str:
         return "save_and_end"
 
 
-def final_response_node(state: ChatState) -> Dict[str, Any]:
+async def final_response_node(state: ChatState) -> Dict[str, Any]:
     """
     Generate a final response after using tools, without allowing more tool calls.
     """
@@ -389,11 +346,9 @@ def final_response_node(state: ChatState) -> Dict[str, Any]:
             elif role == "assistant":
                 assistant_messages.append(AIMessage(content=content))
         
-        # Add instruction about using tool results that are already in the conversation
-        system_content.append("IMPORTANTE: Las herramientas ya se ejecutaron y sus resultados están en la conversación anterior. Usa EXACTAMENTE esos resultados para responder. Sigue las reglas de formato del CONTEXT_MENU_INQUIRY para respuestas concisas y bien organizadas. NO ejecutes más herramientas. NO inventes información.")
-        
-        # Add final instruction to system content
-        system_content.append("Genera una respuesta natural y humana basada en los resultados de las herramientas que ya se ejecutaron. Usa el formato optimizado para evitar respuestas muy largas. Si hay muchas pizzas, muestra solo algunos ejemplos y menciona que hay más opciones.")
+        # Instructions about using the tool results already in the conversation. They are
+        # static too, so they go right after the static prefix, before any customer data
+        system_content.insert(1, FINAL_RESPONSE_RULES)
         
         # Create final message list
         messages = [
@@ -403,7 +358,7 @@ def final_response_node(state: ChatState) -> Dict[str, Any]:
         messages.extend(assistant_messages)
         
         # Get AI response WITHOUT allowing tool calls
-        response = llm_without_tools.invoke(messages)
+        response = await llm_without_tools.ainvoke(messages)
         
         # Ensure response is properly formatted
         if hasattr(response, 'content'):
@@ -429,23 +384,21 @@ def final_response_node(state: ChatState) -> Dict[str, Any]:
             # Create a clean AIMessage with the formatted content
             response = AIMessage(content=response_content)
         
-        # Add AI response to messages
-        new_messages = list(state["messages"])
+        # Add AI response to messages (the reducer appends it)
         if not isinstance(response, AIMessage):
             response = AIMessage(content=str(response))
-        new_messages.append(response)
+        
+        # A reply built from read-only tools (search_menu) can be reused like any other
+        await response_cache.store(state, response)
         
         return {
-            "messages": new_messages
+            "messages": [response]
         }
         
     except Exception as e:
         logger.error(f"Error in final_response_node: {e}")
-        error_response = AIMessage(content=ERROR_GENERAL)
-        messages_list = list(state["messages"])
-        messages_list.append(error_response)
         return {
-            "messages": messages_list
+            "messages": [AIMessage(content=ERROR_GENERAL)]
         }
 
 
@@ -462,8 +415,9 @@ def create_graph():
     
     # Add nodes
     workflow.add_node("load_state", load_state_node)
+    workflow.add_node("route", route_node)
     workflow.add_node("conversation", conversation_node)
-    workflow.add_node("tools", ToolNode(ALL_TOOLS))
+    workflow.add_node("tools", tool_executor.node)  # Parallel reads, ordered writes (core/tool_executor.py)
     workflow.add_node("final_response", final_response_node)
     workflow.add_node("save_state", save_state_node)
     
@@ -471,7 +425,15 @@ def create_graph():
     workflow.set_entry_point("load_state")
     
     # Add edges
-    workflow.add_edge("load_state", "conversation")
+    workflow.add_edge("load_state", "route")
+    workflow.add_conditional_edges(
+        "route",
+        route_after_fast_path,
+        {
+            "answered": "save_state",
+            "use_llm": "conversation"
+        }
+    )
     workflow.add_conditional_edges(
         "conversation",
         should_use_tools,
@@ -485,8 +447,8 @@ def create_graph():
     workflow.add_edge("final_response", "save_state")
     workflow.add_edge("save_state", END)
     
-    # Compile with memory checkpointer
-    return workflow.compile(checkpointer=MemorySaver())
+    # Compile with the bounded checkpointer (latest checkpoint per thread only)
+    return workflow.compile(checkpointer=checkpointer)
 
 
 # Create the  graph
@@ -530,9 +492,13 @@ async def process_message(user_id: str, message: str) -> str:
             ready_to_order=False  # Will be determined by load_state_node
         )
         
-        # Process through  graph
+        # Process through  graph, one turn at a time per user: messages sent in
+        # quick succession are handled in order on the latest saved state.
+        # Customer and order rows are fetched once per turn (see core/loader.py)
         config = {"configurable": {"thread_id": user_id}}
-        final_state = await graph.ainvoke(initial_state, config=config)
+        async with memory.lock(user_id):
+            with request_scope():
+                final_state = await graph.ainvoke(initial_state, config=config)
         
         # Extract response - handle different content formats
         if final_state and "messages" in final_state and final_state["messages"]:
@@ -0,0 +1,160 @@
+"""
+Keyword intent matching shared by the graphs and the state manager.
+
+Every keyword list is compiled into one regex over lowercased, accent-folded
+text ("Menú" and "menu" are the same keyword). A text is scanned once and the
+set of keyword groups it contains is cached, so the graph node and the state
+manager looking at the same message, or the same history message turn after
+turn, never scan it twice.
+
+Matching is by substring, like the `keyword in text` checks it replaces.
+"""
+
+import logging
+import re
+import unicodedata
+from functools import lru_cache
+from typing import Dict, FrozenSet, Iterable, List
+
+logger = logging.getLogger(__name__)
+
+# Keyword groups. A text matches a group when it contains any of its keywords.
+KEYWORD_GROUPS: Dict[str, List[str]] = {
+    # Specific menu queries (answered from the database)
+    "specific_menu": [
+        "precio de", "precios de", "cuesta la", "cuánto cuesta", "cuanto cuesta",
+        "ingredientes de", "lleva la", "pizza de", "tamaño de", "tamaños de",
+    ],
+    # Full menu requests (answered with the menu image)
+    "full_menu": [
+        "menú completo", "menu completo", "el menú", "el menu", "ver el menú", "ver el menu",
+        "muéstrame el menú", "muestrame el menu", "envíame el menú", "enviame el menu",
+        "quiero ver el menú", "quiero ver el menu", "menú", "menu", "carta", "la carta",
+        "qué tienen", "que tienen", "qué hay", "que hay", "qué venden", "que venden",
+        "opciones", "productos", "comida", "pizzas tienen", "pizzas hay",
+    ],
+    "order": [
+        "pedido", "orden", "comprar", "quiero una", "me gustaría una", "voy a pedir",
+        "hacer pedido", "ordenar", "pedir una",
+    ],
+    "confirmation": [
+        "confirmar", "listo", "perfecto", "sí", "si", "ok", "está bien", "esta bien",
+    ],
+    # Conversation step hints (ChatStateManager._determine_current_step)
+    "step_menu": ["menú", "menu", "pizzas", "precios", "qué tienen"],
+    "step_order": ["ordenar", "pedido", "quiero", "pizza"],
+    "recent_order": ["pedido", "orden", "pizza"],
+    "recent_menu": ["menú", "menu", "precios"],
+    # Catalog lookups the menu fast path can answer (see core/catalog.py)
+    "ask_price": [
+        "precio", "cuánto cuesta", "cuanto cuesta", "cuánto vale", "cuanto vale", "qué valor",
+        "que valor", "valor de", "cuesta la", "cuesta el", "vale la", "vale el",
+    ],
+    "ask_ingredients": [
+        "ingredientes", "qué lleva", "que lleva", "lleva la", "lleva el", "qué trae", "que trae",
+        "trae la", "trae el", "de qué es", "de que es",
+    ],
+}
+
+# Checked in this order; the first group present decides the intent
+INTENT_PRIORITY = (
+    ("specific_menu", "menu"),
+    ("full_menu", "full_menu"),
+    ("order", "order"),
+    ("confirmation", "confirmation"),
+)
+
+
+# Combining diacritical marks left over after NFD decomposition ("á" -> "a" + U+0301)
+_COMBINING = re.compile("[\u0300-\u036f]")
+
+
+def normalize(text: str) -> str:
+    """Lowercase and strip accents: "¿Cuánto CUESTA?" -> "¿cuanto cuesta?"."""
+    text = text.lower()
+    if text.isascii():
+        return text
+    return _COMBINING.sub("", unicodedata.normalize("NFD", text))
+
+
+def _trie_pattern(keywords: Iterable[str]) -> str:
+    """
+    Alternation factored by common prefixes ("pedi(do|r una)"), so the regex engine
+    rejects most positions on the first character instead of trying every keyword.
+    Longer continuations come first, so the longest keyword at a position wins.
+    """
+    trie: Dict[str, dict] = {}
+    for keyword in keywords:
+        node = trie
+        for char in keyword:
+            node = node.setdefault(char, {})
+        node[""] = {}  # End of a keyword
+
+    def build(node: Dict[str, dict]) -> str:
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        branches.sort(key=len, reverse=True)
+        if "" in node:
+            branches.append("")
+        if len(branches) == 1:
+            return branches[0]
+        return "(?:" + "|".join(branches) + ")"
+
+    return build(trie)
+
+
+def _compile(groups: Dict[str, List[str]]):
+    keyword_groups: Dict[str, set] = {}
+    for group, keywords in groups.items():
+        for keyword in keywords:
+            keyword_groups.setdefault(normalize(keyword), set()).add(group)
+    # Only one keyword is reported per position (the longest), so each keyword also
+    # carries the groups of every shorter keyword it starts with
+    for keyword, owners in keyword_groups.items():
+        for other, other_owners in keyword_groups.items():
+            if other != keyword and keyword.startswith(other):
+                owners |= other_owners
+    pattern = re.compile(_trie_pattern(keyword_groups))
+    return pattern, {keyword: frozenset(owners) for keyword, owners in keyword_groups.items()}
+
+
+_PATTERN, _KEYWORD_GROUPS = _compile(KEYWORD_GROUPS)
+
+
+@lru_cache(maxsize=4096)
+def match_groups(text: str) -> FrozenSet[str]:
+    """Keyword groups found in `text`, computed once per distinct text."""
+    found: set = set()
+    text = normalize(text)
+    search = _PATTERN.search
+    match = search(text)
+    while match is not None:
+        found |= _KEYWORD_GROUPS[match.group()]
+        # Resume one character later, not after the match, so overlapping keywords are all seen
+        match = search(text, match.start() + 1)
+    return frozenset(found)
+
+
+def detect_intent(text: str) -> str:
+    """"menu", "full_menu", "order", "confirmation" or "general"."""
+    groups = match_groups(text)
+    for group, intent in INTENT_PRIORITY:
+        if group in groups:
+            return intent
+    return "general"
+
+
+def determine_step(message: str, recent: Iterable[str]) -> str:
+    """Conversation step from the new message, falling back to recent history."""
+    groups = match_groups(message)
+    if "step_menu" in groups:
+        return "menu"
+    if "step_order" in groups:
+        return "order"
+    recent_groups: set = set()
+    for content in recent:
+        recent_groups |= match_groups(content)
+    if "recent_order" in recent_groups:
+        return "order"
+    if "recent_menu" in recent_groups:
+        return "menu"
+    return "general"
@@ -0,0 +1,143 @@
+"""
+Request-scoped lookup memo.
+
+One message touches the same rows several times: hydration loads the customer
+and the active order, get_active_order looks the customer up again, and the
+order tools do both once more. Inside `request_scope()` each (kind, key) is
+fetched at most once; a lookup that finds the same key already in flight waits
+for it instead of issuing its own query. Writes prime or invalidate the keys
+they touch, so a tool never reads a row older than its own update.
+
+The scope lives in a ContextVar, so it follows the request across graph nodes,
+asyncio tasks and the worker threads sync tools run in. Outside a scope every
+lookup goes straight to the database.
+"""
+
+import contextvars
+import logging
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Hashable, Iterator, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class RequestLoader:
+    """Memoized lookups for one request. Thread-safe: tools run on worker threads."""
+
+    def __init__(self):
+        self._values: Dict[Tuple[str, Hashable], Any] = {}
+        self._in_flight: Dict[Tuple[str, Hashable], Future] = {}
+        self._lock = threading.Lock()
+        self.queries = 0  # Lookups that reached the database
+        self.saved = 0  # Lookups answered from the memo or an in-flight query
+
+    def load(self, kind: str, key: Hashable, fetch: Callable[[], Any]) -> Any:
+        """Return the value for (kind, key), calling `fetch` only if nobody has yet."""
+        slot = (kind, key)
+        with self._lock:
+            value = self._values.get(slot, _MISSING)
+            if value is not _MISSING:
+                self.saved += 1
+                return value
+            pending = self._in_flight.get(slot)
+            waiting = pending is not None
+            if waiting:
+                self.saved += 1
+            else:
+                pending = self._in_flight[slot] = Future()
+        if waiting:
+            return pending.result()
+
+        try:
+            value = fetch()
+        except BaseException as e:
+            with self._lock:
+                self.queries += 1
+                if self._in_flight.get(slot) is pending:
+                    del self._in_flight[slot]
+            pending.set_exception(e)  # Failures are not memoized; waiters see the same error
+            raise
+        with self._lock:
+            self.queries += 1
+            if self._in_flight.get(slot) is pending:  # Not invalidated while fetching
+                del self._in_flight[slot]
+                self._values[slot] = value
+        pending.set_result(value)
+        return value
+
+    def prime(self, kind: str, key: Hashable, value: Any):
+        """Store a value the caller just wrote, so later lookups need no query."""
+        with self._lock:
+            self._in_flight.pop((kind, key), None)
+            self._values[(kind, key)] = value
+
+    def invalidate(self, kind: str, key: Hashable):
+        """Forget (kind, key): the next lookup queries again."""
+        with self._lock:
+            self._in_flight.pop((kind, key), None)
+            self._values.pop((kind, key), None)
+
+
+class LoaderMeter:
+    """Running totals over finished request scopes."""
+
+    def __init__(self):
+        self.requests = 0
+        self.queries = 0
+        self.saved = 0
+
+    def record(self, loader: RequestLoader):
+        self.requests += 1
+        self.queries += loader.queries
+        self.saved += loader.saved
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.queries + self.saved
+        return {
+            "requests": self.requests,
+            "queries": self.queries,
+            "queries_saved": self.saved,
+            "saved_ratio": round(self.saved / lookups, 4) if lookups else 0.0,
+            "avg_queries_per_request": round(self.queries / self.requests, 2) if self.requests else 0.0,
+        }
+
+
+_current: contextvars.ContextVar[Optional[RequestLoader]] = contextvars.ContextVar("request_loader", default=None)
+
+
+@contextmanager
+def request_scope() -> Iterator[RequestLoader]:
+    """`with request_scope():` memoizes lookups until the block exits."""
+    loader = RequestLoader()
+    token = _current.set(loader)
+    try:
+        yield loader
+    finally:
+        _current.reset(token)
+        request_loads.record(loader)
+
+
+def load(kind: str, key: Hashable, fetch: Callable[[], Any]) -> Any:
+    """Memoized lookup inside a request scope, a plain `fetch()` outside one."""
+    loader = _current.get()
+    return fetch() if loader is None else loader.load(kind, key, fetch)
+
+
+def prime(kind: str, key: Hashable, value: Any):
+    loader = _current.get()
+    if loader is not None:
+        loader.prime(kind, key, value)
+
+
+def invalidate(kind: str, key: Hashable):
+    loader = _current.get()
+    if loader is not None:
+        loader.invalidate(kind, key)
+
+
+# Global instance
+request_loads = LoaderMeter()
@@ -0,0 +1,126 @@
+"""
+Per-key async locks.
+
+Used to serialize the turns of one conversation: several requests for the same
+thread run one after another in arrival order (asyncio.Lock is FIFO), while
+different threads never wait on each other. A key's lock exists only while
+someone holds or waits for it, so idle threads leave nothing behind.
+
+The locks are per process. With several uvicorn workers, route a user's
+requests to one worker (e.g. by user_id) to get the same guarantee.
+"""
+
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Hashable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class _Entry:
+    __slots__ = ("lock", "users")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0  # Holder plus waiters
+
+
+def _abandon(lock: asyncio.Lock, acquire: asyncio.Future):
+    """Cancel a pending acquire; if it wins the lock anyway, hand the lock back."""
+    acquire.cancel()
+    acquire.add_done_callback(
+        lambda task: lock.release() if not task.cancelled() and task.exception() is None else None
+    )
+
+
+class KeyedLock:
+    """A lazily created asyncio.Lock per key, dropped as soon as nobody uses it."""
+
+    def __init__(self, name: str, timeout: Optional[float] = None):
+        self.name = name
+        self.timeout = timeout  # Max seconds to wait for a key; None waits forever
+        self._entries: Dict[Hashable, _Entry] = {}
+
+        self.acquisitions = 0
+        self.contended = 0  # Acquisitions that had to wait for another turn
+        self.timeouts = 0
+        self.max_waiters = 0
+        self.total_wait = 0.0
+
+    @asynccontextmanager
+    async def hold(self, key: Hashable) -> AsyncIterator[None]:
+        """`async with locks.hold(key):` runs the block exclusively for `key`."""
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = _Entry()
+        entry.users += 1
+        if entry.users > 1:
+            self.contended += 1
+            self.max_waiters = max(self.max_waiters, entry.users - 1)
+
+        started = time.perf_counter()
+        try:
+            if self.timeout is None:
+                await entry.lock.acquire()
+            else:
+                try:
+                    await self._acquire_within(entry.lock, self.timeout)
+                except asyncio.TimeoutError:
+                    self.timeouts += 1
+                    logger.warning(f"Timed out after {self.timeout}s waiting for {self.name} lock {key}")
+                    raise
+        except BaseException:
+            self._release_user(key, entry)
+            raise
+
+        self.acquisitions += 1
+        self.total_wait += time.perf_counter() - started
+        try:
+            yield
+        finally:
+            entry.lock.release()
+            self._release_user(key, entry)
+
+    @staticmethod
+    async def _acquire_within(lock: asyncio.Lock, timeout: float):
+        """
+        lock.acquire() giving up after `timeout` seconds (asyncio.TimeoutError).
+        Unlike wait_for on Python < 3.12, an acquire that completes just as the
+        timeout fires never leaves the lock held with no owner: an abandoned
+        acquire that still wins the lock releases it straight away.
+        """
+        acquire = asyncio.ensure_future(lock.acquire())
+        try:
+            done, _ = await asyncio.wait((acquire,), timeout=timeout)
+        except BaseException:  # Cancelled while waiting
+            _abandon(lock, acquire)
+            raise
+        if not done:
+            _abandon(lock, acquire)
+            raise asyncio.TimeoutError()
+        acquire.result()
+
+    def _release_user(self, key: Hashable, entry: _Entry):
+        entry.users -= 1
+        if entry.users == 0 and self._entries.get(key) is entry:
+            del self._entries[key]
+
+    def locked(self, key: Hashable) -> bool:
+        entry = self._entries.get(key)
+        return entry is not None and entry.lock.locked()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "active_keys": len(self._entries),
+            "acquisitions": self.acquisitions,
+            "contended": self.contended,
+            "timeouts": self.timeouts,
+            "max_waiters": self.max_waiters,
+            "avg_wait_ms": round(self.total_wait / self.acquisitions * 1000, 3) if self.acquisitions else 0.0,
+        }
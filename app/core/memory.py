@@ -3,127 +3,546 @@
 Implements hybrid approach: key context + recent messages with intelligent cleanup.
 """
 
+import asyncio
+import copy
 import json
 import logging
+import sys
+import time
+from collections import deque
 from datetime import datetime, timezone, timedelta
-from typing import Dict, List, Any, Optional
+from typing import Deque, Dict, FrozenSet, Iterable, List, Any, NamedTuple, Optional, Set
 from langchain_core.messages import BaseMessage, HumanMessage, AIMessage
 
-from ..config import supabase
+from ..config import (
+    MEMORY_CACHE_MAX_ENTRIES, MEMORY_CACHE_MAX_BYTES, MEMORY_CACHE_TTL_MINUTES,
+    MEMORY_STORAGE_MODE, MEMORY_MAX_MESSAGES, MEMORY_MAX_MESSAGE_TOKENS, MEMORY_SUMMARIZER,
+    MEMORY_INVALIDATION_CHANNEL, MEMORY_INVALIDATION_PORTS, MEMORY_REVALIDATE_SECONDS,
+    MEMORY_BACKEND, MEMORY_SQLITE_PATH, MEMORY_RETENTION_DAYS, MEMORY_CODEC, MEMORY_TURN_LOCK_TIMEOUT,
+    MEMORY_SNAPSHOT_PATH, MEMORY_SNAPSHOT_MAX_AGE_MINUTES
+)
+from .cache import LRUCache
+from .codecs import Codec, CodecError, decode, get_codec
+from .coherence import InvalidationChannel, build_channel
+from .locks import KeyedLock
+from .snapshot import CacheSnapshot, write_snapshot
+from .memory_backends import MemoryBackend, VersionConflict, build_backend
+from .summarizer import Summarizer, build_summarizer
+from .tokens import estimate_tokens, get_token_budget, truncate_to_tokens
 
 logger = logging.getLogger(__name__)
 
+# Layout of ConversationContext.to_record(); bump when it changes
+CONTEXT_SCHEMA_VERSION = 1
+
+
+class StoredMessage(NamedTuple):
+    """One message in the window. A plain tuple: no per-instance dict, epoch-float timestamp."""
+    seq: int
+    role: str  # "human" or "assistant"
+    content: str
+    ts: float  # Unix epoch seconds (UTC)
+    tokens: int  # Estimated prompt tokens, computed once
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "role": self.role,
+            "content": self.content,
+            "timestamp": _format_timestamp(self.ts),
+            "seq": self.seq,
+            "tokens": self.tokens
+        }
+
+
+def _parse_timestamp(value: Any) -> float:
+    """Parse an ISO string (or epoch number) from storage into epoch seconds."""
+    if value is None:
+        return time.time()
+    if isinstance(value, (int, float)):
+        return float(value)
+    # Python 3.11+ parses the "Z" suffix natively; no intermediate string copy
+    return datetime.fromisoformat(value).timestamp()
+
+
+def _format_timestamp(ts: float) -> str:
+    return datetime.fromtimestamp(ts, timezone.utc).isoformat()
+
+
+def make_stored_message(seq: int, role: Optional[str], content: str, ts: float,
+                        tokens: Optional[int] = None) -> StoredMessage:
+    """Build a StoredMessage, estimating its tokens unless already known."""
+    return StoredMessage(
+        seq,
+        "human" if role == "human" else "assistant",
+        content,
+        ts,
+        tokens if tokens is not None else estimate_tokens(content)
+    )
+
 
 class ConversationContext:
-    """Represents the context of a conversation with intelligent data management."""
+    """
+    Represents the context of a conversation with intelligent data management.
+    
+    Slotted to keep per-conversation overhead small: messages live in a fixed-capacity
+    ring buffer of StoredMessage tuples, and the LangChain message objects built from
+    them are cached until the window changes.
+    
+    The window is sized by a token budget rather than a message count; max_messages
+    is only a hard cap on the ring buffer.
+    
+    Changes are tracked per column: a save writes only the columns that changed
+    since the context was loaded or last saved, and nothing at all when none did.
+    """
+    
+    # Optional row columns; thread_id, last_activity and version are always written
+    ROW_FIELDS = ("recent_messages", "customer_context", "session_metadata", "created_at")
+    
+    max_messages = MEMORY_MAX_MESSAGES  # Ring buffer capacity
+    token_budget = get_token_budget()  # Prompt tokens the history may use
+    min_messages = 2  # The latest exchange is always kept, whatever its size
+    
+    __slots__ = (
+        "thread_id", "customer_context", "session_metadata",
+        "_window", "_window_tokens", "_llm_messages", "_last_activity", "_created_at",
+        "next_seq", "pending_messages", "evicted_messages",
+        "version", "validated_at", "_dirty",
+    )
     
     def __init__(self, thread_id: str):
+        now = time.time()
         self.thread_id = thread_id
         self.customer_context: Dict[str, Any] = {}
-        self.recent_messages: List[Dict[str, Any]] = []
         self.session_metadata: Dict[str, Any] = {}
-        self.last_activity = datetime.now(timezone.utc)
-        self.created_at = datetime.now(timezone.utc)
+        self._window: Deque[StoredMessage] = deque(maxlen=self.max_messages)
+        self._window_tokens = 0
+        self._llm_messages: Optional[List[BaseMessage]] = None
+        self._last_activity = now
+        self._created_at = now
+        
+        # Row version stamp (bumped on every save) and when this copy was last known current
+        self.version = 0
+        self.validated_at = now
+        
+        # Append-only log bookkeeping: next sequence number and messages not yet persisted
+        self.next_seq = 0
+        self.pending_messages: List[StoredMessage] = []
+        # Messages that left the window and still have to be folded into the summary
+        self.evicted_messages: List[StoredMessage] = []
+        
+        # Columns changed since the last load/save; a new conversation has no row yet
+        self._dirty: Set[str] = set(self.ROW_FIELDS)
+    
+    @property
+    def last_activity(self) -> datetime:
+        return datetime.fromtimestamp(self._last_activity, timezone.utc)
+    
+    @last_activity.setter
+    def last_activity(self, value: datetime):
+        self._last_activity = value.timestamp()
+    
+    @property
+    def created_at(self) -> datetime:
+        return datetime.fromtimestamp(self._created_at, timezone.utc)
+    
+    @created_at.setter
+    def created_at(self, value: datetime):
+        self._created_at = value.timestamp()
+    
+    @property
+    def messages(self) -> Deque[StoredMessage]:
+        """The message window, oldest first. Read-only by convention."""
+        return self._window
+    
+    @property
+    def summary(self) -> str:
+        """Rolling summary of the history older than the window."""
+        return self.session_metadata.get("summary", "")
+    
+    @property
+    def summarized_through(self) -> int:
+        """Highest seq already folded into the summary (-1 if none)."""
+        return self.session_metadata.get("summary_through_seq", -1)
+    
+    def apply_summary(self, summary: str, through_seq: int):
+        """Store a new rolling summary covering every message up to through_seq."""
+        self.session_metadata["summary"] = summary
+        self.session_metadata["summary_through_seq"] = through_seq
+        self._dirty.add("session_metadata")
+    
+    @property
+    def window_tokens(self) -> int:
+        """Estimated prompt tokens of the current window."""
+        return self._window_tokens
+    
+    @property
+    def recent_messages(self) -> List[Dict[str, Any]]:
+        """The message window in its storage format (list of dicts)."""
+        return [msg.to_dict() for msg in self._window]
+    
+    @recent_messages.setter
+    def recent_messages(self, messages: List[Dict[str, Any]]):
+        # Rows written before messages carried a seq are numbered by position
+        self.set_window(
+            make_stored_message(
+                msg_data.get("seq", position),
+                msg_data.get("role"),
+                msg_data.get("content") or "",
+                _parse_timestamp(msg_data.get("timestamp")),
+                msg_data.get("tokens")
+            )
+            for position, msg_data in enumerate(messages)
+        )
+    
+    def set_window(self, messages: Iterable[StoredMessage]):
+        """Replace the window, trim it to the budget and resync next_seq."""
+        self._window = deque(messages, maxlen=self.max_messages)
+        self._window_tokens = sum(msg.tokens for msg in self._window)
+        self._llm_messages = None
+        self._dirty.add("recent_messages")
+        self.next_seq = self._window[-1].seq + 1 if self._window else 0
+        self._trim_to_budget()
     
     def add_message(self, message: BaseMessage):
-        """Add a message to recent messages with intelligent size management."""
-        message_data = {
-            "role": "human" if isinstance(message, HumanMessage) else "assistant",
-            "content": message.content,
-            "timestamp": datetime.now(timezone.utc).isoformat()
-        }
-        
-        self.recent_messages.append(message_data)
-        self.last_activity = datetime.now(timezone.utc)
+        """Add a message to the window and trim the window to the token budget."""
+        now = time.time()
+        stored = make_stored_message(
+            self.next_seq,
+            "human" if isinstance(message, HumanMessage) else "assistant",
+            message.content,
+            now
+        )
+        self.next_seq += 1
         
-        # Keep only the most recent messages (sliding window)
-        max_messages = 12
-        if len(self.recent_messages) > max_messages:
-            # Remove oldest messages but keep the first message if it's important
-            if len(self.recent_messages) > max_messages + 2:
-                self.recent_messages = self.recent_messages[-max_messages:]
+        if len(self._window) == self._window.maxlen:
+            # The ring buffer is about to drop its oldest entry
+            self._evict(self._window[0])
+        self._window.append(stored)
+        self._window_tokens += stored.tokens
+        self.pending_messages.append(stored)
+        self._llm_messages = None
+        self._dirty.add("recent_messages")
+        self._last_activity = now
+        self._trim_to_budget()
     
-    def update_customer_context(self, key: str, value: Any):
-        """Update customer context with key information."""
-        self.customer_context[key] = value
-        self.last_activity = datetime.now(timezone.utc)
+    def _trim_to_budget(self):
+        """
+        Evict messages until the window fits token_budget.
+        Each candidate costs tokens × age (distance from the newest message), so long
+        menu replies go before short confirmations, and old short messages still age out.
+        """
+        window = self._window
+        while self._window_tokens > self.token_budget and len(window) > self.min_messages:
+            newest = len(window) - 1
+            candidates = range(len(window) - self.min_messages)
+            victim = max(candidates, key=lambda i: (window[i].tokens * (newest - i), -i))
+            self._evict(window[victim])
+            del window[victim]
+            self._llm_messages = None
+            self._dirty.add("recent_messages")
+    
+    def _evict(self, msg: StoredMessage):
+        """Account for a message leaving the window and queue it for summarization."""
+        self._window_tokens -= msg.tokens
+        if msg.seq > self.summarized_through:
+            self.evicted_messages.append(msg)
+    
+    def update_customer_context(self, key: str, value: Any) -> bool:
+        """
+        Update customer context with key information.
+        Returns False (and marks nothing dirty) when the stored value is already equal.
+        """
+        if key in self.customer_context and self.customer_context[key] == value:
+            return False
+        # Copied so later in-place changes to the caller's dict are not mistaken for stored state
+        self.customer_context[key] = copy.deepcopy(value)
+        self._dirty.add("customer_context")
+        self._last_activity = time.time()
+        return True
+    
+    @property
+    def dirty_fields(self) -> FrozenSet[str]:
+        """Row columns changed since the last load or save."""
+        return frozenset(self._dirty)
+    
+    def take_dirty(self) -> FrozenSet[str]:
+        """Return the changed columns and mark them clean (restore them with mark_dirty if the save fails)."""
+        fields = frozenset(self._dirty)
+        self._dirty.clear()
+        return fields
+    
+    def mark_dirty(self, fields: Iterable[str]):
+        self._dirty.update(fields)
+    
+    def message_id(self, seq: int) -> str:
+        """Stable id of a stored message, so graph state can be diffed against the window."""
+        return f"{self.thread_id}:{seq}"
     
     def get_messages_for_llm(self) -> List[BaseMessage]:
-        """Convert recent messages back to LangChain format."""
-        messages = []
-        for msg_data in self.recent_messages:
-            if msg_data["role"] == "human":
-                messages.append(HumanMessage(content=msg_data["content"]))
-            else:
-                messages.append(AIMessage(content=msg_data["content"]))
-        return messages
+        """Convert recent messages back to LangChain format (cached until the window changes)."""
+        if self._llm_messages is None:
+            self._llm_messages = [
+                HumanMessage(content=msg.content, id=self.message_id(msg.seq)) if msg.role == "human"
+                else AIMessage(content=msg.content, id=self.message_id(msg.seq))
+                for msg in self._window
+            ]
+        return list(self._llm_messages)
     
-    def to_dict(self) -> Dict[str, Any]:
-        """Serialize context for storage."""
-        return {
+    def to_dict(self, include_messages: bool = True, fields: Optional[Iterable[str]] = None) -> Dict[str, Any]:
+        """
+        Serialize context for storage.
+        With include_messages=False the message window is left out (append-log mode).
+        `fields` narrows the row to those ROW_FIELDS columns (a partial upsert).
+        """
+        columns = set(self.ROW_FIELDS if fields is None else fields)
+        data = {
             "thread_id": self.thread_id,
-            "customer_context": self.customer_context,
-            "recent_messages": self.recent_messages,
-            "session_metadata": self.session_metadata,
-            "last_activity": self.last_activity.isoformat(),
-            "created_at": self.created_at.isoformat()
+            "last_activity": _format_timestamp(self._last_activity),
+            "version": self.version
         }
+        if "customer_context" in columns:
+            data["customer_context"] = self.customer_context
+        if "session_metadata" in columns:
+            data["session_metadata"] = self.session_metadata
+        if "created_at" in columns:
+            data["created_at"] = _format_timestamp(self._created_at)
+        if include_messages and "recent_messages" in columns:
+            data["recent_messages"] = self.recent_messages
+        return data
     
     @classmethod
     def from_dict(cls, data: Dict[str, Any]) -> 'ConversationContext':
         """Deserialize context from storage."""
         context = cls(data["thread_id"])
         context.customer_context = data.get("customer_context", {})
-        context.recent_messages = data.get("recent_messages", [])
-        context.session_metadata = data.get("session_metadata", {})
+        # Metadata first: trimming the window checks what the summary already covers
+        context.session_metadata = data.get("session_metadata") or {}
+        context.recent_messages = data.get("recent_messages") or []
         
         if "last_activity" in data:
-            context.last_activity = datetime.fromisoformat(data["last_activity"].replace('Z', '+00:00'))
+            context._last_activity = _parse_timestamp(data["last_activity"])
         if "created_at" in data:
-            context.created_at = datetime.fromisoformat(data["created_at"].replace('Z', '+00:00'))
+            context._created_at = _parse_timestamp(data["created_at"])
+        context.version = data.get("version") or 0
+        context._dirty.clear()
         
         return context
+    
+    def to_record(self) -> List[Any]:
+        """
+        Compact positional form for binary codecs: epoch-float timestamps and
+        message tuples, so encoding and decoding never touch ISO strings.
+        """
+        return [
+            self.thread_id,
+            self.customer_context,
+            self.session_metadata,
+            self._last_activity,
+            self._created_at,
+            self.version,
+            [[msg.seq, 0 if msg.role == "human" else 1, msg.content, msg.ts, msg.tokens] for msg in self._window]
+        ]
+    
+    @classmethod
+    def from_record(cls, record: List[Any]) -> 'ConversationContext':
+        """Inverse of to_record()."""
+        thread_id, customer_context, session_metadata, last_activity, created_at, version, messages = record
+        context = cls(thread_id)
+        context.customer_context = customer_context
+        context.session_metadata = session_metadata
+        context.set_window(
+            StoredMessage(seq, "human" if role == 0 else "assistant", content, ts, tokens)
+            for seq, role, content, ts, tokens in messages
+        )
+        context._last_activity = last_activity
+        context._created_at = created_at
+        context.version = version
+        context._dirty.clear()
+        return context
+    
+    def encode(self, codec: Optional[Codec] = None) -> bytes:
+        """Serialize to a self-describing blob (see codecs.py)."""
+        return (codec or get_codec(MEMORY_CODEC)).encode(self.to_record(), CONTEXT_SCHEMA_VERSION)
+    
+    @classmethod
+    def decode(cls, blob: bytes) -> 'ConversationContext':
+        """Deserialize a blob written by encode(), whatever codec wrote it."""
+        schema_version, record = decode(blob)
+        if schema_version != CONTEXT_SCHEMA_VERSION:
+            raise CodecError(f"Unsupported context schema version {schema_version}")
+        return cls.from_record(record)
+    
+    def mark_saved(self):
+        """Forget messages that are now persisted."""
+        self.pending_messages = []
+    
+    def approx_size(self) -> int:
+        """
+        Cheap estimate of the bytes this context holds, used for cache budgeting.
+        Per-object costs are measured with tracemalloc (the "memory" benchmark compares
+        the estimate with the real allocation); string sizes come from sys.getsizeof, so
+        accented text and emoji count at their real width.
+        """
+        size = 1450  # Slotted object, deque, dicts and sets of an empty context
+        for messages in (self._window, self.evicted_messages):
+            for msg in messages:
+                size += 140 + sys.getsizeof(msg.content)  # Tuple, seq, ts, tokens and the content string
+        if self._llm_messages is not None:
+            size += 870 * len(self._llm_messages)  # Message objects; their content is shared with the window
+        size += 64 * (len(self.customer_context) + len(self.session_metadata))
+        for value in self.customer_context.values():
+            size += sys.getsizeof(str(value))
+        return size
+
+
+class ConversationTurn:
+    """
+    Unit of work for one chat turn.
+    Collects the turn's messages and context changes and flushes them with a single save.
+    """
+    
+    def __init__(self, manager: "MemoryManager", thread_id: str):
+        self.manager = manager
+        self.thread_id = thread_id
+        self.messages: List[BaseMessage] = []
+        self.context_updates: Dict[str, Any] = {}
+        self.requested_writes = 0  # Saves the per-call API would have issued
+        self.committed = False
+    
+    def add_message(self, message: BaseMessage):
+        """Queue a message for this turn."""
+        self.messages.append(message)
+        self.requested_writes += 1
+    
+    def update_customer_context(self, key: str, value: Any):
+        """Queue a customer context change for this turn. Later values win."""
+        self.context_updates[key] = value
+        self.requested_writes += 1
+    
+    async def commit(self) -> Dict[str, int]:
+        """
+        Apply everything queued and save the conversation once.
+        Returns how many writes were issued and how many were saved (both 0 if the save failed).
+        """
+        if self.committed:
+            return {"writes": 0, "writes_saved": 0}
+        self.committed = True
+        
+        if not self.requested_writes:
+            return {"writes": 0, "writes_saved": 0}
+        
+        context = await self.manager.get_conversation(self.thread_id)
+        for message in self.messages:
+            self.manager._truncate_message(self.thread_id, message)
+            context.add_message(message)
+        for key, value in self.context_updates.items():
+            context.update_customer_context(key, value)
+        
+        has_changes = bool(context.dirty_fields or context.pending_messages)
+        writes = 1 if await self.manager.save_conversation(context) else 0
+        if has_changes and not writes:
+            # The save failed: nothing was written, and nothing was saved by coalescing either
+            logger.warning(f"Turn for {self.thread_id} was not saved")
+            return {"writes": 0, "writes_saved": 0}
+        
+        writes_saved = self.requested_writes - writes
+        self.manager.writes_saved += writes_saved
+        logger.info(f"Committed turn for {self.thread_id}: {len(self.messages)} messages, "
+                    f"{len(self.context_updates)} context updates, {writes_saved} writes saved")
+        return {"writes": writes, "writes_saved": writes_saved}
+    
+    async def __aenter__(self) -> "ConversationTurn":
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        # Only persist turns that completed; a failed turn leaves memory untouched
+        if exc_type is None:
+            await self.commit()
 
 
 class MemoryManager:
     """
     Intelligent memory manager for multi-user conversations.
-    Uses hybrid approach with Supabase for persistent storage.
+    Uses hybrid approach with a pluggable storage backend (Supabase by default).
     """
     
-    def __init__(self):
-        self.table_name = "conversation_memory"
-        self.ttl_days = 7  # Auto-cleanup after 7 days of inactivity
-        self.max_message_length = 1000  # Truncate very long messages
+    def __init__(self, backend: Optional[MemoryBackend] = None):
+        # Where rows live: Supabase, SQLite or in-process (see memory_backends.py)
+        self.backend = backend or build_backend(MEMORY_BACKEND, MEMORY_SQLITE_PATH, MEMORY_CODEC)
+        # "snapshot" rewrites recent_messages on every save; "append_log" inserts
+        # each message once into the message log (see database/message_log_schema.sql)
+        self.storage_mode = MEMORY_STORAGE_MODE
+        self.ttl_days = MEMORY_RETENTION_DAYS  # Auto-cleanup after N days of inactivity (default 7)
+        self.max_message_tokens = MEMORY_MAX_MESSAGE_TOKENS  # Truncate very long messages
+        
+        # Bounded in-memory cache for active conversations
+        self._cache: LRUCache[ConversationContext] = LRUCache(
+            "conversations",
+            max_entries=MEMORY_CACHE_MAX_ENTRIES,
+            max_bytes=MEMORY_CACHE_MAX_BYTES,
+            ttl_seconds=MEMORY_CACHE_TTL_MINUTES * 60,
+            sizeof=ConversationContext.approx_size,
+        )
+        
+        # Upserts avoided by coalescing turns (see ConversationTurn)
+        self.writes_saved = 0
+        # Saves skipped because nothing changed, and unchanged columns left out of saves
+        self.writes_skipped = 0
+        self.columns_skipped = 0
+        
+        # Folds evicted history into session_metadata["summary"] in the background
+        self.summarizer: Optional[Summarizer] = build_summarizer(MEMORY_SUMMARIZER)
+        self._summarizing: set = set()
+        self._background_tasks: set = set()
+        
+        # Cross-worker coherence: version-stamped rows plus an invalidation channel
+        self.channel: Optional[InvalidationChannel] = build_channel(
+            MEMORY_INVALIDATION_CHANNEL, MEMORY_INVALIDATION_PORTS
+        )
+        self.revalidate_after = MEMORY_REVALIDATE_SECONDS
+        self._channel_started = False
+        self.invalidations = 0
+        self.revalidations = 0
+        self.stale_reloads = 0
+        # Saves that found the row already moved on by another worker (see _rebase)
+        self.save_conflicts = 0
+        # Saves of one thread never overlap (a turn and a background summary share the context)
+        self.save_locks = KeyedLock("conversation_saves")
         
-        # In-memory cache for active conversations (optional optimization)
-        self._cache: Dict[str, ConversationContext] = {}
-        self._cache_ttl = timedelta(minutes=30)
+        # One turn at a time per thread; other threads run in parallel
+        self.turn_locks = KeyedLock("conversation_turns", timeout=MEMORY_TURN_LOCK_TIMEOUT or None)
+        
+        # Warm start across restarts (see snapshot.py)
+        self.snapshot_path = MEMORY_SNAPSHOT_PATH
+        self.snapshot_max_age = MEMORY_SNAPSHOT_MAX_AGE_MINUTES * 60
+        self._snapshot: Optional[CacheSnapshot] = None
+        self.snapshot_restored = 0
+        self.snapshot_stale = 0
     
     async def get_conversation(self, thread_id: str) -> ConversationContext:
         """
         Get conversation context. Creates new if doesn't exist.
         """
         try:
-            # Check cache first
-            if thread_id in self._cache:
-                cached_context = self._cache[thread_id]
-                # Check if cache is still valid
-                if datetime.now(timezone.utc) - cached_context.last_activity < self._cache_ttl:
-                    logger.info(f"Retrieved conversation from cache: {thread_id}")
-                    return cached_context
-                else:
-                    # Cache expired
-                    del self._cache[thread_id]
+            await self._ensure_channel()
+            
+            # Check cache first (expired entries are swept by the cache itself)
+            cached_context = self._cache.get(thread_id)
+            if cached_context is not None and await self._is_current(cached_context):
+                logger.info(f"Retrieved conversation from cache: {thread_id}")
+                return cached_context
+            
+            # Warm start: the copy cached before the last restart, if still current
+            context = await self._restore_from_snapshot(thread_id)
             
             # Load from database
-            result = supabase.table(self.table_name).select("*").eq("thread_id", thread_id).limit(1).execute()
+            if context is None:
+                context = await self._load_stored(thread_id)
             
-            if result.data:
+            if context is not None:
                 # Found existing conversation
-                context = ConversationContext.from_dict(result.data[0])
-                self._cache[thread_id] = context
-                logger.info(f"Loaded conversation from DB: {thread_id}, {len(context.recent_messages)} messages")
+                self._cache.put(thread_id, context)
+                logger.info(f"Loaded conversation from DB: {thread_id}, {len(context.messages)} messages")
                 return context
             else:
                 # Create new conversation
@@ -136,43 +555,310 @@ class MemoryManager:
             # Return empty context on error
             return ConversationContext(thread_id)
     
-    async def save_conversation(self, context: ConversationContext):
+    async def _load_stored(self, thread_id: str) -> Optional[ConversationContext]:
+        """The conversation as stored, bypassing cache and snapshot (None if it does not exist)."""
+        if self.storage_mode == "append_log":
+            return await self._load_from_log(thread_id)
+        row = await self.backend.load(thread_id)
+        return ConversationContext.from_dict(row) if row else None
+    
+    def peek_conversation(self, thread_id: str) -> Optional[ConversationContext]:
+        """Cached context without revalidation or I/O (None if not cached)."""
+        return self._cache.peek(thread_id)
+    
+    async def _ensure_channel(self):
+        """Subscribe to invalidations once, from inside the running event loop."""
+        if self.channel is None or self._channel_started:
+            return
+        self._channel_started = True
+        await self.channel.start(self._on_invalidation)
+    
+    async def close_channel(self):
+        """Stop listening for invalidations and release the socket (shutdown)."""
+        if self.channel is None or not self._channel_started:
+            return
+        self._channel_started = False
+        await self.channel.close()
+    
+    async def _on_invalidation(self, thread_id: str, version: int):
+        """Another worker saved a newer version: drop our copy so the next read reloads."""
+        cached_context = self._cache.peek(thread_id)
+        if cached_context is not None and version > cached_context.version:
+            self._cache.pop(thread_id)
+            self.invalidations += 1
+            logger.info(f"Invalidated cached conversation {thread_id}: v{cached_context.version} -> v{version}")
+    
+    async def _is_current(self, context: ConversationContext) -> bool:
+        """
+        Cheap revalidation of a cached copy. Only relevant with several workers:
+        if nothing was heard about the thread for revalidate_after seconds, compare
+        the version column instead of reloading the whole conversation.
+        """
+        if self.channel is None:
+            return True
+        now = time.time()
+        if now - context.validated_at < self.revalidate_after:
+            return True
+        
+        self.revalidations += 1
+        stored_version = await self.backend.get_version(context.thread_id) or 0
+        if stored_version == context.version:
+            context.validated_at = now
+            return True
+        
+        self.stale_reloads += 1
+        logger.info(f"Cached conversation {context.thread_id} is stale: v{context.version} != v{stored_version}")
+        return False
+    
+    async def _restore_from_snapshot(self, thread_id: str) -> Optional[ConversationContext]:
+        """
+        Decode the snapshot entry for a thread, trusting it only if its version still
+        matches the database (a version-only query instead of a full load).
+        """
+        if self._snapshot is None:
+            return None
+        entry = self._snapshot.take("conversations", thread_id)
+        if entry is None:
+            return None
+        
+        version, blob = entry
+        stored_version = await self.backend.get_version(thread_id)
+        if stored_version is None or stored_version != version:
+            self.snapshot_stale += 1
+            logger.info(f"Snapshot of {thread_id} is stale: v{version} != v{stored_version}")
+            return None
+        try:
+            context = ConversationContext.decode(blob)
+        except Exception as e:
+            self.snapshot_stale += 1
+            logger.warning(f"Could not decode snapshot of {thread_id}: {e}")
+            return None
+        
+        context.validated_at = time.time()
+        self.snapshot_restored += 1
+        return context
+    
+    def load_snapshot(self, path: Optional[str] = None) -> int:
+        """
+        Map the snapshot written at the last shutdown. Nothing is decoded yet; entries
+        are restored one by one as their threads come back. Returns how many are available.
+        """
+        path = path or self.snapshot_path
+        if not path:
+            return 0
+        if self._snapshot is not None:
+            self._snapshot.close()
+        self._snapshot = CacheSnapshot.open(path, max_age_seconds=self.snapshot_max_age)
+        return self._snapshot.remaining() if self._snapshot else 0
+    
+    async def save_snapshot(self, path: Optional[str] = None) -> int:
+        """
+        Write every cached conversation that exists in the database to a snapshot file.
+        Call on graceful shutdown. Returns how many entries were written.
+        """
+        path = path or self.snapshot_path
+        if not path:
+            return 0
+        try:
+            # Unsaved contexts (version 0) could never be revalidated, so they are skipped
+            entries = [
+                (thread_id, context.version, context.encode())
+                for thread_id, context in self._cache.items() if context.version
+            ]
+            written = await asyncio.to_thread(write_snapshot, path, {"conversations": entries})
+            logger.info(f"Wrote cache snapshot {path}: {written} conversations")
+            return written
+        except Exception as e:
+            logger.error(f"Error writing cache snapshot {path}: {e}")
+            return 0
+    
+    async def _load_from_log(self, thread_id: str) -> Optional[ConversationContext]:
+        """
+        Load the conversation row and its message window with one indexed range query
+        on (thread_id, seq).
+        """
+        row, log_rows = await asyncio.gather(
+            self.backend.load(thread_id),
+            self.backend.load_messages(thread_id, ConversationContext.max_messages)
+        )
+        if not row:
+            return None
+        
+        context = ConversationContext.from_dict(row)
+        if log_rows:
+            context.set_window(
+                make_stored_message(log["seq"], log["role"], log["content"], _parse_timestamp(log["created_at"]))
+                for log in log_rows
+            )
+        elif context.messages:
+            # Row predates the log: queue its JSONB window so the next save migrates it
+            context.pending_messages = list(context.messages)
+            logger.info(f"Migrating {len(context.pending_messages)} messages to log for {thread_id}")
+        return context
+    
+    async def save_conversation(self, context: ConversationContext) -> bool:
         """
         Save conversation context to database.
+        Only changed columns are written. Returns True once they are stored, False when
+        there was nothing to write or the write failed (the changes stay dirty for the next save).
+        
+        The write is a compare-and-set on the row version: if another worker saved the
+        thread since this copy was loaded, the unsaved changes are rebased onto the stored
+        row and written once more instead of overwriting it.
         """
+        async with self.save_locks.hold(context.thread_id):
+            return await self._save_locked(context)
+    
+    async def _save_locked(self, context: ConversationContext) -> bool:
+        fields = frozenset()
+        previous_version = context.version
         try:
             # Update cache
-            self._cache[context.thread_id] = context
+            self._cache.put(context.thread_id, context)
             
-            # Prepare data for storage
-            data = context.to_dict()
+            fields = context.take_dirty()
+            if not fields and not context.pending_messages:
+                self.writes_skipped += 1
+                logger.info(f"Skipped save of unchanged conversation: {context.thread_id}")
+                return False
+            self.columns_skipped += len(ConversationContext.ROW_FIELDS) - len(fields)
             
-            # Upsert to database
-            result = supabase.table(self.table_name).upsert(
-                data, 
-                on_conflict="thread_id"
-            ).execute()
+            try:
+                saved = await self._write(context, fields)
+            except VersionConflict:
+                self.save_conflicts += 1
+                logger.warning(f"Conversation {context.thread_id} v{previous_version} was saved elsewhere; rebasing")
+                fields = await self._rebase(context, fields)
+                previous_version = context.version
+                saved = await self._write(context, fields)  # A second conflict gives up below
             
-            if result.data:
-                logger.info(f"Saved conversation: {context.thread_id}, {len(context.recent_messages)} messages")
+            if saved:
+                context.mark_saved()
+                context.validated_at = time.time()
+                if self.channel is not None:
+                    await self.channel.publish(context.thread_id, context.version)
+                self._schedule_summary(context)
+                logger.info(f"Saved conversation: {context.thread_id}, {len(context.messages)} messages")
             else:
+                context.version = previous_version
+                context.mark_dirty(fields)
                 logger.warning(f"Failed to save conversation: {context.thread_id}")
+            return saved
                 
         except Exception as e:
+            context.version = previous_version
+            context.mark_dirty(fields)
             logger.error(f"Error saving conversation {context.thread_id}: {e}")
+            return False
+    
+    async def _write(self, context: ConversationContext, fields: FrozenSet[str]) -> bool:
+        """Write the changed columns as the next version, if the row is still at the current one."""
+        expected_version = context.version
+        context.version += 1
+        try:
+            if self.storage_mode == "append_log":
+                return await self._save_to_log(context, fields, expected_version)
+            # Upsert the changed columns, message window included when it changed
+            return await self.backend.save(context.to_dict(fields=fields), expected_version)
+        except VersionConflict:
+            context.version = expected_version
+            raise
+    
+    async def _rebase(self, context: ConversationContext, fields: FrozenSet[str]) -> FrozenSet[str]:
+        """
+        Put this copy's unsaved changes on top of the stored row: the stored window plus
+        our new messages (renumbered after it), and the stored columns except those we
+        changed. Returns the columns to write.
+        """
+        stored = await self._load_stored(context.thread_id)
+        if stored is None:
+            # Deleted meanwhile (retention): our copy becomes the row again, whole window included
+            context.version = 0
+            context.pending_messages = list(context.messages)
+            return frozenset(ConversationContext.ROW_FIELDS)
+        
+        for column in ("customer_context", "session_metadata"):
+            if column not in fields:
+                setattr(context, column, getattr(stored, column))
+        context._created_at = stored._created_at
+        
+        pending = [
+            msg._replace(seq=stored.next_seq + offset) for offset, msg in enumerate(context.pending_messages)
+        ]
+        context.evicted_messages = []
+        context.set_window([*stored.messages, *pending])
+        context.pending_messages = pending
+        context.version = stored.version
+        return fields | {"recent_messages"} if pending else fields
+    
+    async def _save_to_log(self, context: ConversationContext, fields: Iterable[str],
+                           expected_version: Optional[int] = None) -> bool:
+        """
+        Upsert the small conversation row, then append only the new messages.
+        The parent row goes first so the log's foreign key is satisfied, and a
+        version conflict stops the save before any message is appended.
+        """
+        saved = await self.backend.save(context.to_dict(include_messages=False, fields=fields), expected_version)
+        if saved and context.pending_messages:
+            rows = [
+                {
+                    "thread_id": context.thread_id,
+                    "seq": msg.seq,
+                    "role": msg.role,
+                    "content": msg.content,
+                    "created_at": _format_timestamp(msg.ts)
+                }
+                for msg in context.pending_messages
+            ]
+            await self.backend.append_messages(context.thread_id, rows)
+        return saved
+    
+    def _schedule_summary(self, context: ConversationContext):
+        """Fold evicted messages into the summary without delaying the current turn."""
+        if self.summarizer is None or not context.evicted_messages:
+            return
+        if context.thread_id in self._summarizing:
+            return  # The running fold picks up newly evicted messages when it loops
+        self._summarizing.add(context.thread_id)
+        task = asyncio.create_task(self._fold_evicted(context))
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+    
+    async def _fold_evicted(self, context: ConversationContext):
+        """Summarize evicted messages batch by batch, then persist the new summary."""
+        try:
+            while context.evicted_messages:
+                evicted = context.evicted_messages
+                context.evicted_messages = []
+                # The summary covers every seq up to its high-water mark. Older messages
+                # still in the window (short ones outlive long ones) are folded in too, so
+                # nothing is skipped when they are evicted later.
+                through = max(msg.seq for msg in evicted)
+                batch = {msg.seq: msg for msg in evicted}
+                batch.update((msg.seq, msg) for msg in context.messages if msg.seq <= through)
+                batch = [batch[seq] for seq in sorted(batch) if seq > context.summarized_through]
+                if not batch:
+                    continue
+                summary = await self.summarizer.summarize(context.summary, batch)
+                context.apply_summary(summary, batch[-1].seq)
+                logger.info(f"Folded {len(batch)} messages into summary for {context.thread_id}")
+            await self.save_conversation(context)
+        except Exception as e:
+            logger.error(f"Error summarizing conversation {context.thread_id}: {e}")
+        finally:
+            self._summarizing.discard(context.thread_id)
+    
+    async def wait_for_background(self):
+        """Wait for pending background summaries (tests and graceful shutdown)."""
+        while self._background_tasks:
+            await asyncio.gather(*list(self._background_tasks), return_exceptions=True)
     
     async def add_message(self, thread_id: str, message: BaseMessage) -> ConversationContext:
         """
         Add a message to the conversation and save.
         """
         context = await self.get_conversation(thread_id)
-        
-        # Truncate very long messages to save space
-        if len(message.content) > self.max_message_length:
-            original_content = message.content
-            message.content = message.content[:self.max_message_length] + "... [truncated]"
-            logger.info(f"Truncated long message for {thread_id}: {len(original_content)} -> {len(message.content)}")
-        
+        self._truncate_message(thread_id, message)
         context.add_message(message)
         await self.save_conversation(context)
         
@@ -183,26 +869,70 @@ class MemoryManager:
         Update customer context information.
         """
         context = await self.get_conversation(thread_id)
-        context.update_customer_context(key, value)
+        if not context.update_customer_context(key, value):
+            self.writes_skipped += 1
+            return
         await self.save_conversation(context)
         
         logger.info(f"Updated customer context for {thread_id}: {key} = {value}")
     
-    async def cleanup_old_conversations(self):
+    def lock(self, thread_id: str):
+        """
+        Serialize whole turns (load -> LLM -> save) for one thread.
+        Use as `async with memory.lock(thread_id):`. Concurrent messages from the
+        same user queue up in arrival order instead of overwriting each other.
         """
-        Clean up conversations older than TTL.
-        This should be run periodically (e.g., daily cron job).
+        return self.turn_locks.hold(thread_id)
+    
+    def turn(self, thread_id: str) -> ConversationTurn:
+        """
+        Start a unit of work for one chat turn.
+        Use as `async with memory.turn(thread_id) as turn:`; it commits one save on exit.
+        """
+        return ConversationTurn(self, thread_id)
+    
+    def _truncate_message(self, thread_id: str, message: BaseMessage):
+        """Truncate very long messages to save space and prompt tokens."""
+        if not isinstance(message.content, str):
+            return
+        original_tokens = estimate_tokens(message.content)
+        if original_tokens > self.max_message_tokens:
+            message.content = truncate_to_tokens(message.content, self.max_message_tokens) + "... [truncated]"
+            logger.info(f"Truncated long message for {thread_id}: ~{original_tokens} -> {self.max_message_tokens} tokens")
+    
+    async def expire_batch(self, cutoff_iso: str, limit: int) -> List[Dict[str, Any]]:
+        """
+        Delete one bounded batch of conversations inactive since before cutoff
+        and drop them from the cache. Returns the deleted {thread_id, last_activity} rows.
+        """
+        deleted = await self.backend.delete_expired_batch(cutoff_iso, limit)
+        # Evicted before anything else can fail: these rows are gone from the database
+        for row in deleted:
+            self._cache.pop(row["thread_id"])
+        if deleted and self.storage_mode == "append_log":
+            # Explicit so the log is cleared even where its foreign key cascade is missing
+            try:
+                await self.backend.delete_messages([row["thread_id"] for row in deleted])
+            except Exception as e:
+                logger.warning(f"Could not delete logged messages of {len(deleted)} expired conversations: {e}")
+        return deleted
+    
+    async def cleanup_old_conversations(self, batch_size: int = 500):
+        """
+        Clean up conversations older than TTL, one bounded batch at a time.
+        Scheduled runs go through the retention job (see retention.py).
         """
         try:
-            cutoff_date = datetime.now(timezone.utc) - timedelta(days=self.ttl_days)
+            cutoff_iso = (datetime.now(timezone.utc) - timedelta(days=self.ttl_days)).isoformat()
             
-            result = supabase.table(self.table_name).delete().lt(
-                "last_activity", 
-                cutoff_date.isoformat()
-            ).execute()
+            cleaned_count = 0
+            while True:
+                deleted = await self.expire_batch(cutoff_iso, batch_size)
+                cleaned_count += len(deleted)
+                if len(deleted) < batch_size:
+                    break
             
-            if result.data:
-                cleaned_count = len(result.data)
+            if cleaned_count:
                 logger.info(f"Cleaned up {cleaned_count} old conversations")
                 return cleaned_count
             else:
@@ -213,24 +943,51 @@ class MemoryManager:
             logger.error(f"Error cleaning up old conversations: {e}")
             return 0
     
+    def purge_expired(self) -> int:
+        """Drop cached conversations past their TTL now, without waiting for the next request."""
+        return self._cache.purge_expired()
+    
     def clear_cache(self):
         """Clear the in-memory cache."""
         self._cache.clear()
         logger.info("Memory cache cleared")
     
+    def get_cache_stats(self) -> Dict[str, Any]:
+        """Hit/miss/eviction counters and size of the conversation cache."""
+        stats = self._cache.stats()
+        stats["writes_saved"] = self.writes_saved
+        stats["writes_skipped"] = self.writes_skipped
+        stats["columns_skipped"] = self.columns_skipped
+        stats["invalidations"] = self.invalidations
+        stats["revalidations"] = self.revalidations
+        stats["stale_reloads"] = self.stale_reloads
+        stats["save_conflicts"] = self.save_conflicts
+        stats["turn_locks"] = self.turn_locks.stats()
+        stats["snapshot"] = {
+            "restored": self.snapshot_restored,
+            "stale": self.snapshot_stale,
+            "pending": self._snapshot.remaining() if self._snapshot else 0,
+        }
+        return stats
+    
     async def get_conversation_stats(self, thread_id: str) -> Dict[str, Any]:
         """
         Get statistics about a conversation.
         """
+        cache_hit = thread_id in self._cache
         context = await self.get_conversation(thread_id)
         
         return {
             "thread_id": thread_id,
-            "message_count": len(context.recent_messages),
+            "message_count": len(context.messages),
+            "window_tokens": context.window_tokens,
+            "has_summary": bool(context.summary),
+            "token_budget": context.token_budget,
             "customer_context_keys": list(context.customer_context.keys()),
             "last_activity": context.last_activity.isoformat(),
             "created_at": context.created_at.isoformat(),
-            "cache_hit": thread_id in self._cache
+            "cache_hit": cache_hit,
+            "cache": self.get_cache_stats()
         }
 
 
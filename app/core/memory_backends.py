@@ -0,0 +1,392 @@
+"""
+Storage backends for MemoryManager.
+
+MemoryManager owns caching, windowing and coherence; a backend only moves rows.
+Conversation rows use the ConversationContext.to_dict() shape and message rows
+the append-log shape ({thread_id, seq, role, content, created_at}).
+
+Selected with MEMORY_BACKEND:
+- "supabase": Postgres through PostgREST (production, default)
+- "sqlite":   local file in WAL mode (single-node installs, load tests)
+- "memory":   process-local dicts (tests, ephemeral runs)
+"""
+
+import asyncio
+import copy
+import json
+import logging
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional
+
+from .codecs import Codec, decode, get_codec
+
+logger = logging.getLogger(__name__)
+
+
+class VersionConflict(Exception):
+    """The stored row is not at the version the writer loaded: another worker saved it first."""
+
+
+class MemoryBackend:
+    """Interface every memory backend implements. All methods are async."""
+
+    name = "base"
+
+    async def load(self, thread_id: str) -> Optional[Dict[str, Any]]:
+        """Return the conversation row, or None if it does not exist."""
+        raise NotImplementedError
+
+    async def save(self, row: Dict[str, Any], expected_version: Optional[int] = None) -> bool:
+        """
+        Upsert a conversation row by thread_id. Returns True on success.
+        With expected_version, write only if the stored row is still at that version
+        (0: absent or never versioned) and raise VersionConflict otherwise.
+        """
+        raise NotImplementedError
+
+    async def load_messages(self, thread_id: str, limit: int) -> List[Dict[str, Any]]:
+        """Return the newest `limit` logged messages, oldest first."""
+        raise NotImplementedError
+
+    async def append_messages(self, thread_id: str, rows: List[Dict[str, Any]]):
+        """Insert message rows; re-inserting an existing (thread_id, seq) is a no-op update."""
+        raise NotImplementedError
+
+    async def get_version(self, thread_id: str) -> Optional[int]:
+        """Return only the version stamp of a conversation (cheap revalidation)."""
+        raise NotImplementedError
+
+    async def delete_expired_batch(self, cutoff_iso: str, limit: int) -> List[Dict[str, Any]]:
+        """
+        Delete at most `limit` of the least recently active conversations inactive
+        since before cutoff. Returns the deleted {thread_id, last_activity} rows, oldest
+        first. Local backends drop their logged messages too; in Postgres the log's
+        foreign key cascades (see delete_messages for installs without it).
+        """
+        raise NotImplementedError
+
+    async def delete_messages(self, thread_ids: List[str]):
+        """Delete the logged messages of these threads (append-log mode only)."""
+        raise NotImplementedError
+
+    async def delete_older_than(self, cutoff_iso: str, batch_size: int = 500) -> int:
+        """Delete every conversation inactive since before cutoff, one bounded batch at a time."""
+        total = 0
+        while True:
+            deleted = await self.delete_expired_batch(cutoff_iso, batch_size)
+            total += len(deleted)
+            if len(deleted) < batch_size:
+                return total
+
+    async def close(self):
+        pass
+
+
+def _stored_version(row: Optional[Dict[str, Any]]) -> int:
+    """Version of a stored row for compare-and-set: 0 when absent or never versioned."""
+    return (row.get("version") or 0) if row is not None else 0
+
+
+# =============================================================================
+# IN-PROCESS
+# =============================================================================
+
+class InMemoryBackend(MemoryBackend):
+    """Process-local dicts. Rows are deep-copied so callers never share state with storage."""
+
+    name = "memory"
+
+    def __init__(self):
+        self.rows: Dict[str, Dict[str, Any]] = {}
+        self.messages: Dict[str, Dict[int, Dict[str, Any]]] = {}
+
+    async def load(self, thread_id: str) -> Optional[Dict[str, Any]]:
+        row = self.rows.get(thread_id)
+        return copy.deepcopy(row) if row is not None else None
+
+    async def save(self, row: Dict[str, Any], expected_version: Optional[int] = None) -> bool:
+        existing = self.rows.get(row["thread_id"])
+        if expected_version is not None and _stored_version(existing) != expected_version:
+            raise VersionConflict(row["thread_id"])
+        stored = self.rows.setdefault(row["thread_id"], {})
+        stored.update(copy.deepcopy(row))
+        return True
+
+    async def load_messages(self, thread_id: str, limit: int) -> List[Dict[str, Any]]:
+        log = self.messages.get(thread_id, {})
+        return [copy.deepcopy(log[seq]) for seq in sorted(log)[-limit:]] if limit > 0 else []
+
+    async def append_messages(self, thread_id: str, rows: List[Dict[str, Any]]):
+        log = self.messages.setdefault(thread_id, {})
+        for row in rows:
+            log[row["seq"]] = copy.deepcopy(row)
+
+    async def get_version(self, thread_id: str) -> Optional[int]:
+        row = self.rows.get(thread_id)
+        return row.get("version", 0) if row is not None else None
+
+    async def delete_expired_batch(self, cutoff_iso: str, limit: int) -> List[Dict[str, Any]]:
+        expired = sorted(
+            (row.get("last_activity", ""), thread_id)
+            for thread_id, row in self.rows.items() if row.get("last_activity", "") < cutoff_iso
+        )[:limit]
+        for _, thread_id in expired:
+            del self.rows[thread_id]
+            self.messages.pop(thread_id, None)
+        return [{"thread_id": thread_id, "last_activity": last_activity} for last_activity, thread_id in expired]
+
+    async def delete_messages(self, thread_ids: List[str]):
+        for thread_id in thread_ids:
+            self.messages.pop(thread_id, None)
+
+
+# =============================================================================
+# SQLITE
+# =============================================================================
+
+class SQLiteBackend(MemoryBackend):
+    """
+    Local SQLite file in WAL mode.
+    One connection guarded by a lock; calls run in a worker thread so the event
+    loop never blocks on disk I/O. Rows are stored as codec blobs (see codecs.py);
+    JSON text written by earlier versions is still read.
+    """
+
+    name = "sqlite"
+    row_schema_version = 1
+
+    def __init__(self, path: str = "conversation_memory.db", codec: Optional[Codec] = None):
+        self.path = path
+        self.codec = codec or get_codec()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS conversation_memory (
+                    thread_id TEXT PRIMARY KEY,
+                    data BLOB NOT NULL,
+                    last_activity TEXT NOT NULL,
+                    version INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE INDEX IF NOT EXISTS idx_memory_last_activity
+                ON conversation_memory(last_activity);
+                CREATE TABLE IF NOT EXISTS conversation_messages (
+                    thread_id TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    created_at TEXT,
+                    PRIMARY KEY (thread_id, seq)
+                );
+            """)
+
+    async def _run(self, func, *args):
+        return await asyncio.to_thread(self._locked, func, *args)
+
+    def _locked(self, func, *args):
+        with self._lock:
+            return func(*args)
+
+    async def load(self, thread_id: str) -> Optional[Dict[str, Any]]:
+        def query():
+            return self._conn.execute(
+                "SELECT data FROM conversation_memory WHERE thread_id = ?", (thread_id,)
+            ).fetchone()
+        found = await self._run(query)
+        return self._decode_row(found[0]) if found else None
+
+    def _decode_row(self, data: Any) -> Dict[str, Any]:
+        if isinstance(data, str):  # Plain JSON text from before codecs
+            return json.loads(data)
+        return decode(data)[1]
+
+    async def save(self, row: Dict[str, Any], expected_version: Optional[int] = None) -> bool:
+        def upsert():
+            existing = self._conn.execute(
+                "SELECT data, version FROM conversation_memory WHERE thread_id = ?", (row["thread_id"],)
+            ).fetchone()
+            # Checked and written under the connection lock, so no other save can slip in between
+            if expected_version is not None and ((existing[1] or 0) if existing else 0) != expected_version:
+                raise VersionConflict(row["thread_id"])
+            # Partial rows (e.g. without recent_messages) merge like a Postgres upsert of those columns
+            merged = self._decode_row(existing[0]) if existing else {}
+            merged.update(row)
+            self._conn.execute(
+                "INSERT INTO conversation_memory (thread_id, data, last_activity, version) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(thread_id) DO UPDATE SET data = excluded.data, "
+                "last_activity = excluded.last_activity, version = excluded.version",
+                (row["thread_id"], self.codec.encode(merged, self.row_schema_version),
+                 merged.get("last_activity", ""), merged.get("version", 0))
+            )
+            return True
+        return await self._run(upsert)
+
+    async def load_messages(self, thread_id: str, limit: int) -> List[Dict[str, Any]]:
+        def query():
+            return self._conn.execute(
+                "SELECT seq, role, content, created_at FROM conversation_messages "
+                "WHERE thread_id = ? ORDER BY seq DESC LIMIT ?", (thread_id, limit)
+            ).fetchall()
+        found = await self._run(query)
+        return [
+            {"thread_id": thread_id, "seq": seq, "role": role, "content": content, "created_at": created_at}
+            for seq, role, content, created_at in reversed(found)
+        ]
+
+    async def append_messages(self, thread_id: str, rows: List[Dict[str, Any]]):
+        def insert():
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO conversation_messages (thread_id, seq, role, content, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(thread_id, row["seq"], row["role"], row["content"], row.get("created_at")) for row in rows]
+            )
+        await self._run(insert)
+
+    async def get_version(self, thread_id: str) -> Optional[int]:
+        def query():
+            return self._conn.execute(
+                "SELECT version FROM conversation_memory WHERE thread_id = ?", (thread_id,)
+            ).fetchone()
+        found = await self._run(query)
+        return found[0] if found else None
+
+    async def delete_expired_batch(self, cutoff_iso: str, limit: int) -> List[Dict[str, Any]]:
+        def delete():
+            # Walks idx_memory_last_activity from the oldest row; one short transaction per batch
+            expired = self._conn.execute(
+                "SELECT thread_id, last_activity FROM conversation_memory "
+                "WHERE last_activity < ? ORDER BY last_activity LIMIT ?", (cutoff_iso, limit)
+            ).fetchall()
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany("DELETE FROM conversation_messages WHERE thread_id = ?",
+                                       [(thread_id,) for thread_id, _ in expired])
+                self._conn.executemany("DELETE FROM conversation_memory WHERE thread_id = ?",
+                                       [(thread_id,) for thread_id, _ in expired])
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            return [{"thread_id": thread_id, "last_activity": last_activity} for thread_id, last_activity in expired]
+        return await self._run(delete)
+
+    async def delete_messages(self, thread_ids: List[str]):
+        def delete():
+            self._conn.executemany("DELETE FROM conversation_messages WHERE thread_id = ?",
+                                   [(thread_id,) for thread_id in thread_ids])
+        await self._run(delete)
+
+    async def close(self):
+        await self._run(self._conn.close)
+
+
+# =============================================================================
+# SUPABASE
+# =============================================================================
+
+class SupabaseBackend(MemoryBackend):
+    """Postgres through PostgREST, using the non-blocking `db` layer."""
+
+    name = "supabase"
+
+    def __init__(self, database: Any = None, table_name: str = "conversation_memory",
+                 messages_table: str = "conversation_messages"):
+        if database is None:
+            from .db import db as database
+        self.db = database
+        self.table_name = table_name
+        self.messages_table = messages_table
+
+    async def load(self, thread_id: str) -> Optional[Dict[str, Any]]:
+        result = await self.db.execute(
+            self.db.table(self.table_name).select("*").eq("thread_id", thread_id).limit(1)
+        )
+        return result.data[0] if result.data else None
+
+    async def save(self, row: Dict[str, Any], expected_version: Optional[int] = None) -> bool:
+        if expected_version is None:
+            result = await self.db.execute(
+                self.db.table(self.table_name).upsert(row, on_conflict="thread_id")
+            )
+            return bool(result.data)
+
+        if expected_version == 0:
+            # A new conversation: insert, doing nothing if another worker created it first
+            result = await self.db.execute(
+                self.db.table(self.table_name).upsert(row, on_conflict="thread_id", ignore_duplicates=True)
+            )
+            if result.data:
+                return True
+        # Compare-and-set: only the row still at the version this worker loaded is updated
+        result = await self.db.execute(
+            self.db.table(self.table_name).update(row)
+            .eq("thread_id", row["thread_id"]).eq("version", expected_version)
+        )
+        if not result.data:
+            raise VersionConflict(row["thread_id"])
+        return True
+
+    async def load_messages(self, thread_id: str, limit: int) -> List[Dict[str, Any]]:
+        # One indexed range query on (thread_id, seq)
+        result = await self.db.execute(
+            self.db.table(self.messages_table)
+            .select("seq, role, content, created_at")
+            .eq("thread_id", thread_id)
+            .order("seq", desc=True)
+            .limit(limit)
+        )
+        return [dict(row, thread_id=thread_id) for row in reversed(result.data or [])]
+
+    async def append_messages(self, thread_id: str, rows: List[Dict[str, Any]]):
+        # Upsert on the key keeps a retried save idempotent
+        await self.db.execute(
+            self.db.table(self.messages_table).upsert(rows, on_conflict="thread_id,seq")
+        )
+
+    async def get_version(self, thread_id: str) -> Optional[int]:
+        result = await self.db.execute(
+            self.db.table(self.table_name).select("version").eq("thread_id", thread_id).limit(1)
+        )
+        return (result.data[0].get("version") or 0) if result.data else None
+
+    async def delete_expired_batch(self, cutoff_iso: str, limit: int) -> List[Dict[str, Any]]:
+        # Pick the batch through idx_smart_memory_last_activity, then delete by key:
+        # each statement touches at most `limit` rows instead of the whole expired range
+        candidates = await self.db.execute(
+            self.db.table(self.table_name)
+            .select("thread_id, last_activity")
+            .lt("last_activity", cutoff_iso)
+            .order("last_activity")
+            .limit(limit)
+        )
+        thread_ids = [row["thread_id"] for row in candidates.data or []]
+        if not thread_ids:
+            return []
+        # Re-checking the cutoff spares a thread that became active since the select
+        result = await self.db.execute(
+            self.db.table(self.table_name).delete().in_("thread_id", thread_ids).lt("last_activity", cutoff_iso)
+        )
+        deleted = {row["thread_id"] for row in result.data or []}
+        # The message log, when installed, follows through its ON DELETE CASCADE
+        return [row for row in candidates.data if row["thread_id"] in deleted]
+
+    async def delete_messages(self, thread_ids: List[str]):
+        # Only for logs created without the foreign key; the table exists only in append-log installs
+        await self.db.execute(
+            self.db.table(self.messages_table).delete().in_("thread_id", thread_ids)
+        )
+
+
+def build_backend(name: Optional[str], sqlite_path: str = "conversation_memory.db",
+                  codec: Optional[str] = None) -> MemoryBackend:
+    """Create the backend selected by config."""
+    if name == "memory":
+        return InMemoryBackend()
+    if name == "sqlite":
+        return SQLiteBackend(sqlite_path, get_codec(codec))
+    if name not in (None, "", "supabase"):
+        logger.warning(f"Unknown memory backend '{name}', using supabase")
+    return SupabaseBackend()
@@ -0,0 +1,120 @@
+"""
+Prompt layout for the conversation LLM calls.
+
+Providers cache prompt prefixes: when a request starts with the same tokens as
+a recent one (OpenAI: the first 1024+ tokens, in 128-token steps), that part
+is billed at a discount and not processed again. The previous layout put the
+per-customer user_id line right after SYSTEM_PROMPT, so prompts of different
+customers diverged a few dozen tokens in and the step instructions behind it
+were never reused.
+
+Prompts are laid out as:
+    1. static prefix: SYSTEM_PROMPT plus the step's instructions from
+       prompts.py, assembled once per (step, registered) at import, so every
+       turn in that step sends the very same string
+    2. per-customer data, most stable first: user_id, customer row, greeting
+       by name, summary, active order
+    3. conversation history
+The prefix is shared by every customer in the same step, and for one customer
+the next turn's prompt usually extends the previous one.
+"""
+
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+
+from langchain_core.messages import AIMessage, HumanMessage
+
+from .prompts import (
+    SYSTEM_PROMPT, CONTEXT_NEW_CUSTOMER, CONTEXT_RETURNING_CUSTOMER,
+    CONTEXT_MENU_INQUIRY, CONTEXT_ORDER_START, CONTEXT_ORDER_CONFIRMATION
+)
+from .tokens import estimate_tokens
+
+# The tool rule without the id itself; the id is per-customer data
+USER_ID_RULE = "IMPORTANTE: Usa SIEMPRE el user_id exacto que aparece en los datos del cliente más abajo cuando uses herramientas como get_customer, create_customer, etc. NO uses el nombre del cliente como user_id."
+NEW_CUSTOMER_GREETING_RULE = "IMPORTANTE: Este cliente NO está registrado. NO inventes nombres. Salúdalo cordialmente sin usar nombres inventados."
+FULL_MENU_RULE = "IMPORTANTE: El cliente pidió el MENÚ COMPLETO. Debes usar la herramienta send_full_menu para enviar la imagen del menú."
+UNREGISTERED_RULE = "IMPORTANTE: Este cliente NO está en la base de datos. NO inventes información sobre él."
+# The customer lookup failed this turn; they may well be registered
+UNKNOWN_CUSTOMER_RULE = "IMPORTANTE: No se pudo consultar el registro de este cliente en este momento. NO le pidas registrarse ni inventes sus datos; usa get_customer si los necesitas."
+
+# Instructions for the reply written after tools ran (final_response_node)
+FINAL_RESPONSE_RULES = (
+    "IMPORTANTE: Las herramientas ya se ejecutaron y sus resultados están en la conversación anterior. Usa EXACTAMENTE esos resultados para responder. Sigue las reglas de formato del CONTEXT_MENU_INQUIRY para respuestas concisas y bien organizadas. NO ejecutes más herramientas. NO inventes información.\n"
+    "Genera una respuesta natural y humana basada en los resultados de las herramientas que ya se ejecutaron. Usa el formato optimizado para evitar respuestas muy largas. Si hay muchas pizzas, muestra solo algunos ejemplos y menciona que hay más opciones."
+)
+
+# Static instructions per step; a registered customer's greeting names them, so it is per-customer data
+_STEP_BLOCKS: Dict[str, Tuple[str, ...]] = {
+    "greeting": (),
+    "menu": (CONTEXT_MENU_INQUIRY,),
+    "full_menu": (CONTEXT_MENU_INQUIRY, FULL_MENU_RULE),
+    "order": (CONTEXT_ORDER_START,),
+    "confirmation": (CONTEXT_ORDER_CONFIRMATION,),
+}
+
+
+def _assemble(step: Optional[str], registered: bool) -> str:
+    blocks = [SYSTEM_PROMPT, USER_ID_RULE]
+    if step == "greeting" and not registered:
+        blocks += [CONTEXT_NEW_CUSTOMER, NEW_CUSTOMER_GREETING_RULE]
+    blocks += _STEP_BLOCKS.get(step, ())
+    if not registered:
+        blocks.append(UNREGISTERED_RULE)
+    return "\n\n".join(block.strip() for block in blocks)
+
+
+# Built once; every turn in a step reuses the same string
+STATIC_PREFIXES: Dict[Tuple[Optional[str], bool], str] = {
+    (step, registered): _assemble(step, registered)
+    for step in (*_STEP_BLOCKS, None) for registered in (False, True)
+}
+
+
+def static_prefix(step: Optional[str], registered: bool) -> str:
+    """The byte-identical leading system message for a step ("general" and unknown steps share one)."""
+    return STATIC_PREFIXES[(step if step in _STEP_BLOCKS else None, registered)]
+
+
+@lru_cache(maxsize=None)
+def prefix_tokens(prefix: str) -> int:
+    return estimate_tokens(prefix)
+
+
+def build_context(state: Dict[str, Any]) -> List[Tuple[str, str]]:
+    """(role, content) messages for the conversation LLM: static prefix, customer data, history."""
+    unknown = "customer" in state and state["customer"] is None
+    customer = state.get("customer") or {}
+    step = state.get("current_step")
+    messages = [("system", static_prefix(step, bool(customer) or unknown))]
+
+    # Per-customer data, most stable first
+    messages.append(("system", f"IMPORTANTE: El user_id de este cliente es '{state['user_id']}'."))
+    if unknown:
+        messages.append(("system", UNKNOWN_CUSTOMER_RULE))
+    if customer:
+        messages.append(("system", f"Datos del cliente en la base de datos: {customer}"))
+        if step == "greeting":
+            customer_name = f"{customer.get('first_name') or ''} {customer.get('last_name') or ''}".strip()
+            if customer.get("first_name"):
+                # Returning customer - greet by name
+                messages.append(("system", CONTEXT_RETURNING_CUSTOMER.format(customer_name=customer_name)))
+                messages.append(("system", f"IMPORTANTE: Este cliente se llama {customer_name}. Salúdalo por su nombre real."))
+            else:
+                messages.append(("system", CONTEXT_NEW_CUSTOMER))
+                messages.append(("system", NEW_CUSTOMER_GREETING_RULE))
+
+    # Older history that no longer fits the window, folded into a summary
+    if state.get("conversation_summary"):
+        messages.append(("system", f"Resumen de la conversación anterior con este cliente:\n{state['conversation_summary']}"))
+
+    if state.get("active_order"):
+        messages.append(("system", f"Pedido activo actual: {state['active_order']}"))
+
+    for msg in state.get("messages", []):
+        if isinstance(msg, HumanMessage):
+            messages.append(("human", msg.content))
+        elif isinstance(msg, AIMessage):
+            messages.append(("assistant", msg.content))
+
+    return messages
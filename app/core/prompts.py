@@ -219,4 +219,16 @@ INSTRUCCIONES FINALES:
 - No hagas ninguna suposición. Usa solo los datos explícitos en la sección.
 
 Tu salida debe ser únicamente la ejecución de herramientas necesarias (tool_calls).
-"""
\ No newline at end of file
+"""
+# Resumen incremental de la conversación (mensajes que salieron de la ventana)
+SUMMARY_PROMPT = """
+Resumes conversaciones de One Pizzeria para que Juan recuerde lo importante.
+Recibes el RESUMEN ACTUAL y MENSAJES NUEVOS que ya no caben en la conversación reciente.
+
+Devuelve un resumen actualizado, en español, de máximo {max_tokens} tokens, con:
+- Datos que dio el cliente (nombre, dirección, método de pago, preferencias)
+- Productos que consultó o pidió, con tamaños y precios si se mencionaron
+- Decisiones o pendientes del pedido
+
+NO inventes nada. NO incluyas saludos ni relleno. Usa viñetas cortas.
+"""
@@ -0,0 +1,222 @@
+"""
+Cache of generated replies for repeated, non-personal turns.
+
+Many turns are the same few messages ("Hola", "cuánto cuesta la hawaiana y la
+pepperoni") and each one paid for one or two model calls. conversation_node
+looks the turn up here before calling the LLM; a reply the LLM produced,
+directly or after read-only tools and final_response, is stored for the next
+customer who sends the same message.
+
+The key is the message (lowercased, accent-folded, punctuation and extra
+spaces dropped), the conversation step and whether the customer is
+registered. Only greetings of unregistered customers and menu questions naming
+a menu item are cached; turns with an active order, replies that mention the
+customer and turns whose tools changed something never are. Entries expire
+RESPONSE_CACHE_TTL_SECONDS after they were written, and menu answers written
+against an older menu catalog version are dropped when looked up.
+"""
+
+import logging
+import re
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from langchain_core.messages import AIMessage, HumanMessage
+
+from .cache import LRUCache
+from .catalog import MenuCatalog, menu_catalog
+from .intents import normalize
+from .tools import PARALLEL_SAFE_TOOLS
+from ..config import (
+    RESPONSE_CACHE_ENABLED, RESPONSE_CACHE_MAX_CHARS, RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL_SECONDS
+)
+
+logger = logging.getLogger(__name__)
+
+# Steps whose reply depends only on the message (and the menu)
+CACHEABLE_STEPS = ("greeting", "menu")
+
+# Tools that only read shared data; a turn that used any other tool is not replayed
+SHAREABLE_TOOL_NAMES = frozenset({"search_menu", "send_full_menu"})
+# Tools that only read, but this customer's own data (customer row, active order)
+PERSONAL_TOOL_NAMES = frozenset(tool.name for tool in PARALLEL_SAFE_TOOLS) - SHAREABLE_TOOL_NAMES
+
+_PUNCTUATION = re.compile(r"[^\w\s]+")
+_SPACES = re.compile(r"\s+")
+
+
+def canonical_text(text: str) -> str:
+    """"¿Cuánto cuesta la Hawaiana?" -> "cuanto cuesta la hawaiana"."""
+    return _SPACES.sub(" ", _PUNCTUATION.sub(" ", normalize(text))).strip()
+
+
+def _last_human_text(state: Dict[str, Any]) -> Optional[str]:
+    for msg in reversed(state.get("messages") or []):
+        if isinstance(msg, HumanMessage):
+            return msg.content if isinstance(msg.content, str) else None
+    return None
+
+
+class _Entry:
+    __slots__ = ("reply", "text", "catalog_version", "created_at")
+
+    def __init__(self, reply: str, text: str, catalog_version: Optional[int], created_at: float):
+        self.reply = reply
+        self.text = text  # Message as first received, to tell exact from normalized hits
+        self.catalog_version = catalog_version  # None for replies that do not depend on the menu
+        self.created_at = created_at
+
+
+class ResponseCache:
+    """Replies by (step, registered, canonical text), with TTL and menu-version checks."""
+
+    def __init__(self, catalog: MenuCatalog, enabled: bool = True, ttl_seconds: float = 600,
+                 max_entries: int = 2000, max_chars: int = 160, clock: Callable[[], float] = time.monotonic):
+        self.catalog = catalog
+        self.enabled = enabled
+        self.ttl_seconds = ttl_seconds
+        self.max_chars = max_chars
+        self._clock = clock
+        self._entries: LRUCache[_Entry] = LRUCache(
+            "llm_responses",
+            max_entries=max_entries,
+            ttl_seconds=ttl_seconds,
+            sizeof=lambda entry: len(entry.reply) + len(entry.text),
+            clock=clock,
+        )
+
+        self.exact_hits = 0
+        self.normalized_hits = 0
+        self.misses = 0
+        self.stale = 0  # Entries dropped on lookup: too old or older menu version
+        self.stored = 0
+        self.bypassed: Dict[str, int] = {}  # Turns not eligible, by reason
+        self.rejected: Dict[str, int] = {}  # Replies not stored, by reason
+
+    async def _key(self, state: Dict[str, Any]) -> Tuple[Optional[str], str]:
+        """(key, "") for a cacheable turn, (None, reason) otherwise."""
+        step = state.get("current_step")
+        if step not in CACHEABLE_STEPS:
+            return None, "step"
+        if state.get("active_order"):
+            return None, "active_order"
+        if "customer" in state and state["customer"] is None:
+            return None, "unknown_customer"  # Lookup failed: a shared reply could greet them as new
+        registered = bool(state.get("customer"))
+        if step == "greeting" and registered:
+            return None, "personal_greeting"
+        text = _last_human_text(state)
+        if not text or len(text) > self.max_chars:
+            return None, "message_length"
+        key_text = canonical_text(text)
+        if not key_text:
+            return None, "message_length"
+        if step == "menu":
+            # Menu answers must name something on the menu, so they can follow its version
+            if not await self.catalog.ensure_loaded() or not self.catalog.find(normalize(text)):
+                return None, "no_menu_item"
+        return f"{step}|{int(registered)}|{key_text}", ""
+
+    async def lookup(self, state: Dict[str, Any]) -> Optional[str]:
+        """Cached reply for this turn, or None when the LLM has to answer."""
+        if not self.enabled:
+            return None
+        key, reason = await self._key(state)
+        if key is None:
+            self.bypassed[reason] = self.bypassed.get(reason, 0) + 1
+            return None
+
+        entry = self._entries.get(key)
+        if entry is not None and (
+            self._clock() - entry.created_at >= self.ttl_seconds
+            or entry.catalog_version not in (None, self.catalog.version)
+        ):
+            self._entries.pop(key)
+            self.stale += 1
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+
+        if entry.text == _last_human_text(state):
+            self.exact_hits += 1
+        else:
+            self.normalized_hits += 1
+        logger.info(f"Reused cached reply for {state.get('user_id')} ({key})")
+        return entry.reply
+
+    async def store(self, state: Dict[str, Any], response: AIMessage) -> bool:
+        """Remember the reply that ended this turn. False when it must not be reused."""
+        if not self.enabled:
+            return False
+        key, _ = await self._key(state)
+        if key is None:
+            return False
+        reason = self._personal(state, response)
+        if reason:
+            self.rejected[reason] = self.rejected.get(reason, 0) + 1
+            return False
+        catalog_version = self.catalog.version if state.get("current_step") == "menu" else None
+        self._entries.put(key, _Entry(response.content, _last_human_text(state), catalog_version, self._clock()))
+        self.stored += 1
+        return True
+
+    @staticmethod
+    def _personal(state: Dict[str, Any], response: AIMessage) -> str:
+        """Why `response` is specific to this customer or turn ("" if it is not)."""
+        if getattr(response, "tool_calls", None):
+            return "tool_calls"
+        if not isinstance(response.content, str) or not response.content.strip():
+            return "not_text"
+        # Tool calls since the customer's message: replaying the reply would skip their effects,
+        # or hand this customer's data to someone else
+        personal_tool = False
+        for msg in reversed(state.get("messages") or []):
+            if isinstance(msg, HumanMessage):
+                break
+            if not isinstance(msg, AIMessage):
+                continue
+            for call in msg.tool_calls:
+                name = call.get("name")
+                if name in PERSONAL_TOOL_NAMES:
+                    personal_tool = True
+                elif name not in SHAREABLE_TOOL_NAMES:
+                    return "side_effects"
+        if personal_tool:
+            return "personal_tool"
+        reply = normalize(response.content)
+        customer = state.get("customer") or {}
+        names = [customer.get("first_name"), customer.get("last_name"), state.get("user_id")]
+        if any(isinstance(name, str) and len(name.strip()) >= 3 and normalize(name.strip()) in reply for name in names):
+            return "mentions_customer"
+        return ""
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        hits = self.exact_hits + self.normalized_hits
+        lookups = hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "hits": hits,
+            "exact_hits": self.exact_hits,
+            "normalized_hits": self.normalized_hits,
+            "misses": self.misses,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            "stale_dropped": self.stale,
+            "stored": self.stored,
+            "bypassed": dict(self.bypassed),
+            "rejected": dict(self.rejected),
+        }
+
+
+# Global instance
+response_cache = ResponseCache(
+    menu_catalog,
+    enabled=RESPONSE_CACHE_ENABLED,
+    ttl_seconds=RESPONSE_CACHE_TTL_SECONDS,
+    max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+    max_chars=RESPONSE_CACHE_MAX_CHARS,
+)
@@ -0,0 +1,175 @@
+"""
+Background retention for conversation memory.
+
+Conversations inactive for longer than MEMORY_RETENTION_DAYS are deleted in
+small batches, oldest first, along the last_activity index. Each batch is its
+own short statement, and batches are spaced by a pause, so cleanup never holds
+long locks or floods the database. The oldest-first order also makes the job
+resumable: an interrupted or capped run simply continues from the oldest
+remaining row next time.
+
+Each scheduler tick also sweeps cached conversations past their TTL. The cache
+only expires entries when it is used, so an idle worker would otherwise keep
+them until the next request.
+"""
+
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Optional
+
+from ..config import (
+    MEMORY_RETENTION_DAYS,
+    MEMORY_RETENTION_BATCH_SIZE,
+    MEMORY_RETENTION_PAUSE_SECONDS,
+    MEMORY_RETENTION_MAX_BATCHES,
+    MEMORY_RETENTION_INTERVAL_MINUTES,
+)
+from .memory import MemoryManager, memory
+
+logger = logging.getLogger(__name__)
+
+
+class RetentionJob:
+    """Chunked, rate-limited deletion of expired conversations, with progress metrics."""
+
+    def __init__(self, memory_manager: MemoryManager, retention_days: float = 7,
+                 batch_size: int = 500, pause_seconds: float = 0.5,
+                 max_batches_per_run: int = 0, interval_seconds: float = 3600):
+        self.memory_manager = memory_manager
+        self.retention_days = retention_days
+        self.batch_size = batch_size
+        self.pause_seconds = pause_seconds  # Rate limit between batches
+        self.max_batches_per_run = max_batches_per_run  # 0 = until nothing is left
+        self.interval_seconds = interval_seconds  # 0 = scheduler disabled
+
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+        # Progress metrics
+        self.runs = 0
+        self.batches = 0
+        self.deleted_total = 0
+        self.errors = 0
+        self.cache_purged = 0
+        self.in_progress = False
+        self.current_run_deleted = 0
+        self.cursor: Optional[str] = None  # last_activity of the newest row deleted so far
+        self.last_run: Dict[str, Any] = {}
+
+    async def run_once(self) -> int:
+        """Delete expired conversations batch by batch. Returns how many were deleted."""
+        if self._lock.locked():
+            logger.info("Retention run already in progress, skipping")
+            return 0
+
+        async with self._lock:
+            cutoff = (datetime.now(timezone.utc) - timedelta(days=self.retention_days)).isoformat()
+            started = time.time()
+            self.in_progress = True
+            self.current_run_deleted = 0
+            batches = 0
+            finished = False
+            error = None
+            try:
+                while True:
+                    deleted = await self.memory_manager.expire_batch(cutoff, self.batch_size)
+                    batches += 1
+                    self.batches += 1
+                    self.current_run_deleted += len(deleted)
+                    self.deleted_total += len(deleted)
+                    if deleted:
+                        self.cursor = deleted[-1].get("last_activity")
+
+                    if len(deleted) < self.batch_size:
+                        finished = True
+                        break
+                    if self.max_batches_per_run and batches >= self.max_batches_per_run:
+                        logger.info(f"Retention run capped at {batches} batches; resuming next run")
+                        break
+                    await asyncio.sleep(self.pause_seconds)
+            except Exception as e:
+                self.errors += 1
+                error = str(e)
+                logger.error(f"Retention batch failed after {self.current_run_deleted} deletions: {e}")
+            finally:
+                self.in_progress = False
+                self.runs += 1
+                self.last_run = {
+                    "cutoff": cutoff,
+                    "deleted": self.current_run_deleted,
+                    "batches": batches,
+                    "finished": finished,
+                    "error": error,
+                    "started_at": datetime.fromtimestamp(started, timezone.utc).isoformat(),
+                    "duration_seconds": round(time.time() - started, 3),
+                }
+
+            if self.current_run_deleted:
+                logger.info(f"Retention removed {self.current_run_deleted} conversations in {batches} batches")
+            return self.current_run_deleted
+
+    def purge_cache(self) -> int:
+        """Drop expired entries from the conversation cache. Returns how many were removed."""
+        purged = self.memory_manager.purge_expired()
+        self.cache_purged += purged
+        if purged:
+            logger.info(f"Retention purged {purged} expired conversations from the cache")
+        return purged
+
+    async def _run_forever(self):
+        while True:
+            await asyncio.sleep(self.interval_seconds)
+            try:
+                self.purge_cache()
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"Retention scheduler error: {e}")
+
+    def start(self):
+        """Start the periodic job on the running event loop (no-op when disabled)."""
+        if self.interval_seconds <= 0 or (self._task is not None and not self._task.done()):
+            return
+        self._task = asyncio.get_running_loop().create_task(self._run_forever())
+        logger.info(f"Retention scheduler started: every {self.interval_seconds:.0f}s, "
+                    f"{self.retention_days} days, batches of {self.batch_size}")
+
+    async def stop(self):
+        """Cancel the periodic job. A batch in flight finishes or rolls back on its own."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "scheduled": self._task is not None and not self._task.done(),
+            "interval_seconds": self.interval_seconds,
+            "retention_days": self.retention_days,
+            "batch_size": self.batch_size,
+            "runs": self.runs,
+            "batches": self.batches,
+            "deleted_total": self.deleted_total,
+            "errors": self.errors,
+            "cache_purged": self.cache_purged,
+            "in_progress": self.in_progress,
+            "current_run_deleted": self.current_run_deleted,
+            "cursor": self.cursor,
+            "last_run": self.last_run,
+        }
+
+
+# Global instance
+retention = RetentionJob(
+    memory,
+    retention_days=MEMORY_RETENTION_DAYS,
+    batch_size=MEMORY_RETENTION_BATCH_SIZE,
+    pause_seconds=MEMORY_RETENTION_PAUSE_SECONDS,
+    max_batches_per_run=MEMORY_RETENTION_MAX_BATCHES,
+    interval_seconds=MEMORY_RETENTION_INTERVAL_MINUTES * 60,
+)
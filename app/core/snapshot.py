@@ -0,0 +1,137 @@
+"""
+Warm-start snapshots of in-process caches.
+
+On graceful shutdown the hot cache entries are written to one local file; on
+startup the file is memory-mapped and only its index is read. Entries are
+decoded lazily, the first time their key is requested, so startup stays
+instant however large the snapshot is. Each entry carries the version stamp it
+had when written; callers compare it with the database before trusting it.
+
+File layout:
+    header  struct "<8sdI": magic, written_at (epoch), index length
+    index   codec blob: {section: [[key, version, offset, length], ...]}
+    data    concatenated entry blobs (offsets relative to the data start)
+"""
+
+import logging
+import mmap
+import os
+import struct
+import time
+from typing import Dict, Iterable, Optional, Tuple
+
+from .codecs import CodecError, decode, get_codec
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"CXSNAP01"
+_HEADER = struct.Struct("<8sdI")
+INDEX_SCHEMA_VERSION = 1
+
+SnapshotEntry = Tuple[str, int, bytes]  # key, version, blob
+
+
+def write_snapshot(path: str, sections: Dict[str, Iterable[SnapshotEntry]]) -> int:
+    """
+    Write every section to `path` atomically (temp file + rename).
+    Returns how many entries were written.
+    """
+    index: Dict[str, list] = {}
+    chunks = []
+    offset = 0
+    for section, entries in sections.items():
+        rows = index.setdefault(section, [])
+        for key, version, blob in entries:
+            rows.append([key, version, offset, len(blob)])
+            chunks.append(blob)
+            offset += len(blob)
+
+    index_blob = get_codec().encode(index, INDEX_SCHEMA_VERSION)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, time.time(), len(index_blob)))
+        f.write(index_blob)
+        for chunk in chunks:
+            f.write(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return len(chunks)
+
+
+class CacheSnapshot:
+    """Read side of a snapshot: a memory-mapped file plus its index."""
+
+    def __init__(self, path: str, written_at: float, index: Dict[str, Dict[str, Tuple[int, int, int]]],
+                 mapped: mmap.mmap, data_start: int):
+        self.path = path
+        self.written_at = written_at
+        self._index = index
+        self._mmap = mapped
+        self._data_start = data_start
+        self.taken = 0
+
+    @classmethod
+    def open(cls, path: str, max_age_seconds: Optional[float] = None) -> Optional["CacheSnapshot"]:
+        """Map a snapshot file. Returns None when it is missing, too old or unreadable."""
+        try:
+            with open(path, "rb") as f:
+                if os.fstat(f.fileno()).st_size < _HEADER.size:
+                    return None
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logger.warning(f"Could not open cache snapshot {path}: {e}")
+            return None
+
+        try:
+            magic, written_at, index_length = _HEADER.unpack_from(mapped, 0)
+            if magic != MAGIC:
+                raise CodecError("Not a cache snapshot")
+            age = time.time() - written_at
+            if max_age_seconds is not None and age > max_age_seconds:
+                logger.info(f"Ignoring cache snapshot {path}: {age / 60:.0f} minutes old")
+                mapped.close()
+                return None
+            schema_version, rows = decode(mapped[_HEADER.size:_HEADER.size + index_length])
+            if schema_version != INDEX_SCHEMA_VERSION:
+                raise CodecError(f"Unsupported snapshot index version {schema_version}")
+        except (CodecError, ValueError, struct.error) as e:
+            logger.warning(f"Ignoring unreadable cache snapshot {path}: {e}")
+            mapped.close()
+            return None
+
+        index = {
+            section: {key: (version, offset, length) for key, version, offset, length in entries}
+            for section, entries in rows.items()
+        }
+        snapshot = cls(path, written_at, index, mapped, _HEADER.size + index_length)
+        logger.info(f"Mapped cache snapshot {path}: {snapshot.remaining()} entries")
+        return snapshot
+
+    def take(self, section: str, key: str) -> Optional[Tuple[int, bytes]]:
+        """
+        Return (version, blob) for `key` and forget it: each entry is restored at most
+        once, after which the live cache owns that key.
+        """
+        entry = self._index.get(section, {}).pop(key, None)
+        if entry is None or self._mmap.closed:
+            return None
+        version, offset, length = entry
+        start = self._data_start + offset
+        self.taken += 1
+        blob = self._mmap[start:start + length]
+        if not self.remaining():
+            self.close()
+        return version, blob
+
+    def remaining(self, section: Optional[str] = None) -> int:
+        if section is not None:
+            return len(self._index.get(section, {}))
+        return sum(len(entries) for entries in self._index.values())
+
+    def close(self):
+        self._index = {}
+        if not self._mmap.closed:
+            self._mmap.close()
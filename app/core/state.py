@@ -4,7 +4,52 @@ This defines what information flows through our conversation graph.
 """
 
 from typing import TypedDict, Annotated, Sequence, Optional, Dict, Any, List
-from langchain_core.messages import BaseMessage
+from langchain_core.messages import BaseMessage, RemoveMessage, ToolMessage
+from langgraph.graph.message import REMOVE_ALL_MESSAGES, add_messages
+
+from ..config import CHAT_STATE_MAX_MESSAGES
+
+
+def merge_messages(left: Sequence[BaseMessage], right: Sequence[BaseMessage]) -> List[BaseMessage]:
+    """
+    Message reducer for ChatState.
+    
+    ID-aware like LangGraph's add_messages: a message with a known id replaces the
+    old one, RemoveMessage(id) deletes it and RemoveMessage(REMOVE_ALL_MESSAGES)
+    starts over. The result is then capped to the newest CHAT_STATE_MAX_MESSAGES,
+    so a thread's checkpoint cannot grow without bound. Tool results whose tool
+    call was cut off are dropped as well; the LLM APIs reject them.
+    """
+    merged = add_messages(left, right)
+    if len(merged) > CHAT_STATE_MAX_MESSAGES:
+        merged = merged[-CHAT_STATE_MAX_MESSAGES:]
+        while merged and isinstance(merged[0], ToolMessage):
+            merged.pop(0)
+    return merged
+
+
+def sync_messages(current: Sequence[BaseMessage], target: Sequence[BaseMessage],
+                  rebuild_tail: Sequence[BaseMessage] = ()) -> List[BaseMessage]:
+    """
+    Smallest merge_messages update that turns `current` into `target`.
+    
+    When every message of `target` already in `current` is a prefix of `target`,
+    the update is only removals plus the new suffix of `target`. Anything else
+    (history reloaded after a restart, edited elsewhere) is a full rebuild:
+    REMOVE_ALL, then `target`, then `rebuild_tail`.
+    """
+    target_ids = [msg.id for msg in target]
+    wanted = set(target_ids)
+    kept = [msg.id for msg in current if msg.id in wanted]
+    if kept != target_ids[:len(kept)]:
+        return [RemoveMessage(id=REMOVE_ALL_MESSAGES), *target, *rebuild_tail]
+    
+    delta: List[BaseMessage] = [RemoveMessage(id=msg.id) for msg in current if msg.id not in wanted]
+    missing = list(target[len(kept):])
+    if missing and rebuild_tail:
+        # New history would land after the tail; only a rebuild keeps the order
+        return [RemoveMessage(id=REMOVE_ALL_MESSAGES), *target, *rebuild_tail]
+    return delta + missing
 
 
 class ChatState(TypedDict):
@@ -16,9 +61,10 @@ class ChatState(TypedDict):
     
     # Core conversation data
     user_id: str                                    # Unique identifier for the user
-    messages: Annotated[Sequence[BaseMessage], lambda x, y: x + y]  # Conversation history
+    messages: Annotated[Sequence[BaseMessage], merge_messages]  # Conversation history (windowed)
     
     # Contextual information
+    conversation_summary: Optional[str]             # Rolling summary of history older than the window
     mensaje_dividido: Optional[List[Dict[str, str]]] = None
     tool_results: Optional[Dict[str, Any]]
     
@@ -0,0 +1,99 @@
+"""
+Rolling summarization of conversation history that fell out of the window.
+Older turns are folded into a compact summary kept in session_metadata, so the
+prompt stays bounded however long the conversation runs.
+"""
+
+import logging
+from typing import Any, Optional, Sequence
+
+from .tokens import estimate_tokens, truncate_to_tokens
+
+logger = logging.getLogger(__name__)
+
+
+class Summarizer:
+    """
+    Folds evicted messages into a running summary.
+    Messages are StoredMessage tuples (role, content, ...), oldest first.
+    """
+
+    max_summary_tokens = 250
+
+    async def summarize(self, previous_summary: str, messages: Sequence[Any]) -> str:
+        raise NotImplementedError
+
+
+class ExtractiveSummarizer(Summarizer):
+    """
+    Deterministic, offline summarizer.
+    Keeps one short line per message and drops the oldest lines once over budget.
+    """
+
+    def __init__(self, max_summary_tokens: int = 250, max_line_tokens: int = 30):
+        self.max_summary_tokens = max_summary_tokens
+        self.max_line_tokens = max_line_tokens
+
+    async def summarize(self, previous_summary: str, messages: Sequence[Any]) -> str:
+        lines = previous_summary.splitlines() if previous_summary else []
+        for message in messages:
+            speaker = "Cliente" if message.role == "human" else "Juan"
+            text = " ".join(str(message.content).split())
+            short = truncate_to_tokens(text, self.max_line_tokens)
+            if short != text:
+                short += "..."
+            lines.append(f"- {speaker}: {short}")
+
+        # Oldest lines go first when the summary outgrows its budget
+        while len(lines) > 1 and estimate_tokens("\n".join(lines)) > self.max_summary_tokens:
+            lines.pop(0)
+        return "\n".join(lines)
+
+
+class LLMSummarizer(Summarizer):
+    """Abstractive summarizer backed by a chat model (async call)."""
+
+    def __init__(self, llm: Any = None, max_summary_tokens: int = 250):
+        self.max_summary_tokens = max_summary_tokens
+        self._llm = llm
+
+    @property
+    def llm(self) -> Any:
+        if self._llm is None:
+            from langchain_openai import ChatOpenAI
+            from ..config import OPENAI_MODEL
+            self._llm = ChatOpenAI(
+                model=OPENAI_MODEL,
+                temperature=0,
+                max_retries=2,
+                timeout=10,
+                max_tokens=self.max_summary_tokens
+            )
+        return self._llm
+
+    async def summarize(self, previous_summary: str, messages: Sequence[Any]) -> str:
+        from .prompts import SUMMARY_PROMPT
+
+        transcript = "\n".join(
+            f"{'Cliente' if message.role == 'human' else 'Juan'}: {message.content}"
+            for message in messages
+        )
+        prompt = [
+            ("system", SUMMARY_PROMPT.format(max_tokens=self.max_summary_tokens)),
+            ("human", f"RESUMEN ACTUAL:\n{previous_summary or '(vacío)'}\n\nMENSAJES NUEVOS:\n{transcript}")
+        ]
+        response = await self.llm.ainvoke(prompt)
+        summary = response.content if isinstance(response.content, str) else str(response.content)
+        return truncate_to_tokens(summary.strip(), self.max_summary_tokens)
+
+
+def build_summarizer(name: Optional[str]) -> Optional[Summarizer]:
+    """Create the summarizer selected by config ("extractive", "llm" or "off")."""
+    if not name or name == "off":
+        return None
+    if name == "extractive":
+        return ExtractiveSummarizer()
+    if name == "llm":
+        return LLMSummarizer()
+    logger.warning(f"Unknown summarizer '{name}', falling back to extractive")
+    return ExtractiveSummarizer()
@@ -0,0 +1,117 @@
+"""
+Local token estimation for prompt budgeting.
+Uses tiktoken when it is installed, otherwise a fast regex heuristic tuned for
+Spanish chat text. Neither calls the provider.
+"""
+
+import logging
+import re
+from typing import Any, Dict, Iterable, Optional
+
+from ..config import MEMORY_TOKEN_BUDGET, OPENAI_MODEL
+
+logger = logging.getLogger(__name__)
+
+try:
+    import tiktoken
+except ImportError:  # Optional: the heuristic is close enough for budgeting
+    tiktoken = None
+
+# Words, numbers and single punctuation marks
+_PIECE_RE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+
+# Per-message framing the chat APIs add around every message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Conversation-history budget per model family (prefix match, most specific first)
+MODEL_TOKEN_BUDGETS: Dict[str, int] = {
+    "gpt-4o-mini": 1500,
+    "gpt-4o": 2000,
+    "gemini": 2000,
+    "meta-llama": 1200,
+}
+DEFAULT_TOKEN_BUDGET = 1500
+
+_encoding = None
+if tiktoken is not None:
+    try:
+        _encoding = tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        logger.warning(f"tiktoken encoding unavailable, using heuristic: {e}")
+
+
+def estimate_tokens(text: Any) -> int:
+    """Estimate how many tokens `text` costs in a prompt."""
+    if not text:
+        return 0
+    if not isinstance(text, str):
+        text = str(text)
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    # Short pieces are one token; long words split roughly every 4 characters
+    return sum(1 + (len(piece) - 1) // 4 for piece in _PIECE_RE.findall(text))
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Cut `text` so it fits in roughly `max_tokens`, on a piece boundary."""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    used = 0
+    for match in _PIECE_RE.finditer(text):
+        piece = match.group(0)
+        used += 1 + (len(piece) - 1) // 4
+        if used > max_tokens:
+            return text[:match.start()].rstrip()
+    return text
+
+
+def get_token_budget(model: Optional[str] = None) -> int:
+    """History token budget for a model. MEMORY_TOKEN_BUDGET overrides the table."""
+    if MEMORY_TOKEN_BUDGET:
+        return MEMORY_TOKEN_BUDGET
+    model = model or OPENAI_MODEL or ""
+    for prefix, budget in MODEL_TOKEN_BUDGETS.items():
+        if model.startswith(prefix):
+            return budget
+    return DEFAULT_TOKEN_BUDGET
+
+
+class PromptTokenMeter:
+    """Running totals of estimated prompt tokens actually sent to the LLM."""
+
+    def __init__(self):
+        self.prompts = 0
+        self.total_tokens = 0
+        self.static_tokens = 0  # Leading tokens identical across turns (see core/prompt_layout.py)
+        self.max_tokens = 0
+        self.last_tokens = 0
+
+    def record(self, messages: Iterable[Any], static_tokens: int = 0) -> int:
+        """
+        Estimate and record one prompt. Accepts (role, content) tuples or message objects.
+        `static_tokens` is how much of it is the shared static prefix.
+        """
+        tokens = 0
+        for message in messages:
+            content = message[1] if isinstance(message, tuple) else getattr(message, "content", message)
+            tokens += estimate_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+        self.prompts += 1
+        self.total_tokens += tokens
+        self.static_tokens += min(static_tokens, tokens)
+        self.max_tokens = max(self.max_tokens, tokens)
+        self.last_tokens = tokens
+        return tokens
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "prompts": self.prompts,
+            "avg_tokens": round(self.total_tokens / self.prompts, 1) if self.prompts else 0.0,
+            "avg_static_prefix_tokens": round(self.static_tokens / self.prompts, 1) if self.prompts else 0.0,
+            "static_prefix_share": round(self.static_tokens / self.total_tokens, 4) if self.total_tokens else 0.0,
+            "max_tokens": self.max_tokens,
+            "last_tokens": self.last_tokens,
+        }
+
+
+# Global instance
+prompt_tokens = PromptTokenMeter()
@@ -0,0 +1,163 @@
+"""
+Tool execution for the graphs' "tools" node (replaces ToolNode(ALL_TOOLS)).
+
+When the model asks for several tools in one message (get_customer +
+search_menu + get_active_order), the read-only ones run concurrently on a
+bounded thread pool of TOOL_EXECUTOR_MAX_WORKERS threads; async tools are
+awaited directly. A tool that writes runs alone, after every call before it
+finished and before any call after it starts, so "create_customer, then
+create_or_update_order" still finds its customer. Results are ToolMessages in
+tool_call order whatever finishes first, formatted like ToolNode's, and every
+call's latency is recorded per tool.
+
+Worker threads run with a copy of the caller's contextvars, so parallel
+lookups still share the request-scoped loader (core/loader.py).
+"""
+
+import asyncio
+import contextvars
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from langchain_core.messages import AIMessage, ToolMessage
+from langchain_core.runnables import RunnableConfig
+from langchain_core.tools import BaseTool
+
+from .tools import ALL_TOOLS, PARALLEL_SAFE_TOOLS
+from ..config import TOOL_EXECUTOR_MAX_WORKERS
+
+logger = logging.getLogger(__name__)
+
+
+def _content(output: Any) -> Any:
+    """ToolMessage content the way ToolNode formats it: strings as is, anything else as JSON."""
+    if isinstance(output, str):
+        return output
+    try:
+        return json.dumps(output, ensure_ascii=False)
+    except Exception:
+        return str(output)
+
+
+class _ToolStats:
+    __slots__ = ("calls", "errors", "total_seconds", "max_seconds")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def record(self, seconds: float, failed: bool):
+        self.calls += 1
+        self.errors += failed
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "avg_ms": round(self.total_seconds / self.calls * 1000, 2) if self.calls else 0.0,
+            "max_ms": round(self.max_seconds * 1000, 2),
+        }
+
+
+class ToolExecutor:
+    """Runs one message's tool calls: read-only ones concurrently, writes one at a time in order."""
+
+    def __init__(self, tools: Sequence[BaseTool], read_only: Iterable[BaseTool] = (), max_workers: int = 8):
+        self.tools_by_name: Dict[str, BaseTool] = {tool.name: tool for tool in tools}
+        self.read_only = frozenset(tool.name for tool in read_only)
+        self.max_workers = max_workers
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tools")
+        self._tool_stats: Dict[str, _ToolStats] = {}
+
+        self.batches = 0  # Model messages with tool calls
+        self.calls = 0
+        self.concurrent_calls = 0  # Calls that ran alongside at least one other
+        self.total_seconds = 0.0  # Wall time of whole batches
+
+    async def node(self, state: Dict[str, Any], config: RunnableConfig) -> Dict[str, Any]:
+        """Graph node: ToolMessages for the tool calls of the last AI message."""
+        message = state["messages"][-1] if state["messages"] else None
+        calls = list(message.tool_calls) if isinstance(message, AIMessage) else []
+        return {"messages": await self.run(calls, config)}
+
+    async def run(self, calls: List[Dict[str, Any]], config: Optional[RunnableConfig] = None) -> List[ToolMessage]:
+        started = time.perf_counter()
+        results: List[Optional[ToolMessage]] = [None] * len(calls)
+        group: List[Tuple[int, Dict[str, Any]]] = []
+
+        async def run_group():
+            if len(group) > 1:
+                self.concurrent_calls += len(group)
+            messages = await asyncio.gather(*(self._run_one(call, config) for _, call in group))
+            for (position, _), tool_message in zip(group, messages):
+                results[position] = tool_message
+            group.clear()
+
+        for position, call in enumerate(calls):
+            if call["name"] in self.read_only:
+                group.append((position, call))
+                continue
+            # A write (or unknown tool) waits for the reads before it and runs alone
+            await run_group()
+            results[position] = await self._run_one(call, config)
+        await run_group()
+
+        self.batches += 1
+        self.calls += len(calls)
+        self.total_seconds += time.perf_counter() - started
+        return results
+
+    async def _run_one(self, call: Dict[str, Any], config: Optional[RunnableConfig]) -> ToolMessage:
+        name = call["name"]
+        tool = self.tools_by_name.get(name)
+        if tool is None:
+            return ToolMessage(
+                content=f"Error: {name} is not a valid tool, try one of [{', '.join(self.tools_by_name)}].",
+                name=name, tool_call_id=call["id"], status="error",
+            )
+
+        tool_input = {**call, "type": "tool_call"}  # The tool answers with a ToolMessage for this call
+        started = time.perf_counter()
+        failed = False
+        try:
+            if getattr(tool, "coroutine", None) is not None:  # Natively async tool
+                response = await tool.ainvoke(tool_input, config)
+            else:
+                loop = asyncio.get_running_loop()
+                ctx = contextvars.copy_context()
+                response = await loop.run_in_executor(self._pool, ctx.run, tool.invoke, tool_input, config)
+        except Exception as e:
+            failed = True
+            logger.error(f"Tool {name} failed: {e}")
+            response = ToolMessage(
+                content=f"Error: {e!r}\n Please fix your mistakes.",
+                name=name, tool_call_id=call["id"], status="error",
+            )
+        finally:
+            self._tool_stats.setdefault(name, _ToolStats()).record(time.perf_counter() - started, failed)
+
+        if not isinstance(response, ToolMessage):
+            return ToolMessage(content=_content(response), name=name, tool_call_id=call["id"])
+        response.content = _content(response.content)
+        return response
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_workers": self.max_workers,
+            "batches": self.batches,
+            "calls": self.calls,
+            "concurrent_calls": self.concurrent_calls,
+            "avg_batch_ms": round(self.total_seconds / self.batches * 1000, 2) if self.batches else 0.0,
+            "tools": {name: stats.to_dict() for name, stats in sorted(self._tool_stats.items())},
+        }
+
+
+# Global instance
+tool_executor = ToolExecutor(ALL_TOOLS, read_only=PARALLEL_SAFE_TOOLS, max_workers=TOOL_EXECUTOR_MAX_WORKERS)
@@ -6,7 +6,8 @@ All tools are organized here for easy understanding and maintenance.
 import logging
 from typing import Dict, Any, List, Optional
 from langchain_core.tools import tool
-from ..config import supabase
+from . import loader
+from .db import db
 
 logger = logging.getLogger(__name__)
 
@@ -15,6 +16,11 @@ logger = logging.getLogger(__name__)
 # CUSTOMER MANAGEMENT TOOLS
 # =============================================================================
 
+def _fetch_customer(user_id: str) -> Dict[str, Any]:
+    result = db.execute_sync(db.table("clientes").select("*").eq("user_id", user_id).limit(1))
+    return result.data[0] if result.data else {}
+
+
 @tool
 def get_customer(user_id: str) -> Dict[str, Any]:
     """
@@ -22,9 +28,9 @@ def get_customer(user_id: str) -> Dict[str, Any]:
     Returns customer data or empty dict if not found.
     """
     try:
-        result = supabase.table("clientes").select("*").eq("user_id", user_id).limit(1).execute()
-        if result.data:
-            customer = result.data[0]
+        # Fetched once per request, however many nodes and tools ask for it
+        customer = loader.load("customer", user_id, lambda: _fetch_customer(user_id))
+        if customer:
             logger.info(f"Customer found: {customer.get('first_name', 'Unknown')}")
             return customer
         else:
@@ -59,9 +65,11 @@ def create_customer(user_id: str, first_name: str, last_name: str, phone: str =
             "email": email
         }
         
-        result = supabase.table("clientes").insert(customer_data).execute()
+        loader.invalidate("customer", user_id)
+        result = db.execute_sync(db.table("clientes").insert(customer_data))
         if result.data:
             logger.info(f"Customer created successfully: {first_name} {last_name} with user_id: {user_id}")
+            loader.prime("customer", user_id, result.data[0])
             return result.data[0]
         else:
             logger.error("Failed to create customer - no data returned")
@@ -90,9 +98,11 @@ def update_customer(user_id: str, **updates) -> Dict[str, Any]:
         if not clean_updates:
             return get_customer(user_id)
         
-        result = supabase.table("clientes").update(clean_updates).eq("user_id", user_id).execute()
+        loader.invalidate("customer", user_id)
+        result = db.execute_sync(db.table("clientes").update(clean_updates).eq("user_id", user_id))
         if result.data:
             logger.info(f"Customer updated: {user_id}")
+            loader.prime("customer", user_id, result.data[0])
             return result.data[0]
         else:
             logger.error("Failed to update customer - no data returned")
@@ -112,7 +122,7 @@ def search_menu(query: str) -> List[Dict[str, Any]]:
     Search menu items by name or description.
     """
     try:
-        result = supabase.table("menu").select("*").eq("active", True).ilike("name", f"%{query}%").execute()
+        result = db.execute_sync(db.table("menu").select("*").eq("active", True).ilike("name", f"%{query}%"))
         if result.data:
             logger.info(f"Menu search '{query}': {len(result.data)} items found")
             return result.data
@@ -151,21 +161,26 @@ def send_full_menu() -> str:
 # ORDER MANAGEMENT TOOLS
 # =============================================================================
 
+def _fetch_active_order(customer_id: Any) -> Dict[str, Any]:
+    result = db.execute_sync(db.table("pedidos_activos").select("*").eq("cliente_id", customer_id).limit(1))
+    return result.data[0] if result.data else {}
+
+
 @tool
 def get_active_order(user_id: str) -> Dict[str, Any]:
     """
     Get the active order for a customer.
     """
     try:
-        # First get customer
+        # First get customer (memoized per request)
         customer = get_customer(user_id)
         if not customer:
             return {}
         
-        result = supabase.table("pedidos_activos").select("*").eq("cliente_id", customer["id"]).limit(1).execute()
-        if result.data:
+        order = loader.load("active_order", user_id, lambda: _fetch_active_order(customer["id"]))
+        if order:
             logger.info(f"Active order found for customer {customer['first_name']}")
-            return result.data[0]
+            return order
         else:
             logger.info(f"No active order for customer {customer['first_name']}")
             return {}
@@ -202,9 +217,10 @@ def create_or_update_order(user_id: str, items: List[Dict[str, Any]], subtotal:
             "updated_at": "now()"
         }
         
+        loader.invalidate("active_order", user_id)
         if existing_order:
             # Update existing order - only update cart and subtotal
-            result = supabase.table("pedidos_activos").update(order_data).eq("id", existing_order["id"]).execute()
+            result = db.execute_sync(db.table("pedidos_activos").update(order_data).eq("id", existing_order["id"]))
             logger.info(f"Order updated for customer {customer['first_name']}")
         else:
             # Create new order - require direccion and metodo_de_pago
@@ -224,9 +240,11 @@ def create_or_update_order(user_id: str, items: List[Dict[str, Any]], subtotal:
                 "status": "creado"
             })
             
-            result = supabase.table("pedidos_activos").insert(order_data).execute()
+            result = db.execute_sync(db.table("pedidos_activos").insert(order_data))
             logger.info(f"New order created for customer {customer['first_name']} with address: {direccion}")
         
+        if result.data:
+            loader.prime("active_order", user_id, result.data[0])
         return result.data[0] if result.data else {}
     except Exception as e:
         logger.error(f"Error creating/updating order for {user_id}: {e}")
@@ -265,11 +283,12 @@ def finalize_order(user_id: str, total: float) -> Dict[str, Any]:
         }
         
         # Insert into finalized orders
-        result = supabase.table("pedidos_finalizados").insert(finalized_order_data).execute()
+        result = db.execute_sync(db.table("pedidos_finalizados").insert(finalized_order_data))
         
         if result.data:
             # Remove from active orders
-            supabase.table("pedidos_activos").delete().eq("id", active_order["id"]).execute()
+            db.execute_sync(db.table("pedidos_activos").delete().eq("id", active_order["id"]))
+            loader.prime("active_order", user_id, {})
             logger.info(f"Order finalized for customer {customer['first_name']}")
             return result.data[0]
         else:
@@ -291,9 +310,11 @@ def update_customer_address(user_id: str, direccion: str) -> Dict[str, Any]:
         direccion: New address
     """
     try:
-        result = supabase.table("clientes").update({"direccion": direccion}).eq("user_id", user_id).execute()
+        loader.invalidate("customer", user_id)
+        result = db.execute_sync(db.table("clientes").update({"direccion": direccion}).eq("user_id", user_id))
         if result.data:
             logger.info(f"Address updated for customer {user_id}")
+            loader.prime("customer", user_id, result.data[0])
             return result.data[0]
         else:
             logger.error("Failed to update address")
@@ -313,4 +334,7 @@ MENU_TOOLS = [search_menu, send_full_menu]  # Removed get_menu - only use search
 ORDER_TOOLS = [get_active_order, create_or_update_order, finalize_order]
 
 # Complete tool list for the agent
-ALL_TOOLS = CUSTOMER_TOOLS + MENU_TOOLS + ORDER_TOOLS 
\ No newline at end of file
+ALL_TOOLS = CUSTOMER_TOOLS + MENU_TOOLS + ORDER_TOOLS 
+
+# Tools that only read: several of them in one turn can run concurrently (see core/tool_executor.py)
+PARALLEL_SAFE_TOOLS = [get_customer, search_menu, send_full_menu, get_active_order]
@@ -1,11 +1,13 @@
 import logging
 from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 import json
-from typing import Dict, Any
+from typing import AsyncIterator, Dict, Any
 
 # Import the new smart memory system
-from .core.smart_graph import smart_process_message
+from .core.smart_graph import process_message as smart_process_message
+from .core.smart_graph import stream_message as smart_stream_message
 from .config import GOOGLE_API_KEY
 
 logger = logging.getLogger(__name__)
@@ -25,6 +27,24 @@ class Msg(BaseModel):
 
 app = FastAPI()
 
+@app.on_event("startup")
+async def start_background_jobs():
+    """Start the periodic memory retention job and map the warm-start snapshot."""
+    from .core.memory import memory
+    from .core.retention import retention
+    memory.load_snapshot()
+    retention.start()
+
+@app.on_event("shutdown")
+async def stop_background_jobs():
+    from .core.memory import memory
+    from .core.retention import retention
+    await retention.stop()
+    # A summary still folding would be lost, or snapshotted at a version its save then bumps
+    await memory.wait_for_background()
+    await memory.save_snapshot()
+    await memory.close_channel()
+
 def parse_response_for_n8n(response: str) -> Dict[str, Any]:
     """
     Parse Juan's response to determine if it contains image commands.
@@ -90,11 +110,86 @@ async def route(msg: Msg):
             "image_path": ""
         }
 
+def _sse(event: str, data: Dict[str, Any]) -> str:
+    """One Server-Sent Events frame."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+async def _agent_events(msg: Msg) -> AsyncIterator[str]:
+    events = smart_stream_message(msg.user_id, msg.text)
+    try:
+        async for event in events:
+            if event["type"] == "token":
+                yield _sse("token", {"text": event["text"]})
+            else:
+                # Same payload as /v1/agent, once the turn is saved
+                parsed_response = parse_response_for_n8n(event["response"])
+                yield _sse("done", {
+                    "response": parsed_response["text"],
+                    "message_type": parsed_response["message_type"],
+                    "has_image": parsed_response["has_image"],
+                    "image_path": parsed_response["image_path"]
+                })
+    except Exception as e:
+        logger.error(f"Error streaming agent response for {msg.user_id}: {e}")
+        yield _sse("done", {
+            "response": "Perdón, tuve un problema técnico. En que más te puedo ayudar?",
+            "message_type": "text",
+            "has_image": False,
+            "image_path": ""
+        })
+    finally:
+        # Also runs on client disconnect: Starlette cancels the response mid-iteration
+        await events.aclose()
+
+@app.post("/v1/agent/stream")
+async def route_stream(msg: Msg):
+    """
+    Streaming variant of /v1/agent (Server-Sent Events).
+    "token" events carry reply text as the model writes it; a final "done" event
+    carries the same fields /v1/agent returns, after the turn is persisted.
+    """
+    return StreamingResponse(
+        _agent_events(msg),
+        media_type="text/event-stream",
+        # Proxies must not buffer the stream, or the first token arrives with the last
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.get("/v1/health")
 async def health():
     """Health check endpoint."""
     return {"status": "healthy", "memory_system": "smart_memory_enabled"}
 
+@app.get("/v1/memory/stats")
+async def get_global_memory_stats():
+    """
+    Process-wide stats for every in-process cache (hits, misses, evictions, size)
+    the database I/O pool, the estimated prompt tokens sent to the LLM, the
+    retention job's progress, state hydration latency, the lookups the
+    per-request loader saved, how many messages the menu fast path answered
+    without the LLM, how often a cached reply was reused and per-tool latency.
+    """
+    from .core.cache import get_cache_stats
+    from .core.db import db
+    from .core.tokens import prompt_tokens
+    from .core.retention import retention
+    from .core.checkpointer import state_manager
+    from .core.loader import request_loads
+    from .core.catalog import menu_fast_path
+    from .core.response_cache import response_cache
+    from .core.tool_executor import tool_executor
+    return {
+        "caches": get_cache_stats(),
+        "database": db.stats(),
+        "prompt_tokens": prompt_tokens.stats(),
+        "retention": retention.stats(),
+        "state_hydration": state_manager.stats(),
+        "request_loader": request_loads.stats(),
+        "menu_fast_path": menu_fast_path.stats(),
+        "response_cache": response_cache.stats(),
+        "tools": tool_executor.stats()
+    }
+
 @app.get("/v1/memory/stats/{user_id}")
 async def get_memory_stats(user_id: str):
     """
@@ -102,8 +197,8 @@ async def get_memory_stats(user_id: str):
     Useful for debugging and monitoring.
     """
     try:
-        from .core.smart_memory import smart_memory
-        stats = await smart_memory.get_conversation_stats(user_id)
+        from .core.memory import memory
+        stats = await memory.get_conversation_stats(user_id)
         return {"user_id": user_id, "stats": stats}
     except Exception as e:
         logger.error(f"Error getting memory stats for {user_id}: {e}")
@@ -112,13 +207,13 @@ async def get_memory_stats(user_id: str):
 @app.post("/v1/memory/cleanup")
 async def cleanup_old_conversations():
     """
-    Manually trigger cleanup of old conversations.
-    In production, this should be called via a cron job.
+    Manually trigger a retention run now.
+    Runs also happen on a schedule (MEMORY_RETENTION_INTERVAL_MINUTES).
     """
     try:
-        from .core.smart_memory import smart_memory
-        cleaned_count = await smart_memory.cleanup_old_conversations()
-        return {"message": f"Cleaned up {cleaned_count} old conversations"}
+        from .core.retention import retention
+        cleaned_count = await retention.run_once()
+        return {"message": f"Cleaned up {cleaned_count} old conversations", "retention": retention.stats()}
     except Exception as e:
         logger.error(f"Error during cleanup: {e}")
         return {"error": "Cleanup failed"}
@@ -0,0 +1,61 @@
+-- Append-only Message Log for Pizzeria Chatbot
+-- Used when MEMORY_STORAGE_MODE=append_log.
+-- Each message is inserted once as its own row instead of rewriting the whole
+-- recent_messages JSONB array on every save.
+--
+-- NOTE: the application stores conversations in the table `conversation_memory`
+-- (MemoryManager.table_name). If you created it from smart_memory_schema.sql
+-- under the name smart_conversation_memory, adjust the names below.
+
+-- Create the message log table
+CREATE TABLE IF NOT EXISTS conversation_messages (
+    thread_id TEXT NOT NULL
+        REFERENCES conversation_memory(thread_id) ON DELETE CASCADE,  -- Cleanup of a conversation removes its log
+    seq BIGINT NOT NULL,                                              -- Position of the message in the conversation (0, 1, 2...)
+    role TEXT NOT NULL CHECK (role IN ('human', 'assistant')),
+    content TEXT NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    PRIMARY KEY (thread_id, seq)
+);
+
+-- The primary key index on (thread_id, seq) serves the window read:
+--   SELECT seq, role, content, created_at FROM conversation_messages
+--   WHERE thread_id = $1 ORDER BY seq DESC LIMIT <MEMORY_MAX_MESSAGES>;  -- 40 by default
+-- as a single backward range scan, so no second index on those columns is needed
+-- (it would only add work to every append).
+-- Deployments that ran an earlier version of this file can drop the duplicate:
+DROP INDEX IF EXISTS idx_conversation_messages_thread_seq;
+
+CREATE INDEX IF NOT EXISTS idx_conversation_messages_created_at
+ON conversation_messages(created_at);
+
+
+-- =============================================================================
+-- Migration of existing rows
+-- =============================================================================
+-- Copies every recent_messages JSONB window into the log, numbering messages
+-- by their position in the array. Safe to run more than once.
+-- The application also migrates lazily: in append_log mode, a conversation
+-- with no log rows has its JSONB window written to the log on its next save.
+
+INSERT INTO conversation_messages (thread_id, seq, role, content, created_at)
+SELECT
+    m.thread_id,
+    COALESCE((e.value->>'seq')::BIGINT, e.ordinality - 1),
+    e.value->>'role',
+    COALESCE(e.value->>'content', ''),
+    COALESCE((e.value->>'timestamp')::TIMESTAMP WITH TIME ZONE, m.last_activity)
+FROM conversation_memory m
+CROSS JOIN LATERAL jsonb_array_elements(m.recent_messages) WITH ORDINALITY AS e(value, ordinality)
+WHERE jsonb_typeof(m.recent_messages) = 'array'
+ON CONFLICT (thread_id, seq) DO NOTHING;
+
+-- Once MEMORY_STORAGE_MODE=append_log is deployed and verified, the JSONB
+-- windows are no longer read and can be emptied to reclaim space:
+-- UPDATE conversation_memory SET recent_messages = '[]' WHERE recent_messages <> '[]';
+
+-- Query examples for reference:
+
+-- Message count per conversation
+-- SELECT thread_id, MAX(seq) + 1 AS message_count
+-- FROM conversation_messages GROUP BY thread_id;
@@ -8,7 +8,8 @@ CREATE TABLE IF NOT EXISTS smart_conversation_memory (
     recent_messages JSONB DEFAULT '[]',            -- Array of recent messages (sliding window)
     session_metadata JSONB DEFAULT '{}',           -- Additional session data
     last_activity TIMESTAMP WITH TIME ZONE DEFAULT NOW(),  -- Last time conversation was updated
-    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()      -- When conversation started
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),     -- When conversation started
+    version BIGINT NOT NULL DEFAULT 0                      -- Bumped on every save (see versioning_schema.sql)
 );
 
 -- Create indexes for performance
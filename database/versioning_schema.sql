@@ -0,0 +1,20 @@
+-- Version Stamps for Conversation Memory
+-- REQUIRED by MemoryManager: every save writes `version`, so saves fail until
+-- this column exists. Tables created from the current smart_memory_schema.sql
+-- already have it; run this once on tables created before.
+--
+-- Workers use the version to tell whether their cached copy of a conversation
+-- is still current, and as a compare-and-set on save: a row is only updated
+-- WHERE version = <the version the worker loaded>. A worker that loses the race
+-- reloads the row and re-applies its new messages on top instead of
+-- overwriting the other worker's save.
+--
+-- NOTE: the application stores conversations in the table `conversation_memory`.
+
+ALTER TABLE conversation_memory
+ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0;
+
+-- Revalidation reads only this column, and the compare-and-set filters on it:
+--   SELECT version FROM conversation_memory WHERE thread_id = $1;
+--   UPDATE conversation_memory SET ... WHERE thread_id = $1 AND version = $2;
+-- both served by the thread_id primary key.
@@ -0,0 +1,1774 @@
+#!/usr/bin/env python3
+"""
+⏱️ BENCHMARKS - Pizzería Chatbot
+Micro-benchmarks for the memory and graph hot paths.
+Runs offline against the in-memory fake Supabase backend.
+
+    python tests/run_benchmarks.py            # run all
+    python tests/run_benchmarks.py memory     # run one
+"""
+
+import asyncio
+import gc
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+# Run against local in-memory tables, never the live service
+os.environ.setdefault("SUPABASE_BACKEND", "fake")
+# Graph benchmarks repeat the same messages to measure the model path; `response_cache` enables it itself
+os.environ.setdefault("RESPONSE_CACHE_ENABLED", "false")
+
+# Add the app directory to the Python path
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+BENCHMARKS = {}
+
+
+def benchmark(name: str):
+    """Register a benchmark under a CLI name."""
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def _sample_turn(conversation: int, turn: int) -> tuple[str, str]:
+    """A realistic human/assistant pair: short question, long-ish menu answer."""
+    human = f"Cuánto cuesta la pizza hawaiana mediana? ({conversation}-{turn})"
+    assistant = (
+        f"Claro que sí. La hawaiana mediana cuesta $42.000 y lleva jamón, piña y queso mozzarella. "
+        f"También la tenemos en tamaño personal y familiar. Te la agrego al pedido? ({conversation}-{turn}) "
+    ) * 3
+    return human, assistant
+
+
+# =============================================================================
+# MEMORY
+# =============================================================================
+
+@benchmark("memory")
+def bench_memory_per_conversation(conversations: int = 2000):
+    """
+    Bytes held per cached ConversationContext with a full message window.
+    Used to size MEMORY_CACHE_MAX_BYTES for a target number of active users.
+    """
+    from langchain_core.messages import HumanMessage, AIMessage
+    from app.core.memory import ConversationContext
+
+    window = ConversationContext.max_messages
+
+    def build_contexts():
+        contexts = []
+        for c in range(conversations):
+            context = ConversationContext(f"user_{c}")
+            context.update_customer_context("customer_name", f"Cliente {c}")
+            for t in range(window // 2):
+                human, assistant = _sample_turn(c, t)
+                context.add_message(HumanMessage(content=human))
+                context.add_message(AIMessage(content=assistant))
+            context.mark_saved()
+            contexts.append(context)
+        return contexts
+
+    def build_legacy_dicts():
+        # The previous representation: list of dicts with ISO timestamp strings
+        conversations_data = []
+        for c in range(conversations):
+            messages = []
+            for t in range(window // 2):
+                human, assistant = _sample_turn(c, t)
+                for role, content in (("human", human), ("assistant", assistant)):
+                    messages.append({
+                        "role": role,
+                        "content": content,
+                        "timestamp": datetime.now(timezone.utc).isoformat()
+                    })
+            conversations_data.append(({"customer_name": f"Cliente {c}"}, messages))
+        return conversations_data
+
+    def measure(build):
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        objects = build()
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        allocated = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+        return objects, allocated / conversations
+
+    contexts, per_context = measure(build_contexts)
+    _, per_legacy = measure(build_legacy_dicts)
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for context in contexts:
+        context.get_messages_for_llm()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    per_llm_cache = sum(stat.size_diff for stat in after.compare_to(before, "filename")) / conversations
+
+    estimate = sum(context.approx_size() for context in contexts) / conversations
+    actual = per_context + per_llm_cache
+
+    print(f"📦 Memory per conversation ({window} messages, {conversations} conversations)")
+    print(f"   • Legacy dict window:        {per_legacy:,.0f} B")
+    print(f"   • Slotted ring buffer:       {per_context:,.0f} B")
+    print(f"   • + cached LLM messages:     {per_llm_cache:,.0f} B")
+    print(f"   • approx_size() estimate:    {estimate:,.0f} B (actual {actual:,.0f} B)")
+    print(f"   • 100k active users:         {actual * 100_000 / 1024 ** 2:,.0f} MiB")
+    # MEMORY_CACHE_MAX_BYTES is enforced with approx_size(); keep it calibrated
+    assert abs(estimate - actual) / actual < 0.15, (estimate, actual)
+
+
+# =============================================================================
+# MEMORY BACKENDS
+# =============================================================================
+
+def _backends_under_test():
+    """Every MemoryBackend implementation, wired to local storage only."""
+    from app.core.db import AsyncSupabase
+    from app.core.fake_db import FakeSupabaseClient
+    from app.core.memory_backends import InMemoryBackend, SQLiteBackend, SupabaseBackend
+
+    sqlite_path = os.path.join(tempfile.mkdtemp(prefix="memory_bench_"), "memory.db")
+    return [
+        InMemoryBackend(),
+        SQLiteBackend(sqlite_path),
+        SupabaseBackend(AsyncSupabase(FakeSupabaseClient())),
+    ]
+
+
+async def check_backend_conformance(backend):
+    """Behaviour every backend must share. Raises AssertionError on the first mismatch."""
+    from langchain_core.messages import HumanMessage, AIMessage
+    from app.core.memory import ConversationContext, MemoryManager
+    from app.core.memory_backends import VersionConflict
+
+    assert await backend.load("missing") is None, "load of a missing thread must return None"
+    assert await backend.get_version("missing") is None, "version of a missing thread must be None"
+
+    # Full-row round trip
+    context = ConversationContext("conformance")
+    context.update_customer_context("customer_name", "María García")
+    context.add_message(HumanMessage(content="Hola"))
+    context.add_message(AIMessage(content="Hola, en qué te ayudo?"))
+    context.version = 3
+    row = context.to_dict()
+    assert await backend.save(row), "save must report success"
+    loaded = await backend.load("conformance")
+    assert loaded["customer_context"] == row["customer_context"], "customer_context must round-trip"
+    assert loaded["recent_messages"] == row["recent_messages"], "recent_messages must round-trip"
+    assert await backend.get_version("conformance") == 3, "get_version must return the saved stamp"
+
+    # Rows saved without the window (append-log mode) keep the stored window
+    partial = context.to_dict(include_messages=False)
+    partial["version"] = 4
+    await backend.save(partial)
+    loaded = await backend.load("conformance")
+    assert loaded["recent_messages"] == row["recent_messages"], "partial save must not drop other columns"
+    assert loaded["version"] == 4
+
+    # Compare-and-set: a write against a version the row has moved past is refused
+    partial["version"] = 5
+    assert await backend.save(partial, expected_version=4)
+    try:
+        await backend.save(partial, expected_version=4)
+        raise AssertionError("save with a stale expected_version must raise VersionConflict")
+    except VersionConflict:
+        pass
+    assert await backend.get_version("conformance") == 5
+    fresh = ConversationContext("cas_new").to_dict()
+    fresh["version"] = 1
+    assert await backend.save(fresh, expected_version=0), "expected_version=0 must create a missing row"
+    try:
+        await backend.save(fresh, expected_version=0)
+        raise AssertionError("expected_version=0 must not overwrite an existing row")
+    except VersionConflict:
+        pass
+
+    # Message log: newest `limit`, oldest first, idempotent on (thread_id, seq)
+    log = [
+        {"thread_id": "conformance", "seq": seq, "role": "human", "content": f"m{seq}",
+         "created_at": "2024-01-07T10:00:00+00:00"}
+        for seq in range(5)
+    ]
+    await backend.append_messages("conformance", log)
+    await backend.append_messages("conformance", log[-2:])
+    window = await backend.load_messages("conformance", 3)
+    assert [msg["seq"] for msg in window] == [2, 3, 4], "load_messages must return the newest rows, oldest first"
+    assert window[0]["content"] == "m2"
+
+    # Retention removes old conversations and their messages only
+    old = ConversationContext("old_thread").to_dict()
+    old["last_activity"] = "2000-01-01T00:00:00+00:00"
+    await backend.save(old)
+    await backend.append_messages("old_thread", [dict(log[0], thread_id="old_thread")])
+    assert await backend.delete_older_than("2001-01-01T00:00:00+00:00") == 1
+    assert await backend.load("old_thread") is None
+    await backend.delete_messages(["old_thread"])  # Postgres does this through the log's FK cascade
+    assert await backend.load_messages("old_thread", 10) == []
+    assert await backend.load("conformance") is not None
+
+    # Batched retention: oldest first, bounded, newer rows untouched
+    for day in (3, 1, 2):
+        expired = ConversationContext(f"expired_{day}").to_dict()
+        expired["last_activity"] = f"2000-01-0{day}T00:00:00+00:00"
+        await backend.save(expired)
+    batch = await backend.delete_expired_batch("2001-01-01T00:00:00+00:00", 2)
+    assert [row["thread_id"] for row in batch] == ["expired_1", "expired_2"], "batches must go oldest first"
+    assert await backend.load("expired_3") is not None
+    assert len(await backend.delete_expired_batch("2001-01-01T00:00:00+00:00", 2)) == 1
+    assert await backend.load("conformance") is not None
+
+    # End to end through MemoryManager in both storage modes
+    for mode in ("snapshot", "append_log"):
+        manager = MemoryManager(backend=backend)
+        manager.storage_mode = mode
+        manager.summarizer = None
+        async with manager.turn(f"e2e_{mode}") as turn:
+            turn.add_message(HumanMessage(content="Quiero una hawaiana"))
+            turn.add_message(AIMessage(content="Listo, una hawaiana"))
+            turn.update_customer_context("current_order", {"items": ["hawaiana"]})
+        manager.clear_cache()
+        reloaded = await manager.get_conversation(f"e2e_{mode}")
+        assert [msg.content for msg in reloaded.messages] == ["Quiero una hawaiana", "Listo, una hawaiana"], mode
+        assert reloaded.customer_context["current_order"] == {"items": ["hawaiana"]}, mode
+        assert reloaded.version == 1, mode
+
+        # Two workers turn the same thread from the same version: the second save is
+        # rebased onto the first instead of overwriting it
+        workers = [MemoryManager(backend=backend) for _ in range(2)]
+        contexts = []
+        for worker in workers:
+            worker.storage_mode = mode
+            worker.summarizer = None
+            contexts.append(await worker.get_conversation(f"e2e_{mode}"))
+        for worker, context, text in zip(workers, contexts, ("Agrega una gaseosa", "Mejor sin cebolla")):
+            context.add_message(HumanMessage(content=text))
+            context.update_customer_context("last_request", text)
+            assert await worker.save_conversation(context), mode
+        assert workers[1].save_conflicts == 1, mode
+        manager.clear_cache()
+        reloaded = await manager.get_conversation(f"e2e_{mode}")
+        assert [msg.content for msg in reloaded.messages][-2:] == ["Agrega una gaseosa", "Mejor sin cebolla"], mode
+        assert [msg.seq for msg in reloaded.messages] == [0, 1, 2, 3], mode
+        assert reloaded.customer_context["last_request"] == "Mejor sin cebolla", mode
+        assert reloaded.version == 3, mode
+
+
+async def _time_backend(backend, threads: int = 300):
+    from langchain_core.messages import HumanMessage, AIMessage
+    from app.core.memory import ConversationContext
+
+    contexts = []
+    for t in range(threads):
+        context = ConversationContext(f"bench_{t}")
+        for turn in range(3):
+            human, assistant = _sample_turn(t, turn)
+            context.add_message(HumanMessage(content=human))
+            context.add_message(AIMessage(content=assistant))
+        contexts.append(context)
+
+    started = time.perf_counter()
+    for context in contexts:
+        await backend.save(context.to_dict())
+    save_rate = threads / (time.perf_counter() - started)
+
+    started = time.perf_counter()
+    for context in contexts:
+        await backend.load(context.thread_id)
+    load_rate = threads / (time.perf_counter() - started)
+
+    started = time.perf_counter()
+    for context in contexts:
+        rows = [{"thread_id": context.thread_id, "seq": msg.seq, "role": msg.role,
+                 "content": msg.content, "created_at": "2024-01-07T10:00:00+00:00"} for msg in context.messages]
+        await backend.append_messages(context.thread_id, rows)
+        await backend.load_messages(context.thread_id, 12)
+    log_rate = threads / (time.perf_counter() - started)
+
+    return save_rate, load_rate, log_rate
+
+
+@benchmark("backends")
+def bench_memory_backends():
+    """
+    Conformance suite plus throughput for every memory backend.
+    All backends must pass the same checks; numbers are sequential ops/second.
+    """
+    async def run():
+        print("🗄️ Memory backends (conformance + sequential ops/s)")
+        for backend in _backends_under_test():
+            await check_backend_conformance(backend)
+            save_rate, load_rate, log_rate = await _time_backend(backend)
+            print(f"   • {backend.name:<9} ✅ conformance | save {save_rate:>8,.0f}/s | "
+                  f"load {load_rate:>8,.0f}/s | append+window {log_rate:>8,.0f}/s")
+            await backend.close()
+
+    asyncio.run(run())
+
+
+# =============================================================================
+# RETENTION
+# =============================================================================
+
+@benchmark("retention")
+def bench_retention(expired: int = 5000, active: int = 500, batch_size: int = 250):
+    """
+    Chunked retention on a SQLite table: deletion rate, capped/resumed runs,
+    and that expired threads also leave the in-process cache. Then the same on
+    the fake Supabase backend without the optional message log table.
+    """
+    from app.core.memory import ConversationContext, MemoryManager
+    from app.core.memory_backends import SQLiteBackend
+    from app.core.retention import RetentionJob
+
+    async def run():
+        backend = SQLiteBackend(os.path.join(tempfile.mkdtemp(prefix="retention_bench_"), "memory.db"))
+        manager = MemoryManager(backend=backend)
+        for i in range(expired + active):
+            context = ConversationContext(f"user_{i}")
+            row = context.to_dict()
+            if i < expired:
+                row["last_activity"] = f"2000-01-01T00:{i // 60 % 60:02d}:{i % 60:02d}+00:00"
+            await backend.save(row)
+            manager._cache.put(context.thread_id, context)
+
+        # A capped run stops early and the next one resumes from the oldest remaining row
+        job = RetentionJob(manager, retention_days=7, batch_size=batch_size, pause_seconds=0, max_batches_per_run=4)
+        first = await job.run_once()
+        assert first == 4 * batch_size and not job.last_run["finished"]
+
+        job.max_batches_per_run = 0
+        started = time.perf_counter()
+        second = await job.run_once()
+        elapsed = time.perf_counter() - started
+        assert first + second == expired and job.last_run["finished"]
+        assert len(manager._cache) == active, "expired threads must leave the cache"
+        assert await backend.load(f"user_{expired}") is not None, "active threads must survive"
+
+        print(f"🧹 Retention ({expired} expired, {active} active, batches of {batch_size})")
+        print(f"   • Capped run:      {first} deleted, resumed for {second} more")
+        print(f"   • Delete rate:     {second / elapsed:,.0f} conversations/s ({job.batches} batches total)")
+        print(f"   • Cache after run: {len(manager._cache)} entries (active only)")
+
+        # An idle worker still drops cached conversations past their TTL on the scheduler tick
+        idle = MemoryManager(backend=backend)
+        for i in range(active):
+            idle._cache.put(f"idle_{i}", ConversationContext(f"idle_{i}"))
+        idle._cache._clock = lambda: time.monotonic() + idle._cache.ttl_seconds + 1
+        job = RetentionJob(idle, retention_days=7, batch_size=batch_size, pause_seconds=0, interval_seconds=0.01)
+        job.start()
+        await asyncio.sleep(0.1)
+        await job.stop()
+        assert len(idle._cache) == 0 and job.cache_purged == active, job.stats()
+        print(f"   • Idle worker:     {job.cache_purged} expired cache entries purged by the scheduler")
+        await backend.close()
+
+    async def run_without_message_log():
+        # Default Supabase install: snapshot mode, message_log_schema.sql never run
+        from app.core.db import AsyncSupabase
+        from app.core.fake_db import FakeSupabaseClient
+        from app.core.memory_backends import SupabaseBackend
+
+        client = FakeSupabaseClient()
+        client.missing_tables.add("conversation_messages")
+        backend = SupabaseBackend(AsyncSupabase(client))
+        outcomes = []
+        for storage_mode in ("snapshot", "append_log"):
+            manager = MemoryManager(backend=backend)
+            manager.storage_mode = storage_mode
+            for i in range(3 * batch_size):
+                context = ConversationContext(f"{storage_mode}_{i}")
+                row = context.to_dict()
+                row["last_activity"] = f"2000-01-01T00:00:{i % 60:02d}+00:00"
+                await backend.save(row)
+                manager._cache.put(context.thread_id, context)
+
+            job = RetentionJob(manager, retention_days=7, batch_size=batch_size, pause_seconds=0)
+            deleted = await job.run_once()
+            assert deleted == 3 * batch_size and job.last_run["finished"], (storage_mode, job.last_run)
+            assert job.errors == 0 and len(manager._cache) == 0, storage_mode
+            outcomes.append(f"{storage_mode} {deleted} deleted")
+        print(f"   • No message log:  {', '.join(outcomes)}, cache emptied, no errors")
+
+    asyncio.run(run())
+    asyncio.run(run_without_message_log())
+
+
+# =============================================================================
+# CODECS
+# =============================================================================
+
+@benchmark("codecs")
+def bench_codecs(conversations: int = 500):
+    """
+    Encode/decode time and stored bytes per conversation: the dict + JSON row
+    (ISO timestamps) against to_record() through every installed codec.
+    """
+    import json
+    from langchain_core.messages import HumanMessage, AIMessage
+    from app.core.codecs import available_codecs
+    from app.core.memory import ConversationContext
+
+    contexts = []
+    for c in range(conversations):
+        context = ConversationContext(f"user_{c}")
+        context.update_customer_context("customer_name", f"Cliente {c}")
+        context.update_customer_context("current_order", {"items": [{"pizza": "hawaiana", "size": "mediana"}]})
+        for t in range(ConversationContext.max_messages // 2):
+            human, assistant = _sample_turn(c, t)
+            context.add_message(HumanMessage(content=human))
+            context.add_message(AIMessage(content=assistant))
+        contexts.append(context)
+
+    def measure(encode, decode):
+        started = time.perf_counter()
+        blobs = [encode(context) for context in contexts]
+        encode_us = (time.perf_counter() - started) / conversations * 1e6
+        started = time.perf_counter()
+        decoded = [decode(blob) for blob in blobs]
+        decode_us = (time.perf_counter() - started) / conversations * 1e6
+        for original, copy in zip(contexts, decoded):
+            assert copy.recent_messages == original.recent_messages, "round trip must be lossless"
+            assert copy.customer_context == original.customer_context
+        return encode_us, decode_us, sum(len(blob) for blob in blobs) / conversations
+
+    results = {"dict + json (row)": measure(
+        lambda context: json.dumps(context.to_dict()).encode("utf-8"),
+        lambda blob: ConversationContext.from_dict(json.loads(blob))
+    )}
+    for name, codec in available_codecs().items():
+        results[f"record + {name}"] = measure(
+            lambda context, codec=codec: context.encode(codec),
+            ConversationContext.decode
+        )
+
+    print(f"🗜️ Context codecs ({conversations} conversations, {len(contexts[0].messages)} messages each)")
+    for name, (encode_us, decode_us, size) in results.items():
+        print(f"   • {name:<22} encode {encode_us:>7,.1f} µs | decode {decode_us:>7,.1f} µs | {size:>7,.0f} B")
+    missing = {"orjson", "msgpack-zstd"} - set(available_codecs())
+    if missing:
+        print(f"   ℹ️  Not installed: {', '.join(sorted(missing))}")
+
+
+# =============================================================================
+# TURN LOCKS
+# =============================================================================
+
+@benchmark("turn_locks")
+def bench_turn_locks(users: int = 200, burst: int = 3, llm_latency: float = 0.05):
+    """
+    Bursts of concurrent messages from the same user (n8n posting several
+    WhatsApp messages at once) with a simulated LLM call per turn.
+    Locked turns must each see the previous answer; other users stay parallel.
+    """
+    from langchain_core.messages import HumanMessage, AIMessage
+    from app.core.memory import MemoryManager
+    from app.core.locks import KeyedLock
+    from app.core.memory_backends import InMemoryBackend
+
+    inside = set()  # Users whose turn is between reading and saving the history
+    overlap = [0]  # Most users inside at the same time
+
+    async def simulated_turn(manager, user_id, text, locked):
+        async def body():
+            inside.add(user_id)
+            overlap[0] = max(overlap[0], len(inside))
+            try:
+                context = await manager.get_conversation(user_id)
+                seen = len(context.messages)  # History the LLM would get
+                await asyncio.sleep(llm_latency)
+                async with manager.turn(user_id) as turn:
+                    turn.add_message(HumanMessage(content=text))
+                    turn.add_message(AIMessage(content=f"respuesta viendo {seen} mensajes"))
+            finally:
+                inside.discard(user_id)
+            return seen
+        if not locked:
+            return await body()
+        async with manager.lock(user_id):
+            return await body()
+
+    async def run(locked):
+        overlap[0] = 0
+        manager = MemoryManager(backend=InMemoryBackend())
+        manager.summarizer = None
+        started = time.perf_counter()
+        seen = await asyncio.gather(*(
+            simulated_turn(manager, f"user_{u}", f"mensaje {m}", locked)
+            for u in range(users) for m in range(burst)
+        ))
+        return manager, seen, time.perf_counter() - started, overlap[0]
+
+    async def handovers_never_leak(rounds: int = 200, timeout: float = 0.002) -> int:
+        # A timeout or a cancellation landing as the lock is handed over must not leave it held
+        loop = asyncio.get_running_loop()
+        lock = asyncio.Lock()
+        gave_up = 0
+        for r in range(rounds):
+            await lock.acquire()
+            waiter = asyncio.ensure_future(KeyedLock._acquire_within(lock, timeout))
+            await asyncio.sleep(0)
+            if r % 2:
+                loop.call_later(timeout, lock.release)  # Released at the waiter's deadline
+            else:
+                lock.release()
+                waiter.cancel()  # Cancelled as it is granted
+            try:
+                await waiter
+                lock.release()
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                gave_up += 1
+            await asyncio.sleep(timeout)
+            assert not lock.locked(), "an abandoned acquire must not keep the lock"
+        return gave_up
+
+    async def main_async():
+        gave_up = await handovers_never_leak()
+        _, unlocked_seen, unlocked_time, _ = await run(locked=False)
+        manager, locked_seen, locked_time, locked_overlap = await run(locked=True)
+
+        expected = [2 * m for m in range(burst)]
+        assert all(locked_seen[u * burst:(u + 1) * burst] == expected for u in range(users)), \
+            "each locked turn must see the previous turns"
+        assert len(manager.turn_locks) == 0, "idle locks must be released"
+        # Checked on the turns themselves rather than on wall-clock time, which is noisy on busy machines
+        assert locked_overlap >= users // 2, f"different users must not wait on each other ({locked_overlap})"
+        stale = sum(1 for u in range(users) for m in range(burst) if unlocked_seen[u * burst + m] != 2 * m)
+
+        stats = manager.turn_locks.stats()
+        print(f"🔒 Per-thread turn locks ({users} users x {burst} concurrent messages, {llm_latency * 1000:.0f} ms LLM)")
+        print(f"   • Unlocked: {stale}/{users * burst} turns answered on stale history, {unlocked_time:.2f}s")
+        print(f"   • Locked:   0/{users * burst} stale, {locked_time:.2f}s (serial per user, "
+              f"up to {locked_overlap} users in a turn at once)")
+        print(f"   • Contended acquisitions: {stats['contended']}, max waiters {stats['max_waiters']}, "
+              f"locks left {stats['active_keys']}")
+        print(f"   • Timeouts/cancellations racing a handover: {gave_up}/200 gave up, 0 locks left held")
+
+    asyncio.run(main_async())
+
+
+# =============================================================================
+# WARM-START SNAPSHOT
+# =============================================================================
+
+@benchmark("snapshot")
+def bench_snapshot(conversations: int = 2000, changed: int = 100):
+    """
+    Restart simulation: cold cache vs. lazily restored snapshot. Snapshot entries
+    whose version moved on since shutdown must be reloaded, never served.
+    """
+    from langchain_core.messages import HumanMessage, AIMessage
+    from app.core.memory import MemoryManager
+    from app.core.memory_backends import SQLiteBackend
+
+    async def shutdown_keeps_pending_summary(backend, workdir: str) -> str:
+        # The app's shutdown hook must let a summary still folding finish before the snapshot
+        from app import main
+        from app.config import MEMORY_MAX_MESSAGES
+        from app.core.coherence import UDPInvalidationChannel
+        from app.core.memory import memory
+        from app.core.summarizer import ExtractiveSummarizer
+
+        class SlowSummarizer(ExtractiveSummarizer):
+            async def summarize(self, previous_summary, messages):
+                await asyncio.sleep(0.05)
+                return await super().summarize(previous_summary, messages)
+
+        saved = (memory.backend, memory.summarizer, memory.snapshot_path, memory.channel)
+        memory.backend, memory.summarizer = backend, SlowSummarizer()
+        memory.snapshot_path = os.path.join(workdir, "shutdown.snapshot")
+        memory.channel = channel = UDPInvalidationChannel(range(47_900, 47_910))
+        try:
+            async with memory.turn("shutdown_user") as turn:
+                for t in range(MEMORY_MAX_MESSAGES):
+                    human, assistant = _sample_turn(t, 0)
+                    turn.add_message(HumanMessage(content=human))
+                    turn.add_message(AIMessage(content=assistant))
+            assert memory._background_tasks, "the turn should have started a summary"
+            await main.stop_background_jobs()
+            assert channel._transport is None, "the invalidation socket must be released"
+        finally:
+            memory.backend, memory.summarizer, memory.snapshot_path, memory.channel = saved
+
+        restarted = MemoryManager(backend=backend)
+        restarted.load_snapshot(os.path.join(workdir, "shutdown.snapshot"))
+        context = await restarted.get_conversation("shutdown_user")
+        stats = restarted.get_cache_stats()["snapshot"]
+        assert context.summary and stats["restored"] == 1 and stats["stale"] == 0, stats
+        return context.summary
+
+    async def run():
+        workdir = tempfile.mkdtemp(prefix="snapshot_bench_")
+        backend = SQLiteBackend(os.path.join(workdir, "memory.db"))
+        snapshot_path = os.path.join(workdir, "cache.snapshot")
+
+        before = MemoryManager(backend=backend)
+        before.summarizer = None
+        for c in range(conversations):
+            async with before.turn(f"user_{c}") as turn:
+                for t in range(4):
+                    human, assistant = _sample_turn(c, t)
+                    turn.add_message(HumanMessage(content=human))
+                    turn.add_message(AIMessage(content=assistant))
+        started = time.perf_counter()
+        written = await before.save_snapshot(snapshot_path)
+        write_time = time.perf_counter() - started
+
+        # Another worker updates some threads after the snapshot was taken
+        other = MemoryManager(backend=backend)
+        other.summarizer = None
+        for c in range(changed):
+            async with other.turn(f"user_{c}") as turn:
+                turn.add_message(HumanMessage(content="cambio después del apagado"))
+
+        cold = MemoryManager(backend=backend)
+        started = time.perf_counter()
+        for c in range(conversations):
+            await cold.get_conversation(f"user_{c}")
+        cold_time = time.perf_counter() - started
+
+        warm = MemoryManager(backend=backend)
+        started = time.perf_counter()
+        mapped = warm.load_snapshot(snapshot_path)
+        map_time = time.perf_counter() - started
+        started = time.perf_counter()
+        for c in range(conversations):
+            context = await warm.get_conversation(f"user_{c}")
+            expected = "cambio después del apagado" if c < changed else _sample_turn(c, 3)[1]
+            assert context.messages[-1].content == expected, "stale snapshot entry was served"
+        warm_time = time.perf_counter() - started
+
+        stats = warm.get_cache_stats()["snapshot"]
+        assert stats["restored"] == conversations - changed and stats["stale"] == changed
+        print(f"🔥 Warm-start snapshot ({conversations} conversations, {changed} changed after shutdown)")
+        print(f"   • Snapshot write:  {written} entries, {os.path.getsize(snapshot_path) / 1024:,.0f} KiB, "
+              f"{write_time * 1000:.0f} ms")
+        print(f"   • Startup map:     {mapped} entries indexed in {map_time * 1000:.1f} ms")
+        print(f"   • First access:    cold {cold_time / conversations * 1e6:,.0f} µs | "
+              f"snapshot {warm_time / conversations * 1e6:,.0f} µs per conversation")
+        print(f"   • Restored {stats['restored']}, rejected as stale {stats['stale']}")
+        summary = await shutdown_keeps_pending_summary(backend, workdir)
+        print(f"   • Shutdown during a summary: folded summary ({len(summary)} chars) restored, not stale")
+        await backend.close()
+
+    asyncio.run(run())
+
+
+# =============================================================================
+# CHECKPOINTER
+# =============================================================================
+
+@benchmark("checkpointer")
+def bench_checkpointer(threads: int = 100, turns: int = 10):
+    """
+    Retained memory and per-turn latency of a real StateGraph compiled with
+    MemorySaver vs. the bounded Checkpointer, plus a persistence round trip.
+    """
+    from typing import Annotated, List, TypedDict
+    from langchain_core.messages import AIMessage, HumanMessage
+    from langgraph.checkpoint.memory import MemorySaver
+    from langgraph.graph import END, StateGraph
+    from langgraph.graph.message import add_messages
+    from app.core.checkpointer import Checkpointer
+
+    class State(TypedDict):
+        messages: Annotated[List, add_messages]
+        step: str
+
+    def respond(state: State):
+        human, assistant = _sample_turn(len(state["messages"]), 0)
+        return {"messages": [AIMessage(content=assistant)], "step": "done"}
+
+    def build(saver):
+        workflow = StateGraph(State)
+        workflow.add_node("classify", lambda state: {"step": "menu"})
+        workflow.add_node("respond", respond)
+        workflow.set_entry_point("classify")
+        workflow.add_edge("classify", "respond")
+        workflow.add_edge("respond", END)
+        return workflow.compile(checkpointer=saver)
+
+    async def run(saver):
+        graph = build(saver)
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        started = time.perf_counter()
+        for turn in range(turns):
+            for t in range(threads):
+                config = {"configurable": {"thread_id": f"user_{t}"}}
+                await graph.ainvoke({"messages": [HumanMessage(content=f"mensaje {turn}")]}, config=config)
+        elapsed = time.perf_counter() - started
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        retained = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+        state = (await graph.aget_state({"configurable": {"thread_id": "user_0"}})).values
+        return graph, retained / threads, elapsed / (threads * turns) * 1e6, state
+
+    async def main_async():
+        _, legacy_bytes, legacy_us, legacy_state = await run(MemorySaver())
+        _, bounded_bytes, bounded_us, bounded_state = await run(Checkpointer("bench_checkpoints"))
+        assert [m.content for m in bounded_state["messages"]] == [m.content for m in legacy_state["messages"]]
+
+        # Bounded retention: the oldest threads are evicted past max_threads
+        small = Checkpointer("bench_small", max_threads=50)
+        graph = build(small)
+        for t in range(threads):
+            await graph.ainvoke({"messages": [HumanMessage(content="hola")]},
+                                config={"configurable": {"thread_id": f"user_{t}"}})
+        assert small.stats()["entries"] == 50
+
+        # Persistence: a new saver on the same file resumes the thread
+        path = os.path.join(tempfile.mkdtemp(prefix="checkpoint_bench_"), "checkpoints.db")
+        graph = build(Checkpointer("bench_persistent", sqlite_path=path))
+        config = {"configurable": {"thread_id": "persisted"}}
+        await graph.ainvoke({"messages": [HumanMessage(content="primero")]}, config=config)
+        restarted = build(Checkpointer("bench_persistent", sqlite_path=path))
+        resumed = (await restarted.aget_state(config)).values
+        assert [m.content for m in resumed["messages"]][0] == "primero"
+
+        print(f"🧷 Checkpointer ({threads} threads x {turns} turns)")
+        print(f"   • MemorySaver:  {legacy_bytes:>9,.0f} B retained per thread | {legacy_us:,.0f} µs per turn")
+        print(f"   • Checkpointer: {bounded_bytes:>9,.0f} B retained per thread | {bounded_us:,.0f} µs per turn")
+        print(f"   • max_threads=50 kept {small.stats()['entries']} threads; SQLite copy resumed after restart")
+
+    asyncio.run(main_async())
+
+
+# =============================================================================
+# CHAT STATE
+# =============================================================================
+
+@benchmark("state_growth")
+def bench_state_growth(turns: int = 200):
+    """
+    Checkpointed ChatState size over a long conversation through the real
+    smart_graph (scripted LLM): it must stay flat once the memory window fills.
+    """
+    from langchain_core.language_models.fake_chat_models import FakeMessagesListChatModel
+    from langchain_core.messages import AIMessage
+    from app.config import MEMORY_MAX_MESSAGES
+    from app.core import smart_graph
+    from app.core.checkpointer import checkpointer
+
+    replies = [AIMessage(content=_sample_turn(0, turn)[1]) for turn in range(turns)]
+    smart_graph.llm_with_tools = FakeMessagesListChatModel(responses=replies)
+    user_id = "bench_state_growth"
+    config = {"configurable": {"thread_id": user_id}}
+
+    async def main_async():
+        samples = {}
+        other_bytes = checkpointer.stats()["bytes"]  # Threads left by benchmarks that ran before
+        started = time.perf_counter()
+        for turn in range(turns):
+            human, _ = _sample_turn(0, turn)
+            reply = await smart_graph.process_message(user_id, human)
+            assert reply == replies[turn].content, f"turn {turn}: unexpected reply {reply!r}"
+            if turn + 1 in (20, 50, 100, turns):
+                messages = (await smart_graph.graph.aget_state(config)).values["messages"]
+                ids = [m.id for m in messages]
+                assert len(ids) == len(set(ids)), f"duplicate message ids at turn {turn + 1}"
+                entry = checkpointer.stats()
+                samples[turn + 1] = (len(messages), entry["bytes"] - other_bytes)
+        elapsed = time.perf_counter() - started
+
+        # The window fills up during the first turns, then the state must stop growing
+        early_count, early_bytes = samples[50]
+        late_count, late_bytes = samples[turns]
+        assert late_count <= MEMORY_MAX_MESSAGES, f"{late_count} messages in state, window is {MEMORY_MAX_MESSAGES}"
+        assert late_count == early_count, f"state grew from {early_count} to {late_count} messages"
+        assert late_bytes <= early_bytes * 1.1, f"checkpoint grew from {early_bytes} to {late_bytes} bytes"
+
+        print(f"📏 ChatState growth ({turns} turns, one thread)")
+        for turn, (count, size) in samples.items():
+            print(f"   • turn {turn:>3}: {count:>3} messages in state | checkpoint {size:>7,} B")
+        print(f"   • {elapsed / turns * 1000:.2f} ms per turn")
+
+    asyncio.run(main_async())
+
+
+# =============================================================================
+# STATE HYDRATION
+# =============================================================================
+
+@benchmark("hydration")
+def bench_hydration(users: int = 30, latency: float = 0.02):
+    """
+    load_state_for_user against a fake database with per-query latency:
+    sequential lookups (previous behavior) vs. the concurrent load, plus the
+    fallback when one source misses its deadline.
+    """
+    from app.config import STATE_LOAD_CUSTOMER_TIMEOUT, STATE_LOAD_ORDER_TIMEOUT
+    from app.core.checkpointer import state_manager
+    from app.core.db import db
+    from app.core.memory import memory
+    from app.core.tools import get_active_order, get_customer
+
+    client = db.client
+    for u in range(users * 3):
+        client.tables.setdefault("clientes", []).append(
+            {"id": u + 1, "user_id": f"hydrate_{u}", "first_name": "Ana", "last_name": "Gómez"})
+        client.tables.setdefault("pedidos_activos", []).append(
+            {"id": u + 1, "cliente_id": u + 1, "cart": [{"pizza": "hawaiana", "size": "mediana"}]})
+    client.latency = latency
+
+    async def sequential(user_id: str):
+        await memory.get_conversation(user_id)
+        await get_customer.ainvoke({"user_id": user_id})
+        await get_active_order.ainvoke({"user_id": user_id})
+
+    async def main_async():
+        started = time.perf_counter()
+        for u in range(users):
+            await sequential(f"hydrate_{u}")
+        sequential_ms = (time.perf_counter() - started) / users * 1000
+
+        started = time.perf_counter()
+        for u in range(users, 2 * users):
+            state = await state_manager.load_state_for_user(f"hydrate_{u}", "hola")
+            assert state["customer"]["last_name"] == "Gómez" and state["active_order"]["cart"]
+        concurrent_ms = (time.perf_counter() - started) / users * 1000
+        assert concurrent_ms < sequential_ms
+
+        # A source past its deadline falls back instead of failing the turn
+        state_manager.load_timeouts["active_order"] = latency / 2
+        try:
+            state = await state_manager.load_state_for_user(f"hydrate_{2 * users}", "hola")
+        finally:
+            state_manager.load_timeouts["active_order"] = STATE_LOAD_ORDER_TIMEOUT
+        assert state["active_order"] == {} and state["customer"]["last_name"] == "Gómez"
+        stats = state_manager.stats()
+        assert stats["fallbacks"]["active_order"] == 1
+
+        # A customer lookup past its deadline is "unknown", never "not registered"
+        state_manager.load_timeouts["customer"] = latency / 2
+        try:
+            seen = await state_manager.load_state_for_user(f"hydrate_{users}", "quiero una hawaiana")
+            unseen = await state_manager.load_state_for_user(f"hydrate_{3 * users - 1}", "quiero una hawaiana")
+        finally:
+            state_manager.load_timeouts["customer"] = STATE_LOAD_CUSTOMER_TIMEOUT
+        assert seen["customer"]["last_name"] == "Gómez" and seen["ready_to_order"], seen["customer"]
+        assert unseen["customer"] is None and not unseen["needs_customer_info"]
+        assert unseen["current_step"] != "greeting", unseen["current_step"]
+        stats = state_manager.stats()
+        assert stats["customers_reused"] == 1, stats
+
+        print(f"💧 State hydration ({users} users, {latency * 1000:.0f} ms per query)")
+        print(f"   • Sequential: {sequential_ms:6.1f} ms per load")
+        print(f"   • Concurrent: {concurrent_ms:6.1f} ms per load ({sequential_ms / concurrent_ms:.1f}x faster)")
+        print(f"   • Per source: {stats['source_avg_ms']}")
+        print(f"   • Order deadline at {latency * 500:.0f} ms: fell back to an empty order, turn continued")
+        print(f"   • Customer deadline at {latency * 500:.0f} ms: last known row reused, "
+              f"an unseen customer left unknown (not sent to registration)")
+
+    try:
+        asyncio.run(main_async())
+    finally:
+        client.latency = 0.0
+
+
+# =============================================================================
+# REQUEST LOADER
+# =============================================================================
+
+@benchmark("request_loader")
+def bench_request_loader(users: int = 20):
+    """
+    Database queries per message through smart_graph (scripted LLM calling the
+    order tools) with and without the request-scoped loader.
+    """
+    import contextlib
+    from langchain_core.language_models.fake_chat_models import FakeMessagesListChatModel
+    from langchain_core.messages import AIMessage
+    from app.core import smart_graph
+    from app.core.db import db
+    from app.core.loader import request_loads
+    from app.core.tools import get_active_order
+
+    client = db.client
+    first_id = 10_000
+    for u in range(users * 2):
+        client.tables.setdefault("clientes", []).append(
+            {"id": first_id + u, "user_id": f"loader_{u}", "first_name": "Ana", "last_name": "Gómez"})
+        client.tables.setdefault("pedidos_activos", []).append(
+            {"id": first_id + u, "cliente_id": first_id + u, "cart": [], "subtotal": 0})
+
+    def tool_call(name: str, args: dict) -> AIMessage:
+        return AIMessage(content="", tool_calls=[{"name": name, "args": args, "id": f"call_{name}"}])
+
+    async def run(offset: int, scoped: bool) -> float:
+        smart_graph.request_scope = smart_graph_scope if scoped else contextlib.nullcontext
+        before = client.executed
+        for u in range(offset, offset + users):
+            user_id = f"loader_{u}"
+            smart_graph.llm_with_tools = FakeMessagesListChatModel(responses=[
+                tool_call("create_or_update_order", {"user_id": user_id, "items": [{"name": "Hawaiana"}], "subtotal": 42000}),
+                tool_call("finalize_order", {"user_id": user_id, "total": 47000}),
+            ])
+            smart_graph.llm_without_tools = FakeMessagesListChatModel(responses=[AIMessage(content="Listo")])
+            await smart_graph.process_message(user_id, "Agrega una hawaiana a mi pedido")
+            assert get_active_order.invoke({"user_id": user_id})["subtotal"] == 42000
+            await smart_graph.process_message(user_id, "Confirmo, gracias")
+            assert get_active_order.invoke({"user_id": user_id}) == {}
+        # The two verification lookups per user are not part of a message
+        return (client.executed - before - 4 * users) / (2 * users)
+
+    smart_graph_scope = smart_graph.request_scope
+    original = (smart_graph.llm_with_tools, smart_graph.llm_without_tools)
+
+    async def main_async():
+        unscoped = await run(0, scoped=False)
+        scoped = await run(users, scoped=True)
+        assert scoped < unscoped
+        stats = request_loads.stats()
+        print(f"🧮 Request-scoped loader ({users} users x 2 messages with order tools)")
+        print(f"   • Without loader: {unscoped:5.1f} queries per message")
+        print(f"   • With loader:    {scoped:5.1f} queries per message")
+        print(f"   • Saved {stats['queries_saved']} lookups over {stats['requests']} requests "
+              f"({stats['saved_ratio']:.0%} of customer/order lookups)")
+
+    try:
+        asyncio.run(main_async())
+    finally:
+        smart_graph.request_scope = smart_graph_scope
+        smart_graph.llm_with_tools, smart_graph.llm_without_tools = original
+
+
+# =============================================================================
+# DIRTY TRACKING
+# =============================================================================
+
+@benchmark("dirty_tracking")
+def bench_dirty_tracking(threads: int = 200, turns: int = 10):
+    """
+    Bytes upserted per turn when save_state_for_user re-sends unchanged
+    customer/order context: full rows vs. rows narrowed to changed columns,
+    plus saves skipped outright when nothing changed.
+    """
+    import json
+    from langchain_core.messages import AIMessage, HumanMessage
+    from app.core.memory import MemoryManager
+    from app.core.memory_backends import InMemoryBackend
+
+    class CountingBackend(InMemoryBackend):
+        def __init__(self):
+            super().__init__()
+            self.saves = 0
+            self.written = 0
+            self.failing = False
+
+        async def save(self, row, expected_version=None):
+            if self.failing:
+                return False
+            self.saves += 1
+            self.written += len(json.dumps(row, ensure_ascii=False))
+            return await super().save(row, expected_version)
+
+    order = {"id": 7, "cart": [{"name": "Hawaiana", "size": "mediana", "quantity": 2, "price": 42000}] * 3,
+             "subtotal": 126000, "direccion": "Calle 10 # 43-12, apto 301", "metodo_de_pago": "efectivo"}
+
+    async def run(storage_mode: str):
+        backend = CountingBackend()
+        manager = MemoryManager(backend=backend)
+        manager.storage_mode = storage_mode
+        full_bytes = 0
+        for turn in range(turns):
+            for t in range(threads):
+                human, assistant = _sample_turn(t, turn)
+                async with manager.turn(f"user_{t}") as pending:
+                    pending.add_message(HumanMessage(content=human))
+                    pending.add_message(AIMessage(content=assistant))
+                    pending.update_customer_context("customer_name", "Ana Gómez")
+                    pending.update_customer_context("current_order", order)
+                context = await manager.get_conversation(f"user_{t}")
+                row = context.to_dict(include_messages=storage_mode != "append_log")
+                full_bytes += len(json.dumps(row, ensure_ascii=False))
+
+        # Re-sending identical context alone writes nothing
+        saves = backend.saves
+        for t in range(threads):
+            await manager.update_customer_context(f"user_{t}", "current_order", dict(order))
+        assert backend.saves == saves and manager.writes_skipped == threads
+
+        # What was stored is complete: a fresh manager reads the same context back
+        fresh = MemoryManager(backend=backend)
+        fresh.storage_mode = storage_mode
+        reloaded = await fresh.get_conversation("user_0")
+        assert reloaded.customer_context == {"customer_name": "Ana Gómez", "current_order": order}
+        assert len(reloaded.messages) == len((await manager.get_conversation("user_0")).messages)
+
+        # A failed save reports False, keeps its changes dirty and leaves the version alone
+        backend.failing = True
+        context = await manager.get_conversation("user_0")
+        version = context.version
+        async with manager.turn("user_0") as pending:
+            pending.update_customer_context("customer_name", "Ana María Gómez")
+        assert pending.committed and context.version == version
+        assert "customer_context" in context.dirty_fields
+        assert not await manager.save_conversation(context) and context.version == version
+        backend.failing = False
+        assert await manager.save_conversation(context) and context.version == version + 1
+
+        saves = threads * turns
+        print(f"   • {storage_mode:<10} full rows {full_bytes / saves:>6,.0f} B per save | changed columns "
+              f"{backend.written / saves:>6,.0f} B ({1 - backend.written / full_bytes:.0%} less) | "
+              f"{manager.columns_skipped} columns and {manager.writes_skipped} saves skipped")
+
+    print(f"🧽 Dirty tracking ({threads} threads x {turns} turns, unchanged customer/order context)")
+    for storage_mode in ("snapshot", "append_log"):
+        asyncio.run(run(storage_mode))
+
+
+# =============================================================================
+# INTENTS
+# =============================================================================
+
+def _legacy_intent(message: str) -> str:
+    """_detect_user_intent before intents.py, kept verbatim for comparison."""
+    text = message.lower()
+    specific_menu_keywords = [
+        "precio de", "precios de", "cuesta la", "cuánto cuesta", "cuanto cuesta",
+        "ingredientes de", "lleva la", "pizza de", "tamaño de", "tamaños de"
+    ]
+    full_menu_keywords = [
+        "menú completo", "menu completo", "el menú", "el menu", "ver el menú", "ver el menu",
+        "muéstrame el menú", "muestrame el menu", "envíame el menú", "enviame el menu",
+        "quiero ver el menú", "quiero ver el menu", "menú", "menu", "carta", "la carta",
+        "qué tienen", "que tienen", "qué hay", "que hay", "qué venden", "que venden",
+        "opciones", "productos", "comida", "pizzas tienen", "pizzas hay"
+    ]
+    order_keywords = [
+        "pedido", "orden", "comprar", "quiero una", "me gustaría una", "voy a pedir",
+        "hacer pedido", "ordenar", "pedir una"
+    ]
+    confirmation_keywords = ["confirmar", "listo", "perfecto", "sí", "si", "ok", "está bien", "esta bien"]
+    if any(keyword in text for keyword in specific_menu_keywords):
+        return "menu"
+    if any(keyword in text for keyword in full_menu_keywords):
+        return "full_menu"
+    if any(keyword in text for keyword in order_keywords):
+        return "order"
+    if any(keyword in text for keyword in confirmation_keywords):
+        return "confirmation"
+    return "general"
+
+
+def _legacy_step(message: str, recent: list) -> str:
+    """ChatStateManager._determine_current_step before intents.py."""
+    message_lower = message.lower()
+    recent_content = " ".join(recent).lower()
+    if any(word in message_lower for word in ["menú", "menu", "pizzas", "precios", "qué tienen"]):
+        return "menu"
+    elif any(word in message_lower for word in ["ordenar", "pedido", "quiero", "pizza"]):
+        return "order"
+    elif any(word in recent_content for word in ["pedido", "orden", "pizza"]):
+        return "order"
+    elif any(word in recent_content for word in ["menú", "menu", "precios"]):
+        return "menu"
+    return "general"
+
+
+@benchmark("intents")
+def bench_intents(turns: int = 20000):
+    """
+    Per-turn cost of intent + step detection over a conversation of unique
+    messages (new message plus the last three): legacy keyword loops vs. the
+    compiled matcher with its per-text cache.
+    """
+    from app.core.intents import detect_intent, determine_step, match_groups
+
+    phrases = [
+        "Hola, buenas tardes", "Cuánto cuesta la pizza hawaiana mediana?", "Quiero ver el menú",
+        "Me gustaría una pizza de pepperoni grande", "Sí, así está bien, confirmar", "Qué tienen de postre?",
+        "Voy a pedir dos familiares", "Cuáles son los ingredientes de la vegetariana?", "Perfecto, gracias",
+        "Envíame la carta por favor", "A qué hora cierran hoy?", "La dirección es Calle 10 # 43-12",
+        "Pago en efectivo", "Cambia mi pedido, quita la gaseosa", "Tienen opciones sin gluten?",
+        _sample_turn(0, 0)[1],
+    ]
+    # Every message is new text; each one then stays in the 3-message history for a few turns
+    history = [f"{phrases[i % len(phrases)]} ({i})" for i in range(turns + 3)]
+    conversation = [(history[i + 3], history[i:i + 3]) for i in range(turns)]
+
+    for message, recent in conversation[:len(phrases) * 3]:
+        assert detect_intent(message) == _legacy_intent(message), message
+        assert determine_step(message, recent) == _legacy_step(message, recent), message
+    assert detect_intent("QUIERO VER EL MENÚ") == "full_menu" and detect_intent("que tíenen?") == "full_menu"
+
+    def legacy():
+        for message, recent in conversation:
+            _legacy_intent(message)  # load_state_node
+            _legacy_step(message, recent)  # ChatStateManager, same message again
+
+    def compiled():
+        match_groups.cache_clear()
+        for message, recent in conversation:
+            determine_step(message, recent)
+            detect_intent(message)
+
+    results = {}
+    for name, fn in (("legacy", legacy), ("compiled", compiled)):
+        started = time.perf_counter()
+        fn()
+        results[name] = (time.perf_counter() - started) / turns * 1e6
+    cache = match_groups.cache_info()
+
+    print(f"🔎 Intent detection ({turns:,} turns, message + 3 history messages)")
+    for name, us in results.items():
+        print(f"   • {name:<9} {us:6.2f} µs per turn ({results['legacy'] / us:.1f}x)")
+    print(f"   • {cache.misses:,} texts scanned, {cache.hits:,} lookups served from the per-text cache")
+
+
+# =============================================================================
+# ASYNC LLM CALLS
+# =============================================================================
+
+@benchmark("async_llm")
+def bench_async_llm(latency: float = 0.2, levels: tuple = (1, 8, 32, 128)):
+    """
+    Messages per second through smart_graph with N users in flight and a fake
+    model that takes `latency` seconds: model calls that block a worker thread
+    (the previous .invoke path) vs. native async calls.
+    """
+    from langchain_core.language_models.chat_models import BaseChatModel
+    from langchain_core.messages import AIMessage
+    from langchain_core.outputs import ChatGeneration, ChatResult
+    from app.core import smart_graph
+
+    class SlowChatModel(BaseChatModel):
+        latency: float = 0.2
+        native_async: bool = True
+
+        @property
+        def _llm_type(self) -> str:
+            return "slow-fake"
+
+        def _result(self) -> ChatResult:
+            return ChatResult(generations=[ChatGeneration(message=AIMessage(content=_sample_turn(0, 0)[1]))])
+
+        def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+            time.sleep(self.latency)
+            return self._result()
+
+        async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+            if not self.native_async:
+                # BaseChatModel's default: run the blocking call on a worker thread
+                return await super()._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+            await asyncio.sleep(self.latency)
+            return self._result()
+
+    async def run(native_async: bool, users: int, round_id: int):
+        smart_graph.llm_with_tools = SlowChatModel(latency=latency, native_async=native_async)
+        started = time.perf_counter()
+        replies = await asyncio.gather(*(
+            smart_graph.process_message(f"async_{native_async}_{round_id}_{u}", "Hola, buenas tardes")
+            for u in range(users)
+        ))
+        elapsed = time.perf_counter() - started
+        assert all(reply == _sample_turn(0, 0)[1] for reply in replies)
+        return users / elapsed
+
+    original = smart_graph.llm_with_tools
+
+    async def main_async():
+        rows = []
+        for round_id, users in enumerate(levels):
+            blocking = await run(False, users, round_id)
+            native = await run(True, users, round_id)
+            rows.append((users, blocking, native))
+        print(f"⚡ Async LLM calls ({latency * 1000:.0f} ms model latency, {os.cpu_count()} CPUs)")
+        for users, blocking, native in rows:
+            print(f"   • {users:>4} in flight: thread-bound {blocking:7.1f} msg/s | native async {native:7.1f} msg/s "
+                  f"({native / blocking:.1f}x)")
+        assert rows[-1][2] > rows[0][2] * min(levels[-1], 10) / 2, "async throughput must scale with users"
+
+    try:
+        asyncio.run(main_async())
+    finally:
+        smart_graph.llm_with_tools = original
+
+
+# =============================================================================
+# STREAMING
+# =============================================================================
+
+@benchmark("streaming")
+def bench_streaming(tokens: int = 60, token_latency: float = 0.02):
+    """
+    Time to first byte of /v1/agent (whole reply) vs. /v1/agent/stream (SSE
+    frames as the model writes), with a fake model emitting one token every
+    `token_latency` seconds. Also checks the final "done" frame, image replies
+    included.
+    """
+    import json
+    from langchain_core.language_models.chat_models import BaseChatModel
+    from langchain_core.messages import AIMessage, AIMessageChunk
+    from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+    from app import main as api
+    from app.core import smart_graph
+
+    words = [f"palabra{i} " for i in range(tokens)]
+    reply = "".join(words)
+
+    class StreamingChatModel(BaseChatModel):
+        @property
+        def _llm_type(self) -> str:
+            return "streaming-fake"
+
+        def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+            raise NotImplementedError
+
+        async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+            await asyncio.sleep(token_latency * tokens)
+            return ChatResult(generations=[ChatGeneration(message=AIMessage(content=reply))])
+
+        async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+            for word in words:
+                await asyncio.sleep(token_latency)
+                chunk = ChatGenerationChunk(message=AIMessageChunk(content=word))
+                if run_manager:
+                    await run_manager.on_llm_new_token(word, chunk=chunk)
+                yield chunk
+
+    def parse(frame: str):
+        event, data = frame.strip().split("\n")
+        return event[len("event: "):], json.loads(data[len("data: "):])
+
+    original = smart_graph.llm_with_tools
+
+    async def main_async():
+        smart_graph.llm_with_tools = StreamingChatModel()
+        started = time.perf_counter()
+        whole = await api.route(api.Msg(user_id="stream_whole", text="Hola, buenas tardes"))
+        whole_seconds = time.perf_counter() - started
+        assert whole["response"] == reply
+
+        started = time.perf_counter()
+        first_byte = None
+        frames = []
+        async for frame in api._agent_events(api.Msg(user_id="stream_sse", text="Hola, buenas tardes")):
+            first_byte = first_byte or time.perf_counter() - started
+            frames.append(parse(frame))
+        stream_seconds = time.perf_counter() - started
+        text = "".join(data["text"] for event, data in frames if event == "token")
+        event, done = frames[-1]
+        assert event == "done" and done["response"] == reply and text == reply, (event, done)
+        assert [event for event, _ in frames].count("done") == 1
+
+        # Image replies (full menu) stream no tokens and still end in the n8n image fields
+        frames = [parse(frame) async for frame in api._agent_events(api.Msg(user_id="stream_menu", text="Quiero ver el menú"))]
+        assert len(frames) == 1 and frames[0][1]["has_image"] and frames[0][1]["message_type"] == "image"
+
+        # The streamed turn was persisted like any other
+        from app.core.memory import memory
+        stored = await memory.get_conversation("stream_sse")
+        assert [msg.content for msg in stored.messages][-1] == reply
+
+        # A client gone mid-stream (generator neither read nor closed) does not hold the
+        # user's turn lock: the turn finishes on its own and the next message goes through
+        abandoned = smart_graph.stream_message("stream_gone", "Hola, buenas tardes")
+        assert (await abandoned.__anext__())["type"] == "token"
+        follow_up = await asyncio.wait_for(api.route(api.Msg(user_id="stream_gone", text="Hola otra vez")), 10)
+        assert follow_up["response"] == reply
+        stored = await memory.get_conversation("stream_gone")
+        assert [msg.content for msg in stored.messages] == ["Hola, buenas tardes", reply, "Hola otra vez", reply]
+        await abandoned.aclose()
+
+        print(f"🌊 Streaming ({tokens} tokens, {token_latency * 1000:.0f} ms each)")
+        print(f"   • /v1/agent:        first byte {whole_seconds * 1000:7.1f} ms (whole reply)")
+        print(f"   • /v1/agent/stream: first byte {first_byte * 1000:7.1f} ms | done after {stream_seconds * 1000:.1f} ms")
+
+    try:
+        asyncio.run(main_async())
+    finally:
+        smart_graph.llm_with_tools = original
+
+
+# =============================================================================
+# MENU FAST PATH
+# =============================================================================
+
+@benchmark("fast_path")
+def bench_fast_path(latency: float = 0.1, rounds: int = 5):
+    """
+    LLM calls and latency per message through smart_graph for a mix of menu
+    lookups and other messages, with the menu fast path off and on. The fake
+    model answers lookups like the real one: a search_menu call, then a
+    final_response call.
+    """
+    from langchain_core.language_models.chat_models import BaseChatModel
+    from langchain_core.messages import AIMessage, HumanMessage
+    from langchain_core.outputs import ChatGeneration, ChatResult
+    from app.core import smart_graph
+    from app.core.catalog import menu_catalog, menu_fast_path
+    from app.core.db import db
+
+    # Shaped like the tables in DATABASE_SCHEMA.md: one pizza row per size
+    db.client.tables["pizzas_armadas"] = [
+        {"id": "p1", "categoria": "Tradicionales", "nombre": "Hawaiana", "tamano": "Mediana", "precio": 42000,
+         "texto_ingredientes": "Queso mozzarella, jamón y piña", "activo": True},
+        {"id": "p2", "categoria": "Tradicionales", "nombre": "Hawaiana", "tamano": "Grande", "precio": 56000,
+         "texto_ingredientes": "Queso mozzarella, jamón y piña", "activo": True},
+        {"id": "p3", "categoria": "Especiales", "nombre": "Hawaiana Especial", "tamano": "Mediana", "precio": 48000,
+         "texto_ingredientes": "Queso mozzarella, jamón, piña y tocineta", "activo": True},
+        {"id": "p4", "categoria": "Tradicionales", "nombre": "Pepperoni", "tamano": "Mediana", "precio": 45000,
+         "texto_ingredientes": "Queso mozzarella y pepperoni", "activo": True},
+        {"id": "p5", "categoria": "Tradicionales", "nombre": "Margarita", "tamano": "Mediana", "precio": 38000,
+         "texto_ingredientes": "Tomate, albahaca y queso mozzarella", "activo": True},
+        {"id": "p6", "categoria": "Tradicionales", "nombre": "Vieja", "tamano": "Mediana", "precio": 1000,
+         "activo": False},
+    ]
+    db.client.tables["bebidas"] = [
+        {"id": "b1", "nombre_producto": "Limonada de Coco", "tamano": "400 ml", "precio": 9000, "activo": True},
+    ]
+    menu_catalog.invalidate()
+
+    lookups = {
+        "Cuánto cuesta la hawaiana?": "$42.000 (Mediana) y $56.000 (Grande)",
+        "cual es el precio de la pepperoni": "$45.000",
+        "Qué ingredientes tiene la margarita?": "albahaca",
+        "que lleva la hawaiana especial": "tocineta",
+        "cuanto vale la limonada de coco": "$9.000",
+        "Precio de la pizza pepperoni porfa": "$45.000",
+    }
+    others = [
+        "Hola, buenas tardes",
+        "Quiero una hawaiana grande, cuánto cuesta?",  # An order: the LLM takes it
+        "cuánto cuesta la hawaiana y la pepperoni?",  # Two items
+        "y cuánto cuesta?",  # Follow-up without the item
+        "cuanto cuesta el domicilio a chapinero?",  # Not on the menu
+        "Me recomiendas alguna pizza?",
+        "Gracias, eso es todo",
+    ]
+    messages = list(lookups) + others
+    llm_calls = [0]
+
+    class MenuChatModel(BaseChatModel):
+        latency: float = 0.1
+        tool_calling: bool = False
+
+        @property
+        def _llm_type(self) -> str:
+            return "menu-fake"
+
+        def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+            raise NotImplementedError
+
+        async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+            llm_calls[0] += 1
+            await asyncio.sleep(self.latency)
+            last = next((msg.content for msg in reversed(messages) if isinstance(msg, HumanMessage)), "")
+            if last in lookups and self.tool_calling:
+                message = AIMessage(content="", tool_calls=[
+                    {"name": "search_menu", "args": {"query": "hawaiana"}, "id": f"call_{llm_calls[0]}"}])
+            else:
+                message = AIMessage(content="Con mucho gusto")
+            return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def run(enabled: bool):
+        menu_fast_path.enabled = enabled
+        calls_before = llm_calls[0]
+        started = time.perf_counter()
+        for r in range(rounds):
+            for i, text in enumerate(messages):
+                reply = await smart_graph.process_message(f"fast_{enabled}_{r}_{i}", text)
+                if enabled and text in lookups:
+                    assert lookups[text] in reply and "¿" not in reply and "¡" not in reply, reply
+        elapsed = time.perf_counter() - started
+        sent = rounds * len(messages)
+        return (llm_calls[0] - calls_before) / sent, elapsed / sent
+
+    original = (smart_graph.llm_with_tools, smart_graph.llm_without_tools, menu_fast_path.enabled)
+
+    async def main_async():
+        smart_graph.llm_with_tools = MenuChatModel(latency=latency, tool_calling=True)
+        smart_graph.llm_without_tools = MenuChatModel(latency=latency)
+        off_calls, off_seconds = await run(False)
+        before = menu_fast_path.stats()
+        on_calls, on_seconds = await run(True)
+        after = menu_fast_path.stats()
+        hits = after["hits"] - before["hits"]
+        asked = hits + after["misses"] - before["misses"]
+        fallbacks = {reason: count - before["fallbacks"].get(reason, 0)
+                     for reason, count in after["fallbacks"].items() if count > before["fallbacks"].get(reason, 0)}
+        assert hits == rounds * len(lookups), after
+        assert on_calls < off_calls
+
+        # Fast-path replies are saved like any other turn
+        from app.core.memory import memory
+        stored = await memory.get_conversation("fast_True_0_0")
+        assert "$42.000" in stored.messages[-1].content
+
+        print(f"🏎️  Menu fast path ({len(lookups)} lookups + {len(others)} other messages x {rounds}, "
+              f"{latency * 1000:.0f} ms per LLM call)")
+        print(f"   • Off: {off_calls:.2f} LLM calls/message | {off_seconds * 1000:6.1f} ms/message")
+        print(f"   • On:  {on_calls:.2f} LLM calls/message | {on_seconds * 1000:6.1f} ms/message")
+        print(f"   • Hit rate {hits / asked:.0%} | fallbacks {fallbacks}")
+
+    try:
+        asyncio.run(main_async())
+    finally:
+        smart_graph.llm_with_tools, smart_graph.llm_without_tools, menu_fast_path.enabled = original
+        # Later benchmarks ask about pizzas too; they expect the LLM to answer
+        db.client.tables.pop("pizzas_armadas", None)
+        db.client.tables.pop("bebidas", None)
+        menu_catalog.invalidate()
+
+
+# =============================================================================
+# RESPONSE CACHE
+# =============================================================================
+
+@benchmark("response_cache")
+def bench_response_cache(latency: float = 0.1, users: int = 40):
+    """
+    LLM calls per message through smart_graph when many new customers send the
+    same few messages in different spellings, with the response cache off and
+    on. Also checks that registered greetings and order turns are never cached
+    and that a menu change drops the cached menu answers.
+    """
+    from langchain_core.language_models.chat_models import BaseChatModel
+    from langchain_core.messages import AIMessage, HumanMessage
+    from langchain_core.outputs import ChatGeneration, ChatResult
+    from app.core import smart_graph
+    from app.core.catalog import menu_catalog
+    from app.core.db import db
+    from app.core.response_cache import response_cache
+
+    db.client.tables["pizzas_armadas"] = [
+        {"id": "p1", "categoria": "Tradicionales", "nombre": "Hawaiana", "tamano": "Mediana", "precio": 42000,
+         "activo": True},
+        {"id": "p2", "categoria": "Tradicionales", "nombre": "Pepperoni", "tamano": "Mediana", "precio": 45000,
+         "activo": True},
+    ]
+    db.client.tables.setdefault("clientes", []).append(
+        {"id": 30_000, "user_id": "cache_registered", "first_name": "Ana", "last_name": "Gómez"})
+    menu_catalog.invalidate()
+
+    # Spellings of the same three questions; the fast path leaves two-item questions to the LLM
+    variants = [
+        ["Hola", "hola!", "Hola.", "HOLA"],
+        ["Cuánto cuesta la hawaiana y la pepperoni?", "cuanto cuesta la hawaiana y la pepperoni",
+         "¿Cuánto cuesta la Hawaiana y la Pepperoni?"],
+        ["Buenas tardes", "buenas tardes!!"],
+    ]
+    llm_calls = [0]
+
+    class CountingChatModel(BaseChatModel):
+        latency: float = 0.1
+
+        @property
+        def _llm_type(self) -> str:
+            return "counting-fake"
+
+        def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+            raise NotImplementedError
+
+        async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+            llm_calls[0] += 1
+            await asyncio.sleep(self.latency)
+            last = next((msg.content for msg in reversed(messages) if isinstance(msg, HumanMessage)), "")
+            reply = f"Con mucho gusto, respuesta {llm_calls[0]} a: {last}"
+            if "Ana" in str(messages):
+                reply = "Hola Ana, que gusto verte de nuevo"
+            return ChatResult(generations=[ChatGeneration(message=AIMessage(content=reply))])
+
+    async def run(enabled: bool) -> float:
+        response_cache.enabled = enabled
+        before = llm_calls[0]
+        for u in range(users):
+            group = variants[u % len(variants)]
+            await smart_graph.process_message(f"rcache_{enabled}_{u}", group[(u // len(variants)) % len(group)])
+        return (llm_calls[0] - before) / users
+
+    original = (smart_graph.llm_with_tools, smart_graph.llm_without_tools, response_cache.enabled)
+
+    async def main_async():
+        smart_graph.llm_with_tools = CountingChatModel(latency=latency)
+        smart_graph.llm_without_tools = CountingChatModel(latency=latency)
+        off = await run(False)
+        on = await run(True)
+        stats = response_cache.stats()
+        assert on < off and stats["hits"] == users - len(variants), stats
+        assert stats["normalized_hits"] > 0 and stats["exact_hits"] > 0, stats
+        hit_rate = stats["hit_rate"]
+
+        # Personal turns never come from the cache
+        before = llm_calls[0]
+        first = await smart_graph.process_message("cache_registered", "Hola")
+        assert llm_calls[0] == before + 1 and "Ana" in first
+
+        # A new menu version drops the menu answers, greetings are kept until their TTL
+        db.client.tables["pizzas_armadas"][0]["precio"] = 44000
+        menu_catalog.invalidate()
+        before = llm_calls[0]
+        await smart_graph.process_message("rcache_after_menu", variants[1][0])
+        await smart_graph.process_message("rcache_after_menu_2", variants[0][0])
+        assert llm_calls[0] == before + 1, (llm_calls[0] - before, response_cache.stats())
+        stats = response_cache.stats()
+        assert stats["stale_dropped"] == 1, stats
+
+        # Customer lookups make a reply personal; any write is a side effect
+        def after_tools(*names) -> dict:
+            calls = [{"name": name, "args": {}, "id": f"call_{name}"} for name in names]
+            return {"messages": [HumanMessage(content="hola"), AIMessage(content="", tool_calls=calls)]}
+        reply = AIMessage(content="Con mucho gusto")
+        assert response_cache._personal(after_tools("search_menu"), reply) == ""
+        assert response_cache._personal(after_tools("get_customer", "search_menu"), reply) == "personal_tool"
+        assert response_cache._personal(after_tools("get_active_order", "create_or_update_order"), reply) == "side_effects"
+
+        print(f"🗃️  Response cache ({users} new customers, {sum(map(len, variants))} spellings of "
+              f"{len(variants)} messages, {latency * 1000:.0f} ms per LLM call)")
+        print(f"   • Off: {off:.2f} LLM calls/message")
+        print(f"   • On:  {on:.2f} LLM calls/message | hit rate {hit_rate:.0%} "
+              f"({stats['exact_hits']} exact, {stats['normalized_hits']} normalized)")
+        print(f"   • Bypassed {stats['bypassed']} | stale after menu change {stats['stale_dropped']}")
+
+    try:
+        asyncio.run(main_async())
+    finally:
+        smart_graph.llm_with_tools, smart_graph.llm_without_tools, response_cache.enabled = original
+        response_cache.clear()
+        db.client.tables.pop("pizzas_armadas", None)
+        menu_catalog.invalidate()
+
+
+# =============================================================================
+# PROMPT PREFIX
+# =============================================================================
+
+def _legacy_conversation_context(state: dict) -> list:
+    """_build_conversation_context before prompt_layout.py, kept for comparison."""
+    from langchain_core.messages import AIMessage, HumanMessage
+    from app.core.prompts import (
+        SYSTEM_PROMPT, CONTEXT_NEW_CUSTOMER, CONTEXT_RETURNING_CUSTOMER,
+        CONTEXT_MENU_INQUIRY, CONTEXT_ORDER_START, CONTEXT_ORDER_CONFIRMATION
+    )
+    messages = [("system", SYSTEM_PROMPT)]
+    user_id = state["user_id"]
+    messages.append(("system", f"IMPORTANTE: El user_id de este cliente es '{user_id}'. Usa SIEMPRE este user_id exacto cuando uses herramientas como get_customer, create_customer, etc. NO uses el nombre del cliente como user_id."))
+    if state["current_step"] == "greeting":
+        if state.get("customer") and state["customer"].get("first_name"):
+            customer_name = f"{state['customer'].get('first_name', '')} {state['customer'].get('last_name', '')}"
+            messages.append(("system", CONTEXT_RETURNING_CUSTOMER.format(customer_name=customer_name.strip())))
+            messages.append(("system", f"IMPORTANTE: Este cliente se llama {customer_name.strip()}. Salúdalo por su nombre real."))
+        else:
+            messages.append(("system", CONTEXT_NEW_CUSTOMER))
+            messages.append(("system", "IMPORTANTE: Este cliente NO está registrado. NO inventes nombres. Salúdalo cordialmente sin usar nombres inventados."))
+    elif state["current_step"] == "menu":
+        messages.append(("system", CONTEXT_MENU_INQUIRY))
+    elif state["current_step"] == "full_menu":
+        messages.append(("system", CONTEXT_MENU_INQUIRY))
+        messages.append(("system", "IMPORTANTE: El cliente pidió el MENÚ COMPLETO. Debes usar la herramienta send_full_menu para enviar la imagen del menú."))
+    elif state["current_step"] == "order":
+        messages.append(("system", CONTEXT_ORDER_START))
+    elif state["current_step"] == "confirmation":
+        messages.append(("system", CONTEXT_ORDER_CONFIRMATION))
+    if state.get("customer") and state["customer"]:
+        messages.append(("system", f"Datos del cliente en la base de datos: {state['customer']}"))
+    else:
+        messages.append(("system", "IMPORTANTE: Este cliente NO está en la base de datos. NO inventes información sobre él."))
+    if state.get("active_order") and state["active_order"]:
+        messages.append(("system", f"Pedido activo actual: {state['active_order']}"))
+    if state.get("conversation_summary"):
+        messages.append(("system", f"Resumen de la conversación anterior con este cliente:\n{state['conversation_summary']}"))
+    for msg in state.get("messages", []):
+        if isinstance(msg, HumanMessage):
+            messages.append(("human", msg.content))
+        elif isinstance(msg, AIMessage):
+            messages.append(("assistant", msg.content))
+    return messages
+
+
+@benchmark("prompt_prefix")
+def bench_prompt_prefix(users: int = 30):
+    """
+    Prompt tokens a provider-side prefix cache could reuse: for every prompt of
+    a run of conversations (users interleaved, steps greeting -> menu -> order
+    -> confirmation -> general), the longest prefix it shares with any earlier
+    prompt, in tokens. Old layout vs. core/prompt_layout.py.
+    """
+    from langchain_core.messages import AIMessage, HumanMessage
+    from app.core.prompt_layout import build_context, static_prefix
+    from app.core.tokens import estimate_tokens
+
+    steps = ["greeting", "menu", "menu", "order", "confirmation", "general"]
+
+    def states():
+        """Turn-by-turn ChatStates, users interleaved like real traffic."""
+        history = {u: [] for u in range(users)}
+        for turn, step in enumerate(steps):
+            for u in range(users):
+                registered = u % 2 == 0
+                human, answer = _sample_turn(u, turn)
+                history[u].append(HumanMessage(content=human))
+                yield {
+                    "user_id": f"57300{u:07d}",
+                    "customer": {"first_name": f"Cliente{u}", "last_name": "Pérez", "phone": f"300{u:07d}"} if registered else {},
+                    "current_step": step,
+                    "active_order": {"items": [{"name": "Hawaiana", "quantity": 1}], "subtotal": 42000} if turn >= 3 else {},
+                    "conversation_summary": "",
+                    "messages": list(history[u]),
+                }
+                history[u].append(AIMessage(content=answer))
+
+    def serialize(messages) -> str:
+        return "".join(f"<|{role}|>{content}<|end|>" for role, content in messages)
+
+    def common_prefix(a: str, b: str) -> int:
+        low, high = 0, min(len(a), len(b))
+        while low < high:
+            mid = (low + high + 1) // 2
+            if a[:mid] == b[:mid]:
+                low = mid
+            else:
+                high = mid - 1
+        return low
+
+    def measure(build) -> tuple:
+        seen, total, reused = [], 0, 0
+        for state in states():
+            prompt = serialize(build(state))
+            shared = max((common_prefix(prompt, earlier) for earlier in seen), default=0)
+            total += estimate_tokens(prompt)
+            reused += estimate_tokens(prompt[:shared])
+            seen.append(prompt)
+        return total, reused
+
+    # Same content, only reordered: every old block except the reworded user_id rule is still there,
+    # and the first message is the one precomputed prefix of the step
+    for state in states():
+        messages = build_context(state)
+        assert messages[0][1] is static_prefix(state["current_step"], bool(state["customer"]))
+        new_text = serialize(messages)
+        missing = [content for role, content in _legacy_conversation_context(state)
+                   if "user_id de este cliente" not in content and content.strip() not in new_text]
+        assert not missing, missing
+
+    started = time.perf_counter()
+    legacy_total, legacy_reused = measure(_legacy_conversation_context)
+    new_total, new_reused = measure(build_context)
+    elapsed = time.perf_counter() - started
+    prompts = users * len(steps)
+    assert new_reused > legacy_reused * 1.2, (legacy_reused, new_reused)
+
+    print(f"🧩 Prompt prefix reuse ({users} users x {len(steps)} turns, {prompts} prompts)")
+    print(f"   • Old layout: {legacy_reused / prompts:7.1f} of {legacy_total / prompts:7.1f} tokens/prompt reusable "
+          f"({legacy_reused / legacy_total:.0%})")
+    print(f"   • New layout: {new_reused / prompts:7.1f} of {new_total / prompts:7.1f} tokens/prompt reusable "
+          f"({new_reused / new_total:.0%})")
+    print(f"   • measured in {elapsed:.2f}s")
+
+
+# =============================================================================
+# TOOL EXECUTOR
+# =============================================================================
+
+@benchmark("tool_executor")
+def bench_tool_executor(latency: float = 0.05, rounds: int = 10):
+    """
+    Wall time of one model message asking for get_customer + search_menu +
+    get_active_order (database round trip `latency` seconds) run one call at a
+    time, through ToolNode and through ToolExecutor. Also checks results come
+    back in tool_call order and that a new customer's create_customer +
+    create_or_update_order message still runs the writes in order.
+    """
+    from langgraph.prebuilt import ToolNode
+    from app.core.db import db
+    from app.core.loader import request_scope
+    from app.core.tool_executor import ToolExecutor
+    from app.core.tools import ALL_TOOLS, PARALLEL_SAFE_TOOLS
+
+    client = db.client
+    client.tables.setdefault("clientes", []).append(
+        {"id": 40_000, "user_id": "tools_user", "first_name": "Ana", "last_name": "Gómez"})
+    client.tables.setdefault("pedidos_activos", []).append(
+        {"id": 40_000, "cliente_id": 40_000, "cart": [], "subtotal": 0})
+    client.tables["menu"] = [{"id": 1, "name": "Pizza Hawaiana", "price": 42000, "active": True}]
+
+    reads = [
+        {"name": "get_customer", "args": {"user_id": "tools_user"}, "id": "call_customer"},
+        {"name": "search_menu", "args": {"query": "hawaiana"}, "id": "call_menu"},
+        {"name": "get_active_order", "args": {"user_id": "tools_user"}, "id": "call_order"},
+    ]
+
+    def writes(user_id: str) -> list:
+        return [
+            {"name": "create_customer", "args": {"user_id": user_id, "first_name": "Luis", "last_name": "Mora"},
+             "id": "call_create"},
+            {"name": "create_or_update_order", "args": {"user_id": user_id, "items": [{"name": "Hawaiana"}],
+                                                        "subtotal": 42000, "direccion": "Calle 10 #5-20",
+                                                        "metodo_de_pago": "efectivo"}, "id": "call_update"},
+        ]
+
+    sequential = ToolExecutor(ALL_TOOLS, read_only=(), max_workers=1)
+    executor = ToolExecutor(ALL_TOOLS, read_only=PARALLEL_SAFE_TOOLS, max_workers=8)
+    tool_node = ToolNode(ALL_TOOLS)
+
+    async def with_tool_node(calls):
+        from langchain_core.messages import AIMessage
+        return (await tool_node.ainvoke({"messages": [AIMessage(content="", tool_calls=calls)]}))["messages"]
+
+    async def timed(run) -> float:
+        started = time.perf_counter()
+        for _ in range(rounds):
+            with request_scope():
+                messages = await run(reads)
+            assert [m.tool_call_id for m in messages] == [call["id"] for call in reads]
+            assert "Gómez" in messages[0].content and "Hawaiana" in messages[1].content
+        return (time.perf_counter() - started) / rounds
+
+    async def write_order_holds(run, user_id: str) -> bool:
+        with request_scope():
+            messages = await run(writes(user_id))
+        return "Hawaiana" in messages[1].content
+
+    async def main_async():
+        client.latency = latency
+        try:
+            one_at_a_time = await timed(sequential.run)
+            node_seconds = await timed(with_tool_node)
+            executor_seconds = await timed(executor.run)
+            node_ordered = await write_order_holds(with_tool_node, "tools_new_node")
+            executor_ordered = await write_order_holds(executor.run, "tools_new_executor")
+        finally:
+            client.latency = 0.0
+        # get_active_order looks the customer up before its order, so the batch is two round trips at best
+        assert executor_seconds < one_at_a_time * 0.8, (executor_seconds, one_at_a_time)
+        assert executor_ordered, "create_or_update_order must see the customer created before it"
+
+        stats = executor.stats()
+        print(f"🧰 Tool executor (get_customer + search_menu + get_active_order, {latency * 1000:.0f} ms per query)")
+        print(f"   • One at a time: {one_at_a_time * 1000:6.1f} ms per message")
+        print(f"   • ToolNode:      {node_seconds * 1000:6.1f} ms per message | "
+              f"create_customer + order {'ok' if node_ordered else 'FAILED (writes raced)'}")
+        print(f"   • ToolExecutor:  {executor_seconds * 1000:6.1f} ms per message | create_customer + order ok")
+        for name, tool_stats in stats["tools"].items():
+            print(f"     - {name:<24} {tool_stats['calls']:>3} calls | avg {tool_stats['avg_ms']:6.1f} ms | "
+                  f"max {tool_stats['max_ms']:6.1f} ms")
+
+    try:
+        asyncio.run(main_async())
+    finally:
+        client.tables.pop("menu", None)
+
+
+def main():
+    selected = sys.argv[1:] or list(BENCHMARKS)
+    for name in selected:
+        if name not in BENCHMARKS:
+            print(f"❌ Unknown benchmark '{name}'. Available: {', '.join(BENCHMARKS)}")
+            sys.exit(1)
+        started = time.perf_counter()
+        BENCHMARKS[name]()
+        print(f"   ⏱️  {name} took {time.perf_counter() - started:.2f}s\n")
+
+
+if __name__ == "__main__":
+    main()